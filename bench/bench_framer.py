@@ -0,0 +1,100 @@
+"""Measure how fast the Python server's MessageFramer splits a stream of
+pipelined `send` commands into messages, compared to the bytes-slicing parser
+that it replaced.
+
+    python3 bench/bench_framer.py --messages 1000000
+
+Author:  Ian Fisher (iafisher@protonmail.com)
+Version: September 2018
+"""
+import argparse
+import time
+
+from common import import_server
+
+
+server = import_server()
+
+
+class FakeSocket:
+    """Serve a byte string in chunks, like a socket with data waiting."""
+
+    def __init__(self, data, chunk_size):
+        self.data = memoryview(data)
+        self.pos = 0
+        self.chunk_size = chunk_size
+
+    def recv(self, n):
+        n = min(n, self.chunk_size)
+        chunk = self.data[self.pos:self.pos+n].tobytes()
+        self.pos += len(chunk)
+        return chunk
+
+    def recv_into(self, view):
+        n = min(len(view), self.chunk_size, len(self.data) - self.pos)
+        view[:n] = self.data[self.pos:self.pos+n]
+        self.pos += n
+        return n
+
+
+def parse_with_framer(sock):
+    framer = server.MessageFramer()
+    count = 0
+    while True:
+        for message, error in framer.messages():
+            count += 1
+
+        view = framer.get_buffer()
+        n = sock.recv_into(view)
+        view.release()
+        if n == 0:
+            return count
+        framer.commit(n)
+
+
+def parse_legacy(sock):
+    """The parsing loop of the original ChatConnection.receive_message, minus
+    the body of the special case for uploads.
+    """
+    buffer = b''
+    count = 0
+    while True:
+        data = sock.recv(1024) if not buffer else buffer
+        if not data:
+            return count
+
+        end = data.find(b'\r\n')
+        while end == -1:
+            old_end = len(data)
+            data += sock.recv(1024)
+            if len(data) == old_end:
+                return count
+            end = data.find(b'\r\n', old_end)
+
+        if data.startswith(b'upload '):
+            pass
+
+        buffer = data[end+2:]
+        # The message is sliced out, as it was, but not handled.
+        _ = data[:end]
+        count += 1
+
+
+def measure(label, parse, data, chunk_size):
+    start = time.perf_counter()
+    count = parse(FakeSocket(data, chunk_size))
+    elapsed = time.perf_counter() - start
+    print('{}: {:9.0f} messages/sec ({} messages in {:.2f} s)'.format(
+        label, count / elapsed, count, elapsed))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--messages', type=int, default=1000000)
+    parser.add_argument('--chunk-size', type=int, default=65536,
+        help='maximum bytes returned by each simulated recv call')
+    args = parser.parse_args()
+
+    data = b'send bob Hello, world!\r\n' * args.messages
+    measure('MessageFramer', parse_with_framer, data, args.chunk_size)
+    measure('legacy parser', parse_legacy, data, args.chunk_size)
@@ -0,0 +1,79 @@
+"""Measure the throughput of `send` in the Python server's storage layer, with
+and without the group-commit StorageWriter.
+
+Each of the client threads shares one StorageLayer, as the connections to the
+server do, and stores direct messages as fast as it can. Run it on the same
+kind of disk as the production database, since the point of group commit is to
+amortize the cost of fsync.
+
+    python3 bench/bench_group_commit.py --threads 32 --messages 200
+
+Author:  Ian Fisher (iafisher@protonmail.com)
+Version: September 2018
+"""
+import argparse
+import os
+import tempfile
+import threading
+import time
+
+from common import create_database, import_server
+
+
+server = import_server()
+
+
+def run(pool, writer, nthreads, nmessages):
+    storage = server.StorageLayer(pool, writer)
+    storage.start()
+    uid = storage.create_user('bench', 'pwd')
+
+    barrier = threading.Barrier(nthreads + 1)
+
+    def client():
+        barrier.wait()
+        for i in range(nmessages):
+            storage.create_message(uid, 'bench', uid, 'message %d' % i)
+
+    threads = [threading.Thread(target=client) for _ in range(nthreads)]
+    for thread in threads:
+        thread.start()
+    barrier.wait()
+    start = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    storage.close()
+    return nthreads * nmessages / elapsed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--threads', type=int, default=32)
+    parser.add_argument('--messages', type=int, default=200,
+        help='messages to send per thread')
+    parser.add_argument('--commit-window', type=float, default=0.0,
+        help='milliseconds, as for the server')
+    parser.add_argument('--commit-batch-size', type=int, default=256)
+    parser.add_argument('--db-synchronous', default='FULL')
+    parser.add_argument('--dir', default=None,
+        help='directory for the temporary database')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(dir=args.dir) as tmpdir:
+        path_to_db = os.path.join(tmpdir, 'bench.sqlite3')
+
+        create_database(path_to_db)
+        pool = server.ConnectionPool(path_to_db, size=args.threads,
+            synchronous=args.db_synchronous)
+        before = run(pool, None, args.threads, args.messages)
+        print('commit per write: {:10.0f} sends/sec'.format(before))
+
+        create_database(path_to_db)
+        pool = server.ConnectionPool(path_to_db, size=args.threads,
+            synchronous=args.db_synchronous)
+        writer = server.StorageWriter(pool, window=args.commit_window / 1000,
+            batch_size=args.commit_batch_size)
+        after = run(pool, writer, args.threads, args.messages)
+        print('group commit:     {:10.0f} sends/sec ({:.1f}x)'.format(
+            after, after / before))
@@ -0,0 +1,131 @@
+"""Count the system calls that the Python server makes per command when a
+client pipelines its commands, with the responses to each batch of commands
+coalesced into one write, and with one write per response as before.
+
+The connection runs in-process over a socket pair, so that its socket can be
+wrapped to count calls.
+
+    python3 bench/bench_pipeline.py --commands 20000 --pipeline 32
+
+Author:  Ian Fisher (iafisher@protonmail.com)
+Version: September 2018
+"""
+import argparse
+import collections
+import os
+import socket
+import tempfile
+import time
+
+from common import create_database, import_server
+
+
+server = import_server()
+
+
+class CountingSocket:
+    """Wrap a socket and count the calls that reach the operating system."""
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.calls = collections.Counter()
+
+    def recv_into(self, view):
+        self.calls['recv_into'] += 1
+        return self.sock.recv_into(view)
+
+    def sendmsg(self, buffers):
+        self.calls['sendmsg'] += 1
+        return self.sock.sendmsg(buffers)
+
+    def sendall(self, data):
+        self.calls['sendall'] += 1
+        return self.sock.sendall(data)
+
+    def sendfile(self, f, offset=0, count=None):
+        self.calls['sendfile'] += 1
+        return self.sock.sendfile(f, offset, count)
+
+    def setsockopt(self, *args):
+        self.calls['setsockopt'] += 1
+        return self.sock.setsockopt(*args)
+
+    def settimeout(self, timeout):
+        # Not a system call unless it switches the socket between blocking
+        # and non-blocking mode, so it isn't counted.
+        return self.sock.settimeout(timeout)
+
+    def close(self):
+        self.sock.close()
+
+
+class UnbufferedConnection(server.ChatConnection):
+    """Write each response as soon as it is ready, as the server used to."""
+
+    def send(self, msg):
+        super().send(msg)
+        if self.output:
+            self.output.flush(self.socket)
+
+
+def run(connection_class, username, storage, files, ncommands, pipeline):
+    client, server_side = socket.socketpair()
+    counting = CountingSocket(server_side)
+    connection = connection_class(counting, storage, files)
+    connection.start()
+
+    # Every run needs its own user, or the recv commands would fail without
+    # touching the database.
+    client.sendall(b'register %b pwd\r\n' % username)
+    assert client.recv(1024) == b'success\r\n'
+    counting.calls.clear()
+
+    batch = b'recv\r\n' * pipeline
+    expected = len(b'error inbox is empty\r\n') * pipeline
+    start = time.perf_counter()
+    for _ in range(ncommands // pipeline):
+        client.sendall(batch)
+        received = 0
+        while received < expected:
+            received += len(client.recv(65536))
+    elapsed = time.perf_counter() - start
+
+    calls = counting.calls.copy()
+    client.close()
+    connection.join()
+    return calls, (ncommands // pipeline) * pipeline / elapsed
+
+
+def report(label, calls, ncommands, throughput):
+    total = sum(calls.values())
+    details = ', '.join(
+        '{} {:.2f}'.format(name, count / ncommands)
+        for name, count in sorted(calls.items())
+    )
+    print('{:12} {:5.2f} syscalls/command ({}), {:8.0f} commands/sec'.format(
+        label, total / ncommands, details, throughput))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--commands', type=int, default=20000)
+    parser.add_argument('--pipeline', type=int, default=32,
+        help='commands sent in each batch before waiting for the responses')
+    args = parser.parse_args()
+    ncommands = args.commands - args.commands % args.pipeline
+
+    server.logger.disabled = True
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path_to_db = os.path.join(tmpdir, 'bench.sqlite3')
+        create_database(path_to_db)
+        storage = server.StorageLayer(server.ConnectionPool(path_to_db))
+        storage.start()
+
+        for i, (label, connection_class) in enumerate((
+                ('per response', UnbufferedConnection),
+                ('coalesced', server.ChatConnection))):
+            calls, throughput = run(connection_class, b'bench%d' % i, storage,
+                server.FileStore(tmpdir), ncommands, args.pipeline)
+            report(label, calls, ncommands, throughput)
+
+        storage.close()
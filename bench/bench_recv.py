@@ -0,0 +1,92 @@
+"""Measure the latency of `recv` in the Python server's storage layer when the
+messages table holds a large backlog, before and after the indexes added by the
+schema migrations.
+
+    python3 bench/bench_recv.py --messages 1000000 --inboxes 10000
+
+Author:  Ian Fisher (iafisher@protonmail.com)
+Version: September 2018
+"""
+import argparse
+import os
+import random
+import statistics
+import tempfile
+import time
+
+from common import create_database, import_server
+
+
+server = import_server()
+
+
+def fill(db, nmessages, ninboxes):
+    db.execute('BEGIN;')
+    db.executemany(
+        'INSERT INTO users (username, password) VALUES (?, ?);',
+        (('user%d' % i, 'pwd') for i in range(ninboxes))
+    )
+    db.executemany(
+        '''
+        INSERT INTO messages (timestamp, source_id, destination, inbox_id,
+            body)
+        VALUES ('2018-09-01T00:00:00Z', 1, 'user', ?, 'Hello, world!');
+        ''',
+        ((i % ninboxes + 1,) for i in range(nmessages))
+    )
+    db.execute('COMMIT;')
+
+
+def measure(storage, inboxes):
+    latencies = []
+    for inbox in inboxes:
+        start = time.perf_counter()
+        storage.take_messages(inbox)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def report(label, latencies):
+    latencies.sort()
+    print('{}: median {:8.2f} ms, max {:8.2f} ms'.format(
+        label,
+        statistics.median(latencies) * 1000,
+        latencies[-1] * 1000,
+    ))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--messages', type=int, default=1000000,
+        help='messages queued across all inboxes')
+    parser.add_argument('--inboxes', type=int, default=10000)
+    parser.add_argument('--samples', type=int, default=20,
+        help='recv calls to time before and after')
+    parser.add_argument('--dir', default=None,
+        help='directory for the temporary database')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(dir=args.dir) as tmpdir:
+        path_to_db = os.path.join(tmpdir, 'bench.sqlite3')
+        create_database(path_to_db)
+        pool = server.ConnectionPool(path_to_db, size=1)
+        storage = server.StorageLayer(pool)
+
+        # Start from the schema as it was before the indexes were added.
+        db = pool.connect()
+        db.execute('DROP INDEX users_username;')
+        db.execute('DROP INDEX messages_inbox;')
+        db.execute('PRAGMA user_version=1;')
+        print('Queueing {} messages...'.format(args.messages))
+        fill(db, args.messages, args.inboxes)
+
+        inboxes = random.sample(range(1, args.inboxes + 1), 2 * args.samples)
+        report('without indexes', measure(storage, inboxes[:args.samples]))
+
+        start = time.perf_counter()
+        server.migrate_database(db)
+        print('migration took {:.1f} s'.format(time.perf_counter() - start))
+        db.close()
+
+        report('with indexes   ', measure(storage, inboxes[args.samples:]))
+        storage.close()
@@ -0,0 +1,106 @@
+"""Measure the throughput of `send` in the Python server's storage layer, with
+the messages table in one database file and partitioned across several.
+
+Each of the client threads shares one StorageLayer, as the connections to the
+server do, and stores direct messages for an inbox of its own as fast as it
+can. Each shard has a StorageWriter of its own, as in the server.
+
+Group commit already lets the senders to one file share each fsync, so more
+shards split the same senders into smaller batches: on a disk whose fsync is
+fast, the extra commits make them slower, and only once the writers spend their
+time waiting for the disk do they keep up with one file. `--fsync-latency` adds
+a wait to every commit, to stand for a slower disk (a network volume or a
+spinning disk) than the one that the benchmark runs on.
+
+    python3 bench/bench_shards.py --threads 32 --messages 200 --shards 4
+    python3 bench/bench_shards.py --fsync-latency 2
+
+Author:  Ian Fisher (iafisher@protonmail.com)
+Version: September 2018
+"""
+import argparse
+import os
+import tempfile
+import threading
+import time
+
+from common import create_database, import_server
+
+
+server = import_server()
+
+
+class SlowDiskWriter(server.StorageWriter):
+    """A StorageWriter that waits `latency` seconds more for each commit."""
+
+    def __init__(self, pool, latency, **kwargs):
+        super().__init__(pool, **kwargs)
+        self.latency = latency
+
+    def commit_batch(self, db, cursor, batch):
+        super().commit_batch(db, cursor, batch)
+        time.sleep(self.latency)
+
+
+def open_storage(path_to_db, nshards, args):
+    shards = []
+    for index in range(nshards):
+        pool = server.ConnectionPool(server.shard_path(path_to_db, index),
+            size=args.threads, synchronous=args.db_synchronous)
+        writer = SlowDiskWriter(pool, args.fsync_latency / 1000,
+            window=args.commit_window / 1000,
+            batch_size=args.commit_batch_size)
+        shards.append(server.MessageShard(pool, writer))
+    storage = server.StorageLayer(shards[0].pool, shards[0].writer,
+        shards=shards[1:])
+    storage.start()
+    return storage
+
+
+def run(storage, nthreads, nmessages):
+    uids = [storage.create_user('bench%d' % i, 'pwd') for i in range(nthreads)]
+
+    barrier = threading.Barrier(nthreads + 1)
+
+    def client(uid):
+        barrier.wait()
+        for i in range(nmessages):
+            storage.create_message(uid, 'bench', uid, 'message %d' % i)
+
+    threads = [threading.Thread(target=client, args=(uid,)) for uid in uids]
+    for thread in threads:
+        thread.start()
+    barrier.wait()
+    start = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    storage.close()
+    return nthreads * nmessages / elapsed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--threads', type=int, default=32)
+    parser.add_argument('--messages', type=int, default=200,
+        help='messages to send per thread')
+    parser.add_argument('--shards', type=int, default=4)
+    parser.add_argument('--commit-window', type=float, default=0.0,
+        help='milliseconds, as for the server')
+    parser.add_argument('--commit-batch-size', type=int, default=256)
+    parser.add_argument('--db-synchronous', default='FULL')
+    parser.add_argument('--fsync-latency', type=float, default=0.0,
+        help='milliseconds to add to each commit')
+    parser.add_argument('--dir', default=None,
+        help='directory for the temporary databases')
+    args = parser.parse_args()
+
+    results = []
+    for nshards in (1, args.shards):
+        with tempfile.TemporaryDirectory(dir=args.dir) as tmpdir:
+            path_to_db = os.path.join(tmpdir, 'bench.sqlite3')
+            create_database(path_to_db)
+            storage = open_storage(path_to_db, nshards, args)
+            results.append(run(storage, args.threads, args.messages))
+        print('{:2d} shard(s): {:10.0f} sends/sec ({:.1f}x)'.format(
+            nshards, results[-1], results[-1] / results[0]))
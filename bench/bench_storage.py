@@ -0,0 +1,127 @@
+"""Compare the latency of `send` and `recv` in the Python server's storage
+backends, and the time each takes to recover its state on startup.
+
+Messages are sent between random users one at a time, so the latencies include
+a commit (or an append to the log) each. Recovery is timed from the state that
+the sends leave behind, until the first `recv` on the reopened backend has
+returned: for memlog, once by replaying the whole log, as after a crash, and
+once from the snapshot that it writes when it is closed.
+
+    python3 bench/bench_storage.py --users 1000 --messages 20000
+
+Author:  Ian Fisher (iafisher@protonmail.com)
+Version: September 2018
+"""
+import argparse
+import os
+import random
+import statistics
+import tempfile
+import time
+
+from common import create_database, import_server
+
+
+server = import_server()
+
+
+def open_sqlite(tmpdir, args, create=True):
+    path_to_db = os.path.join(tmpdir, 'bench.sqlite3')
+    if create:
+        create_database(path_to_db)
+    pool = server.ConnectionPool(path_to_db, synchronous=args.db_synchronous)
+    storage = server.StorageLayer(pool, server.StorageWriter(pool))
+    storage.start()
+    return storage
+
+
+def open_memlog(tmpdir, args, create=True):
+    storage = server.MemLogStorage(os.path.join(tmpdir, 'bench-memlog'),
+        sync=args.db_synchronous in ('FULL', 'EXTRA'))
+    storage.start()
+    return storage
+
+
+def crash(storage):
+    """Stop a storage backend without the clean shutdown that would write a
+    snapshot.
+    """
+    if isinstance(storage, server.MemLogStorage):
+        storage.stopping.set()
+        storage.log.stop()
+    else:
+        storage.close()
+
+
+def timed_calls(f, calls):
+    latencies = []
+    for args in calls:
+        start = time.perf_counter()
+        f(*args)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def summarize(latencies):
+    latencies.sort()
+    return 'median {:7.3f} ms, p99 {:7.3f} ms'.format(
+        statistics.median(latencies) * 1000,
+        latencies[int(len(latencies) * 0.99)] * 1000,
+    )
+
+
+def recover(label, how, open_storage, tmpdir, args, uid):
+    start = time.perf_counter()
+    storage = open_storage(tmpdir, args, create=False)
+    storage.take_messages(uid)
+    print('{:7} recovery {:17} {:8.3f} s'.format(
+        label, how + ':', time.perf_counter() - start))
+    storage.close()
+    return storage
+
+
+def run(label, open_storage, args):
+    rng = random.Random(args.seed)
+    with tempfile.TemporaryDirectory(dir=args.dir) as tmpdir:
+        storage = open_storage(tmpdir, args)
+        uids = [
+            storage.create_user('user%d' % i, 'pwd') for i in range(args.users)
+        ]
+        sends = []
+        for i in range(args.messages):
+            recipient = rng.choice(uids)
+            sends.append(
+                (rng.choice(uids), 'user', recipient, 'message %d' % i)
+            )
+        send = timed_calls(storage.create_message, sends)
+        # Receive from half of the inboxes, so that the other half is left to
+        # be recovered.
+        recv = timed_calls(
+            storage.take_messages, [(uid,) for uid in uids[::2]]
+        )
+        print('{:7} send: {}'.format(label, summarize(send)))
+        print('{:7} recv: {}'.format(label, summarize(recv)))
+
+        crash(storage)
+        storage = recover(label, 'after a crash', open_storage, tmpdir, args,
+            uids[1])
+        if isinstance(storage, server.MemLogStorage):
+            recover(label, 'from a snapshot', open_storage, tmpdir, args,
+                uids[3])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--messages', type=int, default=20000,
+        help='messages to send, one at a time')
+    parser.add_argument('--db-synchronous', default='FULL',
+        help='as for the server, which also decides whether memlog fsyncs')
+    parser.add_argument('--seed', default='bench_storage')
+    parser.add_argument('--dir', default=None,
+        help='directory for the temporary databases')
+    args = parser.parse_args()
+
+    server.logger.disabled = True
+    run('sqlite', open_sqlite, args)
+    run('memlog', open_memlog, args)
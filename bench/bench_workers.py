@@ -0,0 +1,108 @@
+"""Measure how the throughput of the Python server scales with the number of
+worker processes (the --workers option).
+
+The server is started once for each worker count, and hammered by client
+processes that each log in and then send `recv` (or, with --send, alternate
+`send` and `recv`) and wait for the response, as fast as they can. Throughput
+can only scale up to the number of cores that are not busy running clients.
+
+    python3 bench/bench_workers.py --workers 1 2 4 --clients 16
+
+Author:  Ian Fisher (iafisher@protonmail.com)
+Version: September 2018
+"""
+import argparse
+import multiprocessing
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+from common import PYTHON_DIR, create_database
+
+
+SERVER = os.path.join(PYTHON_DIR, 'server.py')
+
+
+def client(port, index, duration, send, start_event, results):
+    sock = socket.create_connection(('localhost', port))
+    username = b'bench%d' % index
+    sock.sendall(b'register ' + username + b' pwd\r\n')
+    sock.recv(1024)
+
+    if send:
+        commands = [b'send ' + username + b' hello\r\n', b'recv\r\n']
+    else:
+        commands = [b'recv\r\n']
+
+    start_event.wait()
+    count = 0
+    deadline = time.monotonic() + duration
+    while time.monotonic() < deadline:
+        for command in commands:
+            sock.sendall(command)
+            # Every response fits in one segment.
+            sock.recv(4096)
+        count += len(commands)
+    sock.close()
+    results.put(count)
+
+
+def run(nworkers, args, tmpdir):
+    path_to_db = os.path.join(tmpdir, 'bench.sqlite3')
+    path_to_files = os.path.join(tmpdir, 'files')
+    create_database(path_to_db)
+    server = subprocess.Popen([
+        sys.executable, SERVER, '-q', '-d', path_to_db, '-f', path_to_files,
+        '-p', str(args.port), '--workers', str(nworkers),
+        '--engine', args.engine, '--db-synchronous', 'NORMAL',
+    ])
+    try:
+        time.sleep(args.startup)
+        start_event = multiprocessing.Event()
+        results = multiprocessing.Queue()
+        clients = [
+            multiprocessing.Process(target=client, args=(
+                args.port, i, args.duration, args.send, start_event, results
+            ))
+            for i in range(args.clients)
+        ]
+        for process in clients:
+            process.start()
+        # Give every client time to connect and register.
+        time.sleep(args.startup)
+        start_event.set()
+        total = sum(results.get() for _ in clients)
+        for process in clients:
+            process.join()
+    finally:
+        server.terminate()
+        server.wait()
+    return total / args.duration
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--clients', type=int, default=16)
+    parser.add_argument('--duration', type=float, default=5.0,
+        help='seconds to run each measurement for')
+    parser.add_argument('--engine', default='threaded')
+    parser.add_argument('--send', action='store_true',
+        help='alternate send and recv instead of only calling recv')
+    parser.add_argument('--port', type=int, default=8890)
+    parser.add_argument('--startup', type=float, default=1.0,
+        help='seconds to wait for the server and the clients to start')
+    args = parser.parse_args()
+
+    print('{} cores'.format(os.cpu_count()))
+    baseline = None
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for nworkers in args.workers:
+            throughput = run(nworkers, args, tmpdir)
+            if baseline is None:
+                baseline = throughput
+            print('{:3d} workers: {:10.0f} commands/sec ({:.2f}x)'.format(
+                nworkers, throughput, throughput / baseline))
@@ -0,0 +1,37 @@
+"""Shared helpers for the benchmarks in this directory.
+
+Author:  Ian Fisher (iafisher@protonmail.com)
+Version: September 2018
+"""
+import os
+import subprocess
+import sys
+
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+CREATEDB = os.path.join(ROOT_DIR, 'test', 'createdb.py')
+PYTHON_DIR = os.path.join(ROOT_DIR, 'python')
+TEST_DIR = os.path.join(ROOT_DIR, 'test')
+
+
+def import_server():
+    """Import the Python implementation's server module."""
+    if PYTHON_DIR not in sys.path:
+        sys.path.insert(0, PYTHON_DIR)
+    import server
+    return server
+
+
+def import_testhelper():
+    """Import the socket helpers of the test suite."""
+    if TEST_DIR not in sys.path:
+        sys.path.insert(0, TEST_DIR)
+    import testhelper
+    return testhelper
+
+
+def create_database(path):
+    """Create a fresh chat database at `path` with the test suite's schema."""
+    if os.path.exists(path):
+        os.remove(path)
+    subprocess.run([sys.executable, CREATEDB, path], check=True)
@@ -0,0 +1,424 @@
+"""Drive a chat server with many simulated users and report the throughput and
+the latency percentiles of each command.
+
+Like ./testclient, the load generator can start the server itself, with a
+fresh database and files directory, so that it works with any implementation:
+
+    python3 bench/loadgen.py python/server.py --users 2000 --duration 30 \
+        --mix send=50,recv=35,broadcast=1,upload=4,download=10 \
+        --output results.json
+
+With --no-start, it drives a server that is already running instead.
+
+Each simulated user has its own connection and sends one command at a time,
+waiting for the response before it picks the next command at random from the
+mix. The users are spread over several processes, each of which runs them on
+an asyncio event loop, so that the load generator is not limited by one
+interpreter.
+
+The end of a recv response cannot be told from its contents, so each recv is
+followed by an empty message, and the response is complete when the server's
+"error no such command" arrives.
+
+Author:  Ian Fisher (iafisher@protonmail.com)
+Version: September 2018
+"""
+import argparse
+import asyncio
+import datetime
+import json
+import multiprocessing
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+
+from common import CREATEDB, import_testhelper
+
+
+testhelper = import_testhelper()
+
+
+COMMANDS = ('send', 'broadcast', 'recv', 'upload', 'download')
+DEFAULT_MIX = 'send=50,recv=35,broadcast=1,upload=4,download=10'
+PERCENTILES = (('p50', 0.5), ('p99', 0.99), ('p999', 0.999))
+
+
+class Disconnected(Exception):
+    pass
+
+
+class Client:
+    """A simulated user's connection to the server."""
+
+    def __init__(self, sock, username):
+        self.sock = sock
+        self.username = username
+        self.buffer = b''
+
+    def register(self):
+        """Register the user, on the blocking socket."""
+        self.sock.sendall(testhelper.to_bytes('register {} pwd'.format(
+            self.username)))
+        while b'\r\n' not in self.buffer:
+            self.receive_blocking()
+        line, _, self.buffer = self.buffer.partition(b'\r\n')
+        return line == b'success'
+
+    def receive_blocking(self):
+        data = self.sock.recv(65536)
+        if not data:
+            raise Disconnected
+        self.buffer += data
+
+    async def receive(self):
+        data = await asyncio.get_running_loop().sock_recv(self.sock, 65536)
+        if not data:
+            raise Disconnected
+        self.buffer += data
+
+    async def request(self, data):
+        await asyncio.get_running_loop().sock_sendall(self.sock, data)
+
+    async def read_line(self):
+        while True:
+            end = self.buffer.find(b'\r\n')
+            if end != -1:
+                line = self.buffer[:end]
+                self.buffer = self.buffer[end+2:]
+                return line
+            await self.receive()
+
+    async def read_file(self):
+        """Read the response to a download message, and return whether it was
+        a file.
+        """
+        while not self.buffer.startswith(b'error') \
+                and self.buffer.count(b' ') < 3:
+            await self.receive()
+        if self.buffer.startswith(b'error'):
+            await self.read_line()
+            return False
+
+        # The header is `file <name> <length> `, and the name may contain the
+        # digits of the length, so the header is measured by its fields.
+        command, name, length, _ = self.buffer.split(b' ', 3)
+        header_length = len(command) + len(name) + len(length) + 3
+        end = header_length + int(length) + 2
+        while len(self.buffer) < end:
+            await self.receive()
+        self.buffer = self.buffer[end:]
+        return True
+
+
+class Simulation:
+    """The simulated users of one load generator process."""
+
+    def __init__(self, args, index, usernames, rng):
+        self.args = args
+        self.index = index
+        self.usernames = usernames
+        self.rng = rng
+        self.commands = list(args.mix)
+        self.weights = [args.mix[command] for command in self.commands]
+        self.file_body = b'x' * args.file_size
+        self.uploaded = []
+        self.nuploads = 0
+        self.latencies = {command: [] for command in COMMANDS}
+        self.errors = dict.fromkeys(COMMANDS, 0)
+        self.disconnects = 0
+
+    def new_filename(self):
+        self.nuploads += 1
+        return '{}_{}_{}.bin'.format(self.args.run_id, self.index,
+            self.nuploads)
+
+    async def run_user(self, client, deadline):
+        loop = asyncio.get_running_loop()
+        try:
+            while loop.time() < deadline:
+                command = self.rng.choices(self.commands, self.weights)[0]
+                start = time.perf_counter()
+                ok = await getattr(self, 'do_' + command)(client)
+                elapsed = time.perf_counter() - start
+                if ok:
+                    self.latencies[command].append(elapsed)
+                else:
+                    self.errors[command] += 1
+                if self.args.think_time:
+                    await asyncio.sleep(
+                        self.rng.expovariate(1000 / self.args.think_time)
+                    )
+        except (Disconnected, ConnectionError):
+            self.disconnects += 1
+
+    async def do_send(self, client):
+        recipient = self.rng.choice(self.usernames)
+        await client.request(testhelper.to_bytes(
+            'send {} {}'.format(recipient, self.args.message)))
+        return await client.read_line() == b'success'
+
+    async def do_broadcast(self, client):
+        await client.request(testhelper.to_bytes(
+            'send * {}'.format(self.args.message)))
+        return await client.read_line() == b'success'
+
+    async def do_recv(self, client):
+        await client.request(b'recv\r\n\r\n')
+        while await client.read_line() != b'error no such command':
+            pass
+        return True
+
+    async def do_upload(self, client):
+        filename = self.new_filename()
+        await client.request(
+            b'upload %b %d %b\r\n' % (filename.encode('utf-8'),
+                len(self.file_body), self.file_body)
+        )
+        if await client.read_line() == b'success':
+            self.uploaded.append(filename)
+            return True
+        else:
+            return False
+
+    async def do_download(self, client):
+        filename = self.rng.choice(self.uploaded)
+        await client.request(testhelper.to_bytes('download ' + filename))
+        return await client.read_file()
+
+
+def run_process(args, index, usernames, start_event, ready, results):
+    """Run the simulated users `usernames[index::args.processes]`."""
+    raise_fd_limit()
+    rng = random.Random('{}-{}'.format(args.seed, index))
+    simulation = Simulation(args, index, usernames, rng)
+
+    clients = []
+    for username in usernames[index::args.processes]:
+        client = Client(testhelper.new_client(port=args.port), username)
+        if not client.register():
+            sys.stderr.write('Could not register {}\n'.format(username))
+            sys.exit(1)
+        clients.append(client)
+
+    # Every process uploads a file first, so that there is always something to
+    # download.
+    seed_file = asyncio.run(upload_seed_file(simulation, clients[0]))
+    for client in clients:
+        client.sock.setblocking(False)
+
+    ready.put(index)
+    start_event.wait()
+    asyncio.run(run_users(simulation, clients))
+    results.put({
+        'latencies': simulation.latencies,
+        'errors': simulation.errors,
+        'disconnects': simulation.disconnects,
+        'seed_file': seed_file,
+    })
+
+
+async def upload_seed_file(simulation, client):
+    client.sock.setblocking(False)
+    if not await simulation.do_upload(client):
+        sys.stderr.write('Could not upload a file\n')
+        sys.exit(1)
+    return simulation.uploaded[0]
+
+
+async def run_users(simulation, clients):
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + simulation.args.duration
+    await asyncio.gather(*(
+        simulation.run_user(client, deadline) for client in clients
+    ))
+
+
+def raise_fd_limit():
+    try:
+        import resource
+    except ImportError:
+        return
+
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != hard:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        except (ValueError, OSError):
+            pass
+
+
+def summarize(latencies, errors, duration):
+    latencies.sort()
+    summary = {
+        'count': len(latencies),
+        'errors': errors,
+        'throughput': len(latencies) / duration,
+    }
+    if latencies:
+        summary['mean_ms'] = 1000 * sum(latencies) / len(latencies)
+        for name, q in PERCENTILES:
+            i = min(len(latencies) - 1, int(q * len(latencies)))
+            summary[name + '_ms'] = 1000 * latencies[i]
+        summary['max_ms'] = 1000 * latencies[-1]
+    return summary
+
+
+def report(results):
+    print('{:10} {:>9} {:>7} {:>10} {:>9} {:>9} {:>9} {:>9}'.format(
+        'command', 'count', 'errors', 'per sec', 'p50 ms', 'p99 ms',
+        'p999 ms', 'max ms'))
+    rows = list(results['commands'].items()) + [('total', results['total'])]
+    for command, summary in rows:
+        if summary['count'] == 0 and summary['errors'] == 0:
+            continue
+        print('{:10} {:9d} {:7d} {:10.0f} {:9.2f} {:9.2f} {:9.2f} {:9.2f}'
+            .format(command, summary['count'], summary['errors'],
+                summary['throughput'], summary.get('p50_ms', 0),
+                summary.get('p99_ms', 0), summary.get('p999_ms', 0),
+                summary.get('max_ms', 0)))
+    if results['disconnects']:
+        print('{} users were disconnected'.format(results['disconnects']))
+
+
+def parse_mix(arg):
+    mix = {}
+    for item in arg.split(','):
+        command, _, weight = item.partition('=')
+        if command not in COMMANDS:
+            raise argparse.ArgumentTypeError(
+                'unknown command {!r}'.format(command))
+        try:
+            mix[command] = float(weight)
+        except ValueError:
+            raise argparse.ArgumentTypeError(
+                'invalid weight {!r}'.format(weight))
+    return mix
+
+
+def start_server(executable, tmpdir, port, startup):
+    """Start the server with a fresh database and files directory, as
+    ./testclient does.
+    """
+    path_to_db = os.path.join(tmpdir, 'loadgen.sqlite3')
+    path_to_files = os.path.join(tmpdir, 'files')
+    os.mkdir(path_to_files)
+    subprocess.run([sys.executable, CREATEDB, path_to_db], check=True)
+    server = subprocess.Popen(
+        [executable, '-q', '-f', path_to_files, '-d', path_to_db, '-p',
+            str(port)]
+    )
+    time.sleep(startup)
+    return server
+
+
+def run(args):
+    usernames = [
+        '{}_{}'.format(args.run_id, i) for i in range(args.users)
+    ]
+    start_event = multiprocessing.Event()
+    ready = multiprocessing.Queue()
+    results = multiprocessing.Queue()
+    processes = [
+        multiprocessing.Process(target=run_process, args=(
+            args, i, usernames, start_event, ready, results
+        ))
+        for i in range(min(args.processes, args.users))
+    ]
+    for process in processes:
+        process.start()
+    for _ in processes:
+        ready.get()
+
+    start_event.set()
+    per_process = [results.get() for _ in processes]
+    for process in processes:
+        process.join()
+
+    latencies = {command: [] for command in COMMANDS}
+    errors = dict.fromkeys(COMMANDS, 0)
+    for result in per_process:
+        for command in COMMANDS:
+            latencies[command].extend(result['latencies'][command])
+            errors[command] += result['errors'][command]
+
+    all_latencies = [t for command in COMMANDS for t in latencies[command]]
+    return {
+        'date': datetime.datetime.utcnow().isoformat() + 'Z',
+        'server': args.server,
+        'users': args.users,
+        'processes': len(processes),
+        'duration': args.duration,
+        'mix': args.mix,
+        'message_size': len(args.message),
+        'file_size': args.file_size,
+        'think_time_ms': args.think_time,
+        'commands': {
+            command: summarize(latencies[command], errors[command],
+                args.duration)
+            for command in COMMANDS if command in args.mix
+        },
+        'total': summarize(all_latencies, sum(errors.values()),
+            args.duration),
+        'disconnects': sum(result['disconnects'] for result in per_process),
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('server', nargs='?',
+        help='path to the server executable to start')
+    parser.add_argument('--no-start', action='store_true',
+        help='drive a server that is already running')
+    parser.add_argument('--port', type=int, default=testhelper.SERVER_PORT)
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--processes', type=int,
+        default=os.cpu_count() or 1,
+        help='load generator processes to spread the users over')
+    parser.add_argument('--duration', type=float, default=10.0,
+        help='seconds to run for')
+    parser.add_argument('--mix', type=parse_mix, default=DEFAULT_MIX,
+        help='relative weights of the commands, e.g. ' + DEFAULT_MIX)
+    parser.add_argument('--think-time', type=float, default=0.0,
+        help='mean milliseconds that each user waits between commands')
+    parser.add_argument('--message-size', type=int, default=64,
+        help='length of the body of each sent message')
+    parser.add_argument('--file-size', type=int, default=4096,
+        help='length of each uploaded file')
+    parser.add_argument('--seed', default='loadgen',
+        help='seed for the random choices of the users')
+    parser.add_argument('--startup', type=float, default=0.5,
+        help='seconds to wait for the server to start')
+    parser.add_argument('--output',
+        help='file to write the results to, as JSON')
+    args = parser.parse_args()
+    if args.server is None and not args.no_start:
+        parser.error('either give a server executable or use --no-start')
+    if isinstance(args.mix, str):
+        args.mix = parse_mix(args.mix)
+    args.message = 'm' * args.message_size
+    # Usernames and filenames are unique to each run, so that runs against
+    # the same server do not clash.
+    args.run_id = 'lg' + uuid.uuid4().hex[:8]
+
+    tmpdir = tempfile.mkdtemp()
+    server = None
+    try:
+        if not args.no_start:
+            server = start_server(os.path.abspath(args.server), tmpdir,
+                args.port, args.startup)
+        results = run(args)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+        shutil.rmtree(tmpdir)
+
+    report(results)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
@@ -0,0 +1,52 @@
+"""Tests of the load generator's parsing of the server's responses.
+
+    python3 bench/test_loadgen.py
+
+Author:  Ian Fisher (iafisher@protonmail.com)
+Version: September 2018
+"""
+import asyncio
+import socket
+import unittest
+
+from loadgen import Client
+
+
+class ReadFileTest(unittest.TestCase):
+    def read_files(self, data, n):
+        """Return the results of n calls of read_file on a connection that
+        receives `data`, and the line that follows them.
+        """
+        async def read():
+            results = [await client.read_file() for _ in range(n)]
+            return results, await client.read_line()
+
+        ours, theirs = socket.socketpair()
+        with ours, theirs:
+            ours.setblocking(False)
+            client = Client(ours, 'user')
+            theirs.sendall(data)
+            return asyncio.run(read())
+
+    def test_file(self):
+        self.assertEqual(
+            self.read_files(b'file a.bin 5 hello\r\nsuccess\r\n', 1),
+            ([True], b'success')
+        )
+
+    def test_name_contains_length(self):
+        body = b'x' * 4096
+        data = (
+            b'file run_0_4096.bin 4096 ' + body + b'\r\n' +
+            b'file 4.bin 4 abcd\r\n' +
+            b'success\r\n'
+        )
+        self.assertEqual(self.read_files(data, 2), ([True, True], b'success'))
+
+    def test_error(self):
+        data = b'error could not read from file\r\nsuccess\r\n'
+        self.assertEqual(self.read_files(data, 1), ([False], b'success'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -8,14 +8,32 @@ Version: September 2018
 """
 
 import argparse
+import asyncio
+import bisect
+import collections
+import concurrent.futures
+import contextlib
+import cProfile
 import datetime
 import functools
+import hashlib
+import http.server
+import inspect
+import json
 import logging
+import logging.handlers
 import os
+import pstats
+import queue
+import random
+import signal
 import socket
 import sqlite3
 import sys
+import tempfile
 import threading
+import time
+import types
 
 
 logger = logging.getLogger(__name__)
@@ -27,16 +45,132 @@ FILE_DIR = os.path.join(BASE_DIR, 'files')
 DB_FILE = os.path.join(BASE_DIR, 'db.sqlite3')
 LOG_FILE = os.path.join(BASE_DIR, 'log', 'server.log')
 SERVER_PORT = 8888
+# Sizes, in bytes, of the buffer that each connection receives data into, of
+# the space to receive into for a regular message and for an upload, which is
+# streamed to disk in chunks of that size.
+FRAMER_INITIAL_SIZE = 4096
+RECV_SIZE = 4096
+UPLOAD_CHUNK_SIZE = 65536
+# The temporary files of uploads in progress are stored in the files directory
+# with this prefix. It contains a space, so it cannot clash with the name of an
+# uploaded file.
+PARTIAL_UPLOAD_PREFIX = '.partial '
+# The permissions of uploaded files, which are those that open() would give a
+# new file under the umask that the server was started with. The umask can
+# only be read by changing it, which is safe before any threads are started.
+UMASK = os.umask(0)
+os.umask(UMASK)
+UPLOAD_MODE = 0o666 & ~UMASK
+ENGINES = ('threaded', 'asyncio')
+# See FileStore and DedupFileStore.
+FILE_STORES = ('plain', 'dedup')
+# See StorageLayer and MemLogStorage.
+STORAGE_BACKENDS = ('sqlite', 'memlog')
+# 'nagle' leaves the operating system's defaults alone, except while a large
+# file is sent, 'nodelay' disables Nagle's algorithm, and 'cork' also corks the
+# socket while a large file is sent.
+TCP_POLICIES = ('nagle', 'nodelay', 'cork')
+# sendmsg is not available on Windows. Linux accepts at most 1024 buffers per
+# call.
+HAVE_SENDMSG = hasattr(socket.socket, 'sendmsg')
+IOV_MAX = 1024
+# Log records wait in a queue of this size to be written by a background
+# thread, and are dropped if it is full. Payloads longer than LOG_MAX_PAYLOAD
+# bytes are logged as a preview of that length.
+LOG_QUEUE_SIZE = 100000
+LOG_MAX_PAYLOAD = 256
+# The most messages that a single recv returns by default, so that the
+# response to a recv of a huge inbox does not need unbounded memory. The rest
+# are left for the next recv. Rows are read from SQLite RECV_FETCH_SIZE at a
+# time.
+RECV_LIMIT = 10000
+RECV_FETCH_SIZE = 256
+# A `recv <max>` with a larger maximum is treated as this one, which is the
+# largest SQLite integer and more messages than any inbox can hold.
+MAX_RECV_MESSAGES = 2 ** 63 - 1
+# The longest that a `recv wait` may wait for a message, in seconds. When other
+# processes also write to the database, their messages are not announced to
+# this one, so waiting connections check their inbox every RECV_POLL_INTERVAL
+# seconds as well.
+MAX_RECV_WAIT = 60.0
+RECV_POLL_INTERVAL = 1.0
+# The most users that a single send can name, and the longest name of a group.
+MAX_RECIPIENTS = 256
+MAX_GROUP_NAME = 30
+# Upper bounds, in seconds, of the buckets of the latency histograms.
+LATENCY_BUCKETS = (
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+    0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+)
+# Clients can be disconnected after --idle-timeout seconds without sending
+# anything, if a message takes more than --message-timeout seconds to arrive in
+# full, or if they accept none of their responses for --send-timeout seconds.
+# The timeouts are off unless they are given, so that clients which stay
+# connected without sending anything keep working. Once more than OUTPUT_LIMIT
+# bytes of responses are waiting to be sent, the connection stops reading
+# messages until the client catches up, or with the 'close' policy for slow
+# clients, is disconnected.
+OUTPUT_LIMIT = 1048576
+SLOW_CLIENT_POLICIES = ('wait', 'close')
+# Files are sent this many bytes at a time in asyncio mode, so that the send
+# timeout applies to each part rather than to the whole download. Downloads of
+# at most SENDFILE_MIN_SIZE bytes are read into memory instead, and sent in one
+# write along with their header.
+SENDFILE_CHUNK_SIZE = 1048576
+SENDFILE_MIN_SIZE = 65536
+# Backlog of the listening socket in asyncio mode, where a single thread has
+# to keep up with bursts of thousands of new connections.
+ASYNC_BACKLOG = 4096
+# Exit status of a process that calls fatal. The supervisor does not restart
+# workers that exit with it, since they would only fail again.
+FATAL_EXIT_CODE = 2
+# The maintenance thread enforces the retention policies every
+# MAINTENANCE_INTERVAL seconds. It deletes MAINTENANCE_BATCH_SIZE rows per
+# write and frees VACUUM_PAGES pages of the file per incremental vacuum,
+# pausing MAINTENANCE_PAUSE seconds in between so that the foreground writes
+# are not starved.
+MAINTENANCE_INTERVAL = 60.0
+MAINTENANCE_BATCH_SIZE = 500
+MAINTENANCE_PAUSE = 0.01
+VACUUM_PAGES = 256
+# How often, in seconds, MemLogStorage writes a snapshot of its state, so that
+# only the changes since then have to be replayed from the log on startup.
+SNAPSHOT_INTERVAL = 300.0
+# How many seconds the profiler runs for each time that it is started.
+PROFILE_WINDOW = 10.0
+# Before Python 3.12, cProfile only sees the thread that enables it.
+PROFILE_PER_THREAD = sys.version_info < (3, 12)
 
 
 class ChatServer:
-    def __init__(self, port, path_to_db, path_to_files):
+    """The default server engine, which starts one thread per connection."""
+
+    # Backlog of the listening socket, or None for Python's default.
+    backlog = None
+
+    def __init__(self, port, storage, files, tcp_policy='nodelay',
+            reuse_port=False, limits=None):
         self.port = port
-        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.path_to_files = path_to_files
-        self.path_to_db = path_to_db
+        self.socket = None
+        # The FileStore of the uploaded files, shared by every connection.
+        self.files = files
+        # A single StorageLayer is shared by every connection.
+        self.storage = storage
+        self.tcp_policy = tcp_policy
+        # Whether other processes may listen on the same port, in which case
+        # the kernel spreads new connections between them.
+        self.reuse_port = reuse_port
+        self.limits = limits or ConnectionLimits()
+        self.listening = False
+        # A Maintenance thread to run alongside the server, if any.
+        self.maintenance = None
 
-    def run_forever(self):
+    def bind(self):
+        # The socket is not created until now, so that each worker process
+        # that binds its own gets a separate one.
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        if self.reuse_port:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         try:
             self.socket.bind((socket.gethostbyname('localhost'), self.port))
         except PermissionError:
@@ -46,18 +180,274 @@ class ChatServer:
                 self.port)
 
         logger.info('Listening on port %d', self.port)
-        self.socket.listen()
+        if self.backlog is None:
+            self.socket.listen()
+        else:
+            self.socket.listen(self.backlog)
+        self.listening = True
+
+    def run_forever(self):
+        # The socket may already have been bound by the parent of a worker
+        # process.
+        if not self.listening:
+            self.bind()
+        self.start_storage()
+        # Once there are max_connections, new connections are left in the
+        # listening socket's backlog until one of them closes.
+        if self.limits.max_connections is not None:
+            slots = threading.BoundedSemaphore(self.limits.max_connections)
+        else:
+            slots = None
         try:
             while True:
+                if slots is not None:
+                    slots.acquire()
                 conn, addr = self.socket.accept()
+                configure_socket(conn, self.tcp_policy)
                 conn_thread = ChatConnection(
-                    conn, self.path_to_db, self.path_to_files
+                    conn, self.storage, self.files, self.tcp_policy,
+                    self.limits
                 )
+                if slots is not None:
+                    conn_thread.on_close = slots.release
                 conn_thread.start()
         except KeyboardInterrupt:
             pass
         finally:
             self.socket.close()
+            self.close_storage()
+
+    def start_storage(self):
+        self.storage.start()
+        self.files.load()
+        if self.maintenance is not None:
+            self.maintenance.start()
+
+    def close_storage(self):
+        if self.maintenance is not None:
+            self.maintenance.stop()
+        self.storage.close()
+
+
+class AsyncChatServer(ChatServer):
+    """A server engine that serves every connection on a single asyncio event
+    loop.
+
+    Handlers are the same as in the threaded engine, but they run on a small
+    thread pool so that SQLite and file I/O never block the event loop.
+    """
+
+    backlog = ASYNC_BACKLOG
+
+    def __init__(self, port, storage, files, tcp_policy='nodelay',
+            reuse_port=False, limits=None, max_workers=None):
+        super().__init__(port, storage, files, tcp_policy, reuse_port,
+            limits)
+        self.max_workers = max_workers
+
+    def run_forever(self):
+        raise_fd_limit()
+        if not self.listening:
+            self.bind()
+        self.socket.setblocking(False)
+        self.start_storage()
+        executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.max_workers,
+            thread_name_prefix='storage',
+        )
+        try:
+            asyncio.run(self.accept_forever(executor))
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.socket.close()
+            executor.shutdown(wait=False)
+            self.close_storage()
+
+    async def accept_forever(self, executor):
+        loop = asyncio.get_running_loop()
+        loop.set_default_executor(executor)
+        # Keep a reference to every running task so that it is not garbage-
+        # collected in the middle of a connection.
+        tasks = set()
+        if self.limits.max_connections is not None:
+            slots = asyncio.BoundedSemaphore(self.limits.max_connections)
+        else:
+            slots = None
+        while True:
+            if slots is not None:
+                await slots.acquire()
+            conn, addr = await loop.sock_accept(self.socket)
+            conn.setblocking(False)
+            configure_socket(conn, self.tcp_policy)
+            connection = AsyncChatConnection(
+                conn, self.storage, self.files, self.tcp_policy, self.limits
+            )
+            task = loop.create_task(connection.run())
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+            if slots is not None:
+                task.add_done_callback(lambda task: slots.release())
+
+
+class Supervisor:
+    """Run a server in several worker processes, so that they are not all
+    limited by one interpreter's global lock, and restart any that crash.
+
+    Each worker is forked from the supervisor and calls `run_worker` with its
+    index, from 0 to `nworkers - 1`, which a restarted worker inherits from
+    the one that it replaces. `run_worker` should not return until the worker
+    is told to stop with SIGTERM (raised in the worker as KeyboardInterrupt).
+    """
+
+    # Workers that crash within this many seconds of starting are restarted
+    # only after the same delay, so that a worker that crashes on startup does
+    # not keep the supervisor busy forking.
+    RESTART_DELAY = 1.0
+
+    def __init__(self, nworkers, run_worker, relay=()):
+        self.nworkers = nworkers
+        self.run_worker = run_worker
+        # Signals to pass on to every worker.
+        self.relay = relay
+        # Maps each worker's process ID to its index and the time when it was
+        # started.
+        self.workers = {}
+        self.stopping = False
+        self.status = 0
+
+    def run_forever(self):
+        """Run the workers until the supervisor receives SIGINT or SIGTERM,
+        and return the exit status for the supervisor.
+        """
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGTERM, self.stop)
+        for signum in self.relay:
+            signal.signal(signum, self.relay_signal)
+        for index in range(self.nworkers):
+            self.spawn(index)
+
+        while self.workers:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+
+            worker = self.workers.pop(pid, None)
+            if worker is None or self.stopping:
+                continue
+            index, started = worker
+
+            if os.WIFSIGNALED(status):
+                logger.error('Worker %d was killed by signal %d', pid,
+                    os.WTERMSIG(status))
+            elif os.WEXITSTATUS(status) == FATAL_EXIT_CODE:
+                logger.critical('Worker %d could not start, shutting down',
+                    pid)
+                self.status = FATAL_EXIT_CODE
+                self.stop()
+                continue
+            elif os.WEXITSTATUS(status) != 0:
+                logger.error('Worker %d exited with status %d', pid,
+                    os.WEXITSTATUS(status))
+            else:
+                # The worker was stopped deliberately.
+                continue
+
+            if time.monotonic() - started < self.RESTART_DELAY:
+                time.sleep(self.RESTART_DELAY)
+            if not self.stopping:
+                self.spawn(index)
+        return self.status
+
+    def spawn(self, index):
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGINT, signal.default_int_handler)
+            signal.signal(signal.SIGTERM, signal.default_int_handler)
+            # Until run_worker installs handlers of its own.
+            for signum in self.relay:
+                signal.signal(signum, signal.SIG_IGN)
+            status = 1
+            try:
+                self.run_worker(index)
+                status = 0
+            except SystemExit as e:
+                status = e.code if isinstance(e.code, int) else 1
+            except KeyboardInterrupt:
+                status = 0
+            except BaseException:
+                logger.exception('Worker crashed')
+            finally:
+                # Never return into the supervisor's code.
+                os._exit(status)
+        else:
+            logger.info('Started worker %d', pid)
+            self.workers[pid] = (index, time.monotonic())
+
+    def stop(self, signum=None, frame=None):
+        """Tell every worker to shut down."""
+        self.stopping = True
+        self.relay_signal(signal.SIGTERM)
+
+    def relay_signal(self, signum, frame=None):
+        for pid in list(self.workers):
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+
+def raise_fd_limit():
+    """Raise the soft limit on open file descriptors to the hard limit, since
+    every connection in asyncio mode holds a socket open.
+    """
+    try:
+        import resource
+    except ImportError:
+        return
+
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != hard:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        except (ValueError, OSError):
+            logger.warning('Could not raise file descriptor limit above %d',
+                soft)
+
+
+class ConnectionLimits:
+    """Limits on what a single client can tie up, shared by every connection.
+
+    Timeouts are in seconds, and any limit may be None for no limit. See the
+    comment on OUTPUT_LIMIT for what each one means.
+    `max_connections` is the most connections that a server process will
+    serve at once, and `max_recv_wait` is the longest that a `recv wait` may
+    wait.
+    """
+
+    def __init__(self, idle_timeout=None, message_timeout=None,
+            send_timeout=None, output_limit=OUTPUT_LIMIT,
+            slow_client_policy='wait', max_connections=None,
+            max_recv_wait=MAX_RECV_WAIT):
+        self.idle_timeout = idle_timeout
+        self.message_timeout = message_timeout
+        self.send_timeout = send_timeout
+        self.output_limit = output_limit
+        self.slow_client_policy = slow_client_policy
+        self.max_connections = max_connections
+        self.max_recv_wait = max_recv_wait
+
+
+class ClientTooSlow(Exception):
+    """Raised to drop a connection whose client has exceeded one of the
+    ConnectionLimits. The argument is a short reason, for the logs and the
+    metrics.
+    """
+
+    @property
+    def reason(self):
+        return self.args[0]
 
 
 # A Python version of Rust's Result type--more efficient than raising an
@@ -67,18 +457,25 @@ Error = lambda e: (None, e)
 
 
 def message_handler(nfields, ws_in_last_field=False, auth=True, binary=False):
-    """A decorator for handler methods in the ChatConnection class.
+    """A decorator for handler methods in the ChatSession class.
 
     The decorator splits the message bytes into fields and sends an error if
     the message is ill-formatted.
 
     Parameters:
         nfields: How many space-separated fields does the message contain,
-            excluding the command name itself?
-        ws_in_last_field: Does the last field allow whitespace?
+            excluding the command name itself? May also be a collection of
+            the allowed numbers, if the handler has optional parameters.
+        ws_in_last_field: Does the last field allow whitespace? Requires a
+            single number of fields.
         auth: Must the user be logged in?
         binary: Can the message contain arbitrary bytes?
     """
+    if isinstance(nfields, int):
+        allowed_nfields = (nfields,)
+    else:
+        allowed_nfields = tuple(nfields)
+        assert not ws_in_last_field
 
     def wraps(f):
         @functools.wraps(f)
@@ -105,7 +502,7 @@ def message_handler(nfields, ws_in_last_field=False, auth=True, binary=False):
 
             # Remove the command name.
             args.pop(0)
-            if len(args) != nfields:
+            if len(args) not in allowed_nfields:
                 return Error('wrong number of fields')
             else:
                 return f(self, *args)
@@ -113,120 +510,132 @@ def message_handler(nfields, ws_in_last_field=False, auth=True, binary=False):
     return wraps
 
 
-class ChatConnection(threading.Thread):
-    def __init__(self, conn, path_to_db, path_to_files):
-        super().__init__()
-        self.socket = conn
+class ChatSession:
+    """The state of a single client session and the handlers for each command
+    of the chat protocol.
+
+    Subclasses are responsible for moving bytes on and off the wire; see
+    ChatConnection and AsyncChatConnection.
+    """
+
+    def __init__(self, storage, files):
         # self.uid is None as long as no user is logged in on the connection.
         self.uid = None
-        self.path_to_db = path_to_db
-        self.path_to_files = path_to_files
-
-        # Contains data from the last recv call that hasn't yet been processed.
-        # The beginning of self.buffer always aligns with the beginning of a
-        # message from the wire.
-        self.buffer = b''
+        self.storage = storage
+        self.files = files
+        # The PartialUpload of the upload message being handled, if any.
+        self.upload = None
 
-    def run(self):
-        self.storage = StorageLayer(self.path_to_db)
+    def recv_timeout(self):
+        """Return how long to wait for more data from the client according
+        to self.limits, and the reason to give for dropping the connection if
+        none arrives in time. Subclasses must have a framer, and set
+        self.message_deadline to None to restart the message timeout.
+        """
+        if not self.framer.in_message:
+            self.message_deadline = None
+            return self.limits.idle_timeout, 'idle'
 
-        logger.info('Connection opened')
-        try:
-            while True:
-                message, error = self.receive_message()
-                if error is not None:
-                    self.send_and_log(
-                        b'error ' + str(error).encode('utf-8') + b'\r\n'
-                    )
-                    continue
+        if self.limits.message_timeout is None:
+            return None, 'message'
+        now = time.monotonic()
+        if self.message_deadline is None:
+            self.message_deadline = now + self.limits.message_timeout
+        elif now >= self.message_deadline:
+            raise ClientTooSlow('message')
+        return self.message_deadline - now, 'message'
 
-                logger.info('Received message %r', message)
+    def handle_frames(self, frames):
+        """Handle a batch of messages, as returned by MessageFramer.messages,
+        and return a list of the responses. The list stops short after a
+        WaitingRecv.
+        """
+        responses = []
+        for message, error in frames:
+            response = self.handle_frame(message, error)
+            responses.append(response)
+            if isinstance(response, WaitingRecv):
+                # The messages after a `recv wait` must not be handled until it
+                # has been answered, so the caller has to hand them in again.
+                break
+        return responses
 
-                first_space = message.find(b' ')
-                if first_space == -1:
-                    # Commands without fields are not followed by a space.
-                    first_space = len(message)
+    def handle_frame(self, message, error):
+        """Handle a message, or a framing error in place of one, and return the
+        response.
+        """
+        if error is not None:
+            logger.info('Could not read message: %s', error)
+            metrics.observe_error(b'unknown', error)
+            return b'error ' + error.encode('utf-8') + b'\r\n'
+        elif profiler.active:
+            return profiler.run(self.handle_message, message)
+        else:
+            return self.handle_message(message)
 
-                cmd = message[:first_space]
-                try:
-                    handler = self.dispatch[cmd]
-                except KeyError:
-                    self.send_and_log(b'error no such command\r\n')
-                else:
-                    response, error = handler(self, message)
-                    if error is not None:
-                        self.send_and_log(
-                            b'error ' + error.encode('utf-8') + b'\r\n'
-                        )
-                    else:
-                        if isinstance(response, str):
-                            response = response.encode('utf-8') + b'\r\n'
-                        self.send_and_log(response)
-        except (ConnectionResetError, BrokenPipeError):
-            pass
+    def handle_message(self, message):
+        """Dispatch a message to its handler and return the bytes of the
+        response.
+        """
+        start = time.perf_counter()
+        try:
+            response = self.dispatch_message(message)
         finally:
-            logger.info('Connection closed')
-            self.socket.close()
-            self.storage.close()
+            if self.upload is not None:
+                self.upload.discard()
+                self.upload = None
 
-    def receive_message(self):
-        """Return a message from the wire and leave any extra data in
-        self.buffer. Return value is a Result type, i.e.
+        command = message.partition(b' ')[0]
+        if command not in self.dispatch:
+            # Keep arbitrary client input out of the metrics.
+            command = b'unknown'
+        metrics.observe_request(command, time.perf_counter() - start, response)
 
-            message, error = self.receive_message()
-            if error is not None:
-                # Error handling
-        """
-        data = self.socket.recv(1024) if not self.buffer else self.buffer
-        if not data:
-            raise ConnectionResetError
+        # The message and its response are logged together so that
+        # MessageLogFilter samples both or neither.
+        if logger.isEnabledFor(logging.INFO):
+            logger.info('Received message %r, sending %r', message, response,
+                extra={'command': command})
+        return response
 
-        # Find the message terminator.
-        end = data.find(b'\r\n')
-        while end == -1:
-            old_end = len(data)
-            data += self.socket.recv(1024)
-            if len(data) == old_end:
-                raise ConnectionResetError
-            end = data.find(b'\r\n', old_end)
-
-        # Special parsing has to be done for the upload message, because the
-        # first CRLF sequence in the data stream could be part of the file
-        # itself and not the end of the message. To find the end, we have to
-        # read the `filelength` field.
-        if data.startswith(b'upload '):
-            second_space = data.find(b' ', 7)  # 7 == len(b'upload '')
-            third_space = data.find(b' ', second_space+1)
-            if second_space != -1 and third_space != -1:
-                try:
-                    length = int(data[second_space+1:third_space])
-                except ValueError:
-                    self.buffer = data[end+2:]
-                    return Error('invalid length field of upload message')
-                else:
-                    # Now that the length field has been extracted, receiving
-                    # the rest of the data is simple.
-                    datapos = third_space + 1
-                    length_so_far = len(data) - datapos
-                    data += recv_large(self.socket, length - length_so_far)
-                    if datapos + length < end:
-                        self.buffer = data[end+2:]
-                        return Error('message not terminated with CRLF')
-                    end = datapos + length
-
-        self.buffer = data[end+2:]
-        return Result(data[:end])
+    def dispatch_message(self, message):
+        first_space = message.find(b' ')
+        if first_space == -1:
+            # Commands without fields are not followed by a space.
+            first_space = len(message)
+
+        cmd = message[:first_space]
+        try:
+            handler = self.dispatch[cmd]
+        except KeyError:
+            return b'error no such command\r\n'
+        else:
+            response, error = handler(self, message)
+            if error is not None:
+                return b'error ' + error.encode('utf-8') + b'\r\n'
+            else:
+                if isinstance(response, str):
+                    response = response.encode('utf-8') + b'\r\n'
+                return response
 
     @message_handler(nfields=2, auth=False, ws_in_last_field=True)
     def process_register(self, username, password):
         if len(username) > 30:
             return Error('username longer than 30 chars')
+        if ',' in username or username.startswith('#'):
+            # They would be read as a list of recipients or a group by send.
+            return Error('username contains a comma or begins with #')
         if len(password) > 50:
             return Error('password longer than 50 chars')
 
-        user_id = self.storage.get_id_from_username(username)
-        if user_id is None:
-            self.uid = self.storage.create_user(username, password)
+        if self.storage.get_id_from_username(username) is not None:
+            return Error('username is already registered')
+
+        # create_user checks again, in case another connection registered the
+        # same username in the meantime.
+        user_id = self.storage.create_user(username, password)
+        if user_id is not None:
+            self.uid = user_id
             return Result('success')
         else:
             return Error('username is already registered')
@@ -254,6 +663,10 @@ class ChatConnection(threading.Thread):
         if recipient == '*':
             self.broadcast_message(message)
             return Result('success')
+        elif recipient.startswith('#'):
+            return self.send_to_group(recipient[1:], message)
+        elif ',' in recipient:
+            return self.send_to_many(recipient.split(','), message)
         else:
             recipient_id = self.storage.get_id_from_username(recipient)
             if recipient_id is not None:
@@ -265,59 +678,197 @@ class ChatConnection(threading.Thread):
                 return Error('recipient does not exist')
 
     def broadcast_message(self, message):
-        # TODO: Can probably make this more efficient.
-        for recipient_id in self.storage.get_all_user_ids():
-            self.storage.create_message(self.uid, '*', recipient_id, message)
+        self.storage.create_broadcast(self.uid, message)
 
-    @message_handler(nfields=0)
-    def process_recv(self):
-        messages = self.storage.get_messages_from_recipient_id(self.uid)
-        self.storage.delete_messages_from_recipient_id(self.uid)
+    def send_to_many(self, recipients, message):
+        # Nothing is sent unless every recipient exists.
+        recipients = list(dict.fromkeys(recipients))
+        if len(recipients) > MAX_RECIPIENTS:
+            return Error('too many recipients')
+        recipient_ids = []
+        for recipient in recipients:
+            recipient_id = self.storage.get_id_from_username(recipient)
+            if recipient_id is None:
+                return Error('recipient does not exist')
+            recipient_ids.append(recipient_id)
+        self.storage.create_shared_message(
+            self.uid, ','.join(recipients), recipient_ids, message
+        )
+        return Result('success')
 
+    def send_to_group(self, name, message):
+        group_id = self.storage.get_group_id(name)
+        if group_id is None:
+            return Error('group does not exist')
+        members = self.storage.get_group_members(group_id)
+        if self.uid not in members:
+            return Error('not a member of the group')
+        self.storage.create_shared_message(
+            self.uid, '#' + name, members, message
+        )
+        return Result('success')
+
+    @message_handler(nfields=2)
+    def process_group(self, action, name):
+        if not valid_group_name(name):
+            return Error('invalid group name')
+
+        if action == 'create':
+            if self.storage.create_group(name, self.uid) is None:
+                return Error('group already exists')
+            return Result('success')
+        elif action not in ('join', 'leave'):
+            return Error('no such group action')
+
+        group_id = self.storage.get_group_id(name)
+        if group_id is None:
+            return Error('group does not exist')
+        if action == 'join':
+            self.storage.add_group_member(group_id, self.uid)
+        elif not self.storage.remove_group_member(group_id, self.uid):
+            return Error('not a member of the group')
+        return Result('success')
+
+    @message_handler(nfields=(0, 1, 2))
+    def process_recv(self, max_messages=None, timeout=None):
+        if timeout is not None:
+            # recv wait <timeout>
+            if max_messages != 'wait':
+                return Error('wrong number of fields')
+            max_messages = None
+            try:
+                timeout = float(timeout)
+            except ValueError:
+                return Error('invalid timeout')
+            if not 0 <= timeout < float('inf'):
+                return Error('invalid timeout')
+        elif max_messages is not None:
+            # Anything but a number is treated as an extra field, as it was
+            # before recv took an argument.
+            if not max_messages.isdigit() or not max_messages.isascii():
+                return Error('wrong number of fields')
+            max_messages = min(int(max_messages), MAX_RECV_MESSAGES)
+            if max_messages == 0:
+                return Error('invalid maximum number of messages')
+
+        messages = self.storage.take_messages(self.uid, max_messages)
         if messages:
-            return Result('\r\n'.join('message ' + ' '.join(m)
-                for m in messages))
+            return Result(format_messages(messages))
+        elif timeout:
+            # The connection waits for a message to arrive and then asks
+            # again (see retry_recv).
+            timeout = min(timeout, self.limits.max_recv_wait)
+            return Result(WaitingRecv(
+                self.uid, max_messages, time.monotonic() + timeout
+            ))
         else:
             return Error('inbox is empty')
 
-    @message_handler(nfields=3, ws_in_last_field=True, binary=True)
-    def process_upload(self, filename, filelength, filebytes):
+    def retry_recv(self, waiting):
+        """Return the bytes of the response to a WaitingRecv once a message
+        has arrived or it has run out of time, or else None.
+        """
+        messages = self.storage.take_messages(waiting.uid, waiting.limit)
+        if messages:
+            response = format_messages(messages).encode('utf-8') + b'\r\n'
+        elif time.monotonic() >= waiting.deadline:
+            response = b'error inbox is empty\r\n'
+        else:
+            return None
+        if logger.isEnabledFor(logging.INFO):
+            logger.info('Sending %r after waiting', response,
+                extra={'command': b'recv'})
+        return response
+
+    # The file itself has already been written to disk by the time that the
+    # handler is called (see ChatConnection.receive_upload), so only the header
+    # is left in the message.
+    @message_handler(nfields=2, binary=True)
+    def process_upload(self, filename, filelength):
+        if self.upload is None:
+            # The message ended before the file began.
+            return Error('wrong number of fields')
+
         try:
             filename = filename.decode('utf-8')
         except UnicodeDecodeError:
             return Error('invalid UTF-8')
 
-        fullname = os.path.join(self.path_to_files, filename)
-        if not os.path.isfile(fullname):
-            try:
-                with open(fullname, 'wb') as f:
-                    f.write(filebytes)
-            except IOError:
-                return Error('could not write to file')
-            else:
-                return Result('success')
-        else:
+        if self.upload.failed:
+            return Error('could not write to file')
+
+        try:
+            self.files.store(self.upload, filename)
+        except FileExistsError:
             return Error('file already exists')
+        except OSError:
+            return Error('could not write to file')
+        else:
+            return Result('success')
 
-    @message_handler(nfields=0)
-    def process_listfiles(self):
-        filelist = os.listdir(self.path_to_files)
+    @message_handler(nfields=(0, 2, 3))
+    def process_listfiles(self, offset=None, limit=None, prefix=''):
+        if offset is None:
+            return Result(self.files.listing())
+
+        try:
+            offset = int(offset)
+            limit = int(limit)
+        except ValueError:
+            return Error('invalid offset or limit')
+        if offset < 0 or limit < 0:
+            return Error('invalid offset or limit')
+
+        filelist = self.files.names(offset, limit, prefix)
         if filelist:
-            return Result('filelist ' + ' '.join(sorted(filelist)))
+            return Result('filelist ' + ' '.join(filelist))
         else:
             return Result('filelist')
 
-    @message_handler(nfields=1)
-    def process_download(self, filename):
-        fullname = os.path.join(self.path_to_files, filename)
+    @message_handler(nfields=(1, 3))
+    def process_download(self, filename, offset=None, length=None):
+        if offset is not None:
+            try:
+                offset = int(offset)
+                length = int(length)
+            except ValueError:
+                return Error('invalid offset or length')
+            if offset < 0 or length < 0:
+                return Error('invalid offset or length')
+
         try:
-            with open(fullname, 'rb') as f:
-                data = f.read()
-            return Result(b'file %b %d %b\r\n' % (filename.encode('utf-8'),
-                len(data), data))
-        except (IOError, FileNotFoundError):
+            f, size = self.files.open(filename)
+        except OSError:
             return Error('could not read from file')
 
+        if offset is None:
+            offset = 0
+            length = size
+        elif offset > size:
+            f.close()
+            return Error('invalid offset or length')
+        else:
+            # A range that runs past the end of the file is cut short, so the
+            # client can tell that it has reached the end.
+            length = min(length, size - offset)
+
+        if length <= SENDFILE_MIN_SIZE:
+            # Written separately from its header, a small file would wait for
+            # the client to acknowledge the header, which it may delay by tens
+            # of milliseconds when Nagle's algorithm is on.
+            try:
+                with f:
+                    f.seek(offset)
+                    data = f.read(length)
+            except OSError:
+                return Error('could not read from file')
+            return Result(b'file %b %d %b\r\n' % (
+                filename.encode('utf-8'), len(data), data
+            ))
+        # The file is sent by the connection, which is also responsible for
+        # closing it.
+        return Result(FileResponse(filename, f, offset, length))
+
     # This dictionary is used to find the proper handler for a message based on
     # its first word.
     dispatch = {
@@ -325,142 +876,4008 @@ class ChatConnection(threading.Thread):
         b'login': process_login,
         b'logout': process_logout,
         b'send': process_send,
+        b'group': process_group,
         b'recv': process_recv,
         b'upload': process_upload,
         b'listfiles': process_listfiles,
         b'download': process_download,
     }
 
-    def send_and_log(self, msg):
-        logger.info('Sending message %r', msg)
-        self.socket.send(msg)
 
+def valid_group_name(name):
+    return (
+        0 < len(name) <= MAX_GROUP_NAME and name.isascii() and
+        name.replace('_', 'a').isalnum()
+    )
 
-def recv_large(sock, n):
-    """Receive n bytes, where n is potentially a very large number."""
-    data = b''
-    while len(data) < n:
-        data += sock.recv(max(4096, n - len(data)))
-    return data
 
+def format_messages(messages):
+    """Return the response to a recv of a list of messages, as returned by
+    StorageLayer.take_messages.
+    """
+    return '\r\n'.join('message ' + ' '.join(m) for m in messages)
 
-def fatal(msg, *args, retcode=2):
-    """Log a critical error and bail."""
-    logger.critical(msg, *args)
-    sys.exit(retcode)
 
+class WaitingRecv:
+    """The response to a `recv wait` that found the inbox empty. The connection
+    waits until the InboxNotifier announces a message for the user or the
+    deadline (on the time.monotonic clock) passes, and then sends the response
+    of ChatSession.retry_recv instead.
+    """
 
-class StorageLayer:
-    """An abstraction over the SQLite3 database."""
+    def __init__(self, uid, limit, deadline):
+        self.uid = uid
+        self.limit = limit
+        self.deadline = deadline
 
-    def __init__(self, path_to_db):
-        self.db = sqlite3.connect(path_to_db)
-        self.cursor = self.db.cursor()
+    def next_timeout(self, poll_interval=None):
+        """Return how long to wait before checking the inbox again."""
+        timeout = max(self.deadline - time.monotonic(), 0)
+        if poll_interval is not None:
+            timeout = min(timeout, poll_interval)
+        return timeout
 
-    def get_id_from_username(self, username):
-        self.cursor.execute(
-            'SELECT user_id FROM users WHERE username=?;', (username,)
+    def __repr__(self):
+        return '<waiting {:.1f} seconds for messages>'.format(
+            self.deadline - time.monotonic()
         )
-        row = self.cursor.fetchone()
-        return row[0] if row else None
 
-    def get_id_from_username_and_password(self, username, password):
-        self.cursor.execute(
-            'SELECT user_id FROM users WHERE username=? AND password=?;',
-            (username, password)
-        )
-        row = self.cursor.fetchone()
-        return row[0] if row else None
 
-    def get_all_user_ids(self):
-        self.cursor.execute('SELECT user_id FROM users;')
-        return [row[0] for row in self.cursor.fetchall()]
+class ChatConnection(ChatSession, threading.Thread):
+    def __init__(self, conn, storage, files, tcp_policy='nodelay',
+            limits=None):
+        ChatSession.__init__(self, storage, files)
+        threading.Thread.__init__(self)
+        self.socket = conn
+        self.framer = MessageFramer()
+        self.output = OutputBuffer()
+        self.cork = tcp_policy == 'cork'
+        self.nagle = tcp_policy == 'nagle'
+        self.limits = limits or ConnectionLimits()
+        self.message_deadline = None
+        # Called with no arguments once the connection is closed, if set.
+        self.on_close = None
 
-    def get_messages_from_recipient_id(self, recipient_id):
-        self.cursor.execute(
-            '''
-            SELECT messages.timestamp, users.username, messages.destination,
-                messages.body FROM messages
-                INNER JOIN users ON users.user_id=messages.source_id
-                    AND messages.inbox_id=?
-                ORDER BY messages.message_id;
-            ''',
-            (recipient_id,)
-        )
-        return self.cursor.fetchall()
+    def run(self):
+        logger.info('Connection opened')
+        metrics.connection_opened()
+        try:
+            while True:
+                for message, error in self.receive_messages():
+                    self.send(self.handle_frame(message, error))
 
-    def create_message(self, sender_id, recipient, recipient_id, message):
-        timestamp = datetime.datetime.utcnow().isoformat() + 'Z'
-        self.cursor.execute(
-            '''
-            INSERT INTO messages (timestamp, source_id, destination, inbox_id,
-                body)
-            VALUES (?, ?, ?, ?, ?);
-            ''',
-            (timestamp, sender_id, recipient, recipient_id, message)
-        )
-        self.db.commit()
-        return self.cursor.lastrowid
+                if self.framer.in_upload:
+                    frame = self.receive_upload()
+                    self.send(self.handle_frame(*frame))
+        except (ConnectionResetError, BrokenPipeError):
+            pass
+        except ClientTooSlow as e:
+            logger.info('Dropping connection (%s)', e.reason)
+            metrics.connection_dropped(e.reason)
+        finally:
+            logger.info('Connection closed')
+            metrics.connection_closed()
+            self.socket.close()
+            if self.on_close is not None:
+                self.on_close()
 
-    def create_user(self, username, password):
-        # NOTE: Storing plaintext passwords is a terrible idea, but this
-        # project is not designed to be cryptographically secure.
-        self.cursor.execute(
-            'INSERT INTO users (username, password) VALUES (?, ?);',
-            (username, password)
-        )
-        self.db.commit()
-        return self.cursor.lastrowid
+    def receive_messages(self):
+        """Return the messages that have been received from the wire, waiting
+        for more data if there are none. Each item in the returned list is a
+        Result type, i.e.
 
-    def delete_messages_from_recipient_id(self, recipient_id):
-        self.cursor.execute(
-            'DELETE FROM messages WHERE inbox_id=?;', (recipient_id,)
-        )
-        self.db.commit()
+            for message, error in self.receive_messages():
+                if error is not None:
+                    # Error handling
 
-    def close(self):
-        self.db.close()
+        If the framer is left in the upload state, the next message is an
+        upload, which must be received with receive_upload.
+        """
+        frames = self.framer.messages()
+        while not frames and not self.framer.in_upload:
+            self.fill()
+            frames = self.framer.messages()
+        # The message timeout starts over for the next message.
+        self.message_deadline = None
+        return frames
 
+    def receive_upload(self):
+        """Stream the file of an upload message to disk, straight from the
+        framer's buffer. The file is left in self.upload, and the rest of the
+        message is returned as a Result type.
+        """
+        header = self.framer.upload_header
+        upload = self.files.new_upload()
+        try:
+            while self.framer.payload_remaining > 0:
+                chunk = self.framer.read_payload()
+                if chunk is None:
+                    self.fill(UPLOAD_CHUNK_SIZE)
+                    # A large file may well take longer than the message
+                    # timeout, so only the gaps in it are limited.
+                    self.message_deadline = None
+                else:
+                    upload.write(chunk)
+                    chunk.release()
 
-if __name__ == '__main__':
-    # Parse command-line arguments.
-    parser = argparse.ArgumentParser()
-    parser.add_argument('-d', '--database', default=DB_FILE,
-        help='path to a SQLite3 database to use')
-    parser.add_argument('-f', '--files', default=FILE_DIR,
-        help='path to a directory to hold files uploaded to the server')
-    parser.add_argument('-p', '--port', default=SERVER_PORT, type=int,
-        help='port for the server to listen on')
-    parser.add_argument('-q', '--quiet', action='store_true', default=False,
-        help='turn off logging')
-    args = parser.parse_args()
+            terminated = self.framer.end_upload()
+            while terminated is None:
+                self.fill()
+                terminated = self.framer.end_upload()
+        except BaseException:
+            upload.discard()
+            raise
 
-    # Configure logging.
-    stream_handler = logging.StreamHandler()
-    stream_handler.setLevel(logging.DEBUG)
-    file_handler = logging.FileHandler(LOG_FILE)
-    file_handler.setLevel(logging.INFO)
-    formatter = logging.Formatter(
-        '[%(levelname)s] (%(threadName)s) %(asctime)s: %(message)s'
-    )
-    stream_handler.setFormatter(formatter)
-    file_handler.setFormatter(formatter)
-    logger.addHandler(stream_handler)
-    logger.addHandler(file_handler)
+        if terminated:
+            upload.finish()
+            self.upload = upload
+            return Result(header)
+        else:
+            upload.discard()
+            return Error('message not terminated with CRLF')
 
-    if args.quiet:
-        logger.setLevel(logging.CRITICAL)
-    else:
-        logger.setLevel(logging.DEBUG)
+    def fill(self, size=RECV_SIZE):
+        """Receive more data from the wire into the framer.
 
-    try:
-        os.mkdir(args.files)
-    except FileExistsError:
-        pass
-    except OSError:
-        fatal(
-            'File folder %s does not exist and could not be created', args.files
-        )
+        Any responses that are waiting to be sent are flushed first, so that
+        all of the responses to a batch of pipelined messages go out together.
+        """
+        if self.output:
+            self.flush()
 
-    server = ChatServer(args.port, args.database, args.files)
-    server.run_forever()
+        timeout, reason = self.recv_timeout()
+        self.socket.settimeout(timeout)
+        view = self.framer.get_buffer(size)
+        try:
+            n = self.socket.recv_into(view)
+        except socket.timeout:
+            raise ClientTooSlow(reason)
+        finally:
+            view.release()
+        if n == 0:
+            raise ConnectionResetError
+        metrics.add_bytes_received(n)
+        self.framer.commit(n)
+
+    def flush(self):
+        """Send every queued response, waiting for the client to accept them
+        for no more than the send timeout at a time.
+        """
+        self.socket.settimeout(self.limits.send_timeout)
+        try:
+            self.output.flush(self.socket)
+        except socket.timeout:
+            raise ClientTooSlow('send')
+
+    def wait_for_messages(self, waiting):
+        """Wait for the messages of a WaitingRecv and return the response."""
+        # The client may be waiting for the responses to the messages before
+        # the recv, too.
+        if self.output:
+            self.flush()
+
+        notifier = self.storage.notifier
+        woken = threading.Event()
+        notifier.subscribe(waiting.uid, woken.set)
+        try:
+            while True:
+                # Cleared before looking, so that no message can slip in
+                # between looking and waiting unannounced.
+                woken.clear()
+                response = self.retry_recv(waiting)
+                if response is not None:
+                    return response
+                woken.wait(waiting.next_timeout(notifier.poll_interval))
+        finally:
+            notifier.unsubscribe(waiting.uid, woken.set)
+
+    def apply_backpressure(self):
+        """Deal with a client whose responses have piled up beyond the
+        output limit, by either sending them before reading any more messages
+        or disconnecting the client if they cannot all be sent right away.
+        """
+        if self.limits.slow_client_policy == 'close':
+            self.socket.settimeout(0)
+            if not self.output.flush_nowait(self.socket):
+                raise ClientTooSlow('output')
+        else:
+            self.flush()
+
+    def send(self, msg):
+        """Queue a response to be sent the next time that the connection waits
+        for data from the client.
+        """
+        if isinstance(msg, WaitingRecv):
+            msg = self.wait_for_messages(msg)
+
+        if isinstance(msg, FileResponse):
+            # With Nagle's algorithm, the end of the file would wait for the
+            # client to acknowledge the rest of it.
+            if self.cork:
+                set_cork(self.socket, True)
+            elif self.nagle:
+                set_nodelay(self.socket, True)
+            try:
+                self.output.append(msg.header())
+                self.flush()
+                # socket.sendfile falls back to reading the file in chunks if
+                # the platform doesn't support sendfile. It takes a count of
+                # zero to mean the rest of the file.
+                try:
+                    if msg.length > 0:
+                        sent = self.socket.sendfile(
+                            msg.file, msg.offset, msg.length
+                        )
+                    else:
+                        sent = 0
+                except socket.timeout:
+                    raise ClientTooSlow('send')
+                metrics.add_bytes_sent(sent)
+                if sent != msg.length:
+                    # The file was truncated, so the client can no longer tell
+                    # where the response ends.
+                    raise ConnectionResetError
+                self.output.append(b'\r\n')
+                if self.cork or self.nagle:
+                    self.flush()
+            finally:
+                msg.close()
+                if self.cork:
+                    set_cork(self.socket, False)
+                elif self.nagle:
+                    set_nodelay(self.socket, False)
+        else:
+            self.output.append(msg)
+            limit = self.limits.output_limit
+            if limit is not None and self.output.size > limit:
+                self.apply_backpressure()
+
+
+class AsyncChatConnection(ChatSession):
+    """A connection served by the event loop of an AsyncChatServer.
+
+    The socket must be in non-blocking mode. Messages are handled on the
+    loop's default executor.
+    """
+
+    def __init__(self, conn, storage, files, tcp_policy='nodelay',
+            limits=None):
+        super().__init__(storage, files)
+        self.socket = conn
+        self.framer = MessageFramer()
+        self.output = OutputBuffer()
+        self.cork = tcp_policy == 'cork'
+        self.nagle = tcp_policy == 'nagle'
+        self.limits = limits or ConnectionLimits()
+        self.message_deadline = None
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+
+        logger.info('Connection opened')
+        metrics.connection_opened()
+        try:
+            while True:
+                # The whole batch is handled in one trip to the executor, or
+                # one trip per `recv wait` in the batch.
+                frames = await self.receive_messages()
+                while frames:
+                    responses = await loop.run_in_executor(
+                        None, self.handle_frames, frames
+                    )
+                    for response in responses:
+                        await self.send(response)
+                    frames = frames[len(responses):]
+
+                if self.framer.in_upload:
+                    frame = await self.receive_upload()
+                    response = await loop.run_in_executor(
+                        None, self.handle_frame, *frame
+                    )
+                    await self.send(response)
+        except (ConnectionResetError, BrokenPipeError):
+            pass
+        except ClientTooSlow as e:
+            logger.info('Dropping connection (%s)', e.reason)
+            metrics.connection_dropped(e.reason)
+        finally:
+            logger.info('Connection closed')
+            metrics.connection_closed()
+            self.socket.close()
+
+    async def receive_messages(self):
+        """The asynchronous counterpart of ChatConnection.receive_messages."""
+        frames = self.framer.messages()
+        while not frames and not self.framer.in_upload:
+            await self.fill()
+            frames = self.framer.messages()
+        self.message_deadline = None
+        return frames
+
+    async def receive_upload(self):
+        """The asynchronous counterpart of ChatConnection.receive_upload. Disk
+        I/O runs on the executor.
+        """
+        header = self.framer.upload_header
+        loop = asyncio.get_running_loop()
+        upload = await loop.run_in_executor(None, self.files.new_upload)
+        try:
+            while self.framer.payload_remaining > 0:
+                chunk = self.framer.read_payload()
+                if chunk is None:
+                    await self.fill(UPLOAD_CHUNK_SIZE)
+                    self.message_deadline = None
+                else:
+                    await loop.run_in_executor(None, upload.write, chunk)
+                    chunk.release()
+
+            terminated = self.framer.end_upload()
+            while terminated is None:
+                await self.fill()
+                terminated = self.framer.end_upload()
+        except BaseException:
+            await loop.run_in_executor(None, upload.discard)
+            raise
+
+        if terminated:
+            await loop.run_in_executor(None, upload.finish)
+            self.upload = upload
+            return Result(header)
+        else:
+            await loop.run_in_executor(None, upload.discard)
+            return Error('message not terminated with CRLF')
+
+    async def fill(self, size=RECV_SIZE):
+        if self.output:
+            await self.flush()
+
+        timeout, reason = self.recv_timeout()
+        view = self.framer.get_buffer(size)
+        recv = asyncio.get_running_loop().sock_recv_into(self.socket, view)
+        try:
+            if timeout is None:
+                n = await recv
+            else:
+                n = await asyncio.wait_for(recv, timeout)
+        except asyncio.TimeoutError:
+            raise ClientTooSlow(reason)
+        finally:
+            view.release()
+        if n == 0:
+            raise ConnectionResetError
+        metrics.add_bytes_received(n)
+        self.framer.commit(n)
+
+    async def flush(self):
+        try:
+            await self.output.flush_async(
+                self.socket, self.limits.send_timeout
+            )
+        except asyncio.TimeoutError:
+            raise ClientTooSlow('send')
+
+    async def send(self, msg):
+        if isinstance(msg, WaitingRecv):
+            msg = await self.wait_for_messages(msg)
+
+        if isinstance(msg, FileResponse):
+            # See ChatConnection.send.
+            if self.cork:
+                set_cork(self.socket, True)
+            elif self.nagle:
+                set_nodelay(self.socket, True)
+            try:
+                self.output.append(msg.header())
+                await self.flush()
+                sent = await self.sendfile(msg)
+                metrics.add_bytes_sent(sent)
+                if sent != msg.length:
+                    raise ConnectionResetError
+                self.output.append(b'\r\n')
+                if self.cork or self.nagle:
+                    await self.flush()
+            finally:
+                msg.close()
+                if self.cork:
+                    set_cork(self.socket, False)
+                elif self.nagle:
+                    set_nodelay(self.socket, False)
+        else:
+            self.output.append(msg)
+            limit = self.limits.output_limit
+            if limit is not None and self.output.size > limit:
+                # See ChatConnection.apply_backpressure.
+                if self.limits.slow_client_policy == 'close':
+                    if not self.output.flush_nowait(self.socket):
+                        raise ClientTooSlow('output')
+                else:
+                    await self.flush()
+
+    async def wait_for_messages(self, waiting):
+        """The asynchronous counterpart of ChatConnection.wait_for_messages.
+        The connection waits on the event loop, not on the executor.
+        """
+        if self.output:
+            await self.flush()
+
+        loop = asyncio.get_running_loop()
+        notifier = self.storage.notifier
+        woken = asyncio.Event()
+
+        def wake():
+            # Called from whichever thread stored the message.
+            loop.call_soon_threadsafe(woken.set)
+
+        notifier.subscribe(waiting.uid, wake)
+        try:
+            while True:
+                woken.clear()
+                response = await loop.run_in_executor(
+                    None, self.retry_recv, waiting
+                )
+                if response is not None:
+                    return response
+                try:
+                    await asyncio.wait_for(
+                        woken.wait(),
+                        waiting.next_timeout(notifier.poll_interval)
+                    )
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            notifier.unsubscribe(waiting.uid, wake)
+
+    async def sendfile(self, msg):
+        """Send the file of a FileResponse, a part at a time so that each part
+        is subject to the send timeout, and return the number of bytes sent.
+        """
+        loop = asyncio.get_running_loop()
+        total = 0
+        while total < msg.length:
+            count = min(SENDFILE_CHUNK_SIZE, msg.length - total)
+            part = loop.sock_sendfile(
+                self.socket, msg.file, msg.offset + total, count
+            )
+            try:
+                sent = await asyncio.wait_for(part, self.limits.send_timeout)
+            except asyncio.TimeoutError:
+                raise ClientTooSlow('send')
+            total += sent
+            if sent != count:
+                break
+        return total
+
+
+class MessageFramer:
+    """Split the stream of bytes from a client into messages.
+
+    Data is received straight into a bytearray (see get_buffer), and the framer
+    remembers how far it has already searched for a CRLF, so each byte is only
+    scanned once no matter how many recv calls a message is spread over.
+    Pipelined messages are parsed out of the same buffer without moving the
+    bytes that follow them.
+
+    The file in an upload message is not part of the messages returned by
+    messages. Instead, the caller reads it out of the buffer with read_payload
+    and then calls end_upload.
+    """
+
+    def __init__(self):
+        self.set_buffer(bytearray(FRAMER_INITIAL_SIZE))
+        # The beginning of the first message that hasn't been returned yet.
+        self.start = 0
+        # The end of the data that has been received.
+        self.end = 0
+        # No CRLF begins between self.start and self.scan.
+        self.scan = 0
+        # The number of bytes left in the file of the current upload message,
+        # or None if the framer is not in the middle of one, and the message
+        # itself.
+        self.payload_remaining = None
+        self.upload_header = None
+        # Whether the rest of the current message is being discarded after an
+        # upload that was not terminated properly.
+        self.skipping = False
+
+    @property
+    def in_upload(self):
+        return self.payload_remaining is not None
+
+    @property
+    def in_message(self):
+        """Whether part of a message has been received, but not all of it."""
+        return self.start != self.end or self.in_upload or self.skipping
+
+    def get_buffer(self, size=RECV_SIZE):
+        """Return a memoryview of at least `size` bytes to receive data into,
+        and make room for it if necessary. Call commit with the number of bytes
+        received, and release the view before the next call.
+        """
+        if self.start == self.end:
+            # Nothing is left over, so the buffer can be reused from the
+            # beginning. If it was enlarged for an upload or a burst of
+            # pipelined messages, go back to a small buffer.
+            self.scan -= self.start
+            self.start = self.end = 0
+            if len(self.buffer) > max(size, FRAMER_INITIAL_SIZE):
+                self.set_buffer(bytearray(max(size, FRAMER_INITIAL_SIZE)))
+        elif len(self.buffer) - self.end < size and self.start > 0:
+            # Move the partial message at the end of the buffer to the front.
+            pending = self.end - self.start
+            self.view[:pending] = self.view[self.start:self.end]
+            self.scan -= self.start
+            self.start = 0
+            self.end = pending
+
+        if len(self.buffer) - self.end < size:
+            buffer = bytearray(max(2 * len(self.buffer), self.end + size))
+            buffer[:self.end] = self.view[:self.end]
+            self.set_buffer(buffer)
+
+        return self.view[self.end:]
+
+    def set_buffer(self, buffer):
+        # The buffer is never resized in place, since it is exported to
+        # memoryviews. Instead, it is replaced by a new one.
+        self.buffer = buffer
+        self.view = memoryview(buffer)
+
+    def commit(self, n):
+        """Record that n bytes were received into the view from get_buffer."""
+        self.end += n
+
+    def messages(self):
+        """Return a list of the complete messages in the buffer, without their
+        CRLF terminators. Each item is a Result type.
+
+        If an upload message is reached, the framer stops there and enters the
+        upload state, with the message (minus the file) in self.upload_header.
+        The caller must then read the file with read_payload.
+        """
+        frames = []
+        if self.in_upload:
+            return frames
+
+        if self.skipping:
+            # The error has already been reported by the caller of end_upload.
+            end = self.buffer.find(b'\r\n', self.scan, self.end)
+            if end == -1:
+                self.scan = max(self.start, self.end - 1)
+                return frames
+            self.start = self.scan = end + 2
+            self.skipping = False
+
+        buffer = self.buffer
+        view = self.view
+        start = self.start
+        scan = self.scan
+        stop = self.end
+
+        # Fast path: if none of the complete messages in the buffer could be an
+        # upload, they can all be split off at once.
+        last = buffer.rfind(b'\r\n', scan, stop)
+        if last != -1 and buffer.find(b'upload ', start, last) == -1:
+            frames = [
+                Result(message)
+                for message in view[start:last].tobytes().split(b'\r\n')
+            ]
+            start = scan = last + 2
+
+        # Otherwise, parse one message at a time. This loop also handles an
+        # upload message after the last CRLF, whose file may not contain one.
+        while start < stop:
+            end = buffer.find(b'\r\n', scan, stop)
+
+            # Special parsing has to be done for the upload message, because
+            # the first CRLF sequence in the data stream could be part of the
+            # file itself and not the end of the message. To find the end, we
+            # have to read the `filelength` field. Checking the first byte
+            # (117 == ord('u')) is much cheaper than calling startswith for
+            # every message.
+            is_upload = (
+                buffer[start] == 117
+                and buffer.startswith(b'upload ', start, stop)
+            )
+            if is_upload:
+                header, error = self.parse_upload_header(start, end)
+                if error is not None and end != -1:
+                    frames.append(Error(error))
+                    start = scan = end + 2
+                    continue
+                elif header is not None:
+                    datapos, length = header
+                    self.upload_header = bytes(buffer[start:datapos-1])
+                    self.payload_remaining = length
+                    start = scan = datapos
+                    break
+
+            if end == -1:
+                # The last byte could be the first half of a CRLF.
+                scan = max(start, stop - 1)
+                break
+
+            frames.append(Result(view[start:end].tobytes()))
+            start = scan = end + 2
+
+        self.start = start
+        self.scan = scan
+        return frames
+
+    def parse_upload_header(self, start, end):
+        """If the message at `start` is an upload, i.e.
+
+            upload <filename> <filelength> <file>
+
+        and the header has been received in full, return the position at which
+        the file begins and its length. `end` is the position of the first
+        CRLF, or -1 if there is none. Return value is a Result type, whose
+        result is None if the header is incomplete.
+        """
+        limit = end if end != -1 else self.end
+        # 7 == len(b'upload ')
+        second_space = self.buffer.find(b' ', start+7, limit)
+        if second_space == -1:
+            return Result(None)
+        third_space = self.buffer.find(b' ', second_space+1, limit)
+        if third_space == -1:
+            return Result(None)
+
+        try:
+            length = int(self.buffer[second_space+1:third_space])
+        except ValueError:
+            return Error('invalid length field of upload message')
+        if length < 0:
+            return Error('invalid length field of upload message')
+        return Result((third_space + 1, length))
+
+    def read_payload(self):
+        """Return a memoryview of the next part of the file of the current
+        upload message that is in the buffer, or None if more data needs to be
+        received. The view must be released before the next call to
+        get_buffer.
+        """
+        n = min(self.payload_remaining, self.end - self.start)
+        if n == 0:
+            return None
+
+        chunk = self.view[self.start:self.start+n]
+        self.start = self.scan = self.start + n
+        self.payload_remaining -= n
+        return chunk
+
+    def end_upload(self):
+        """Consume the CRLF after the file of an upload message. Return True if
+        it was there, False if it wasn't, or None if more data needs to be
+        received to tell.
+
+        If the upload wasn't terminated properly, the rest of the message up to
+        the next CRLF will be skipped.
+        """
+        if self.end - self.start < 2:
+            return None
+
+        self.payload_remaining = None
+        self.upload_header = None
+        if self.buffer.startswith(b'\r\n', self.start, self.end):
+            self.start = self.scan = self.start + 2
+            return True
+        else:
+            self.skipping = True
+            return False
+
+
+class PartialUpload:
+    """A file that is being uploaded, streamed into a temporary file in the
+    files directory.
+
+    If the temporary file cannot be created or written to, the rest of the
+    upload is discarded and `failed` is set, so that the connection can still
+    read the whole message off the wire. If `hashed` is true, the SHA-256
+    digest of the file is computed as it is written.
+    """
+
+    def __init__(self, path_to_files, hashed=False):
+        self.failed = False
+        self.hash = hashlib.sha256() if hashed else None
+        try:
+            fd, self.path = tempfile.mkstemp(
+                prefix=PARTIAL_UPLOAD_PREFIX, dir=path_to_files
+            )
+        except OSError:
+            self.path = None
+            self.file = None
+            self.failed = True
+        else:
+            self.file = os.fdopen(fd, 'wb')
+            # mkstemp creates the file readable by its owner only.
+            try:
+                os.fchmod(fd, UPLOAD_MODE)
+            except OSError:
+                self.discard()
+                self.failed = True
+
+    def write(self, data):
+        if self.failed:
+            return
+
+        try:
+            self.file.write(data)
+        except OSError:
+            self.discard()
+            self.failed = True
+        else:
+            if self.hash is not None:
+                self.hash.update(data)
+
+    def hexdigest(self):
+        return self.hash.hexdigest()
+
+    def finish(self):
+        if self.failed:
+            return
+
+        try:
+            self.file.close()
+        except OSError:
+            self.discard()
+            self.failed = True
+
+    def discard(self):
+        if self.file is not None:
+            try:
+                self.file.close()
+            except OSError:
+                pass
+            self.file = None
+        if self.path is not None:
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+            self.path = None
+
+
+class OutputBuffer:
+    """Responses that are waiting to be written to a socket.
+
+    The responses to a batch of pipelined messages are written together with a
+    single sendmsg call where possible, rather than one send call each.
+    """
+
+    def __init__(self):
+        self.chunks = []
+        # The number of bytes in the buffer.
+        self.size = 0
+
+    def __bool__(self):
+        return bool(self.chunks)
+
+    def append(self, data):
+        if data:
+            self.chunks.append(data)
+            self.size += len(data)
+
+    def flush(self, sock):
+        """Write everything in the buffer to a blocking socket."""
+        while self.chunks:
+            self.consume(send_chunks(sock, self.chunks))
+
+    def flush_nowait(self, sock):
+        """Write as much of the buffer as a non-blocking socket will take right
+        away, and return whether all of it was written.
+        """
+        try:
+            while self.chunks:
+                self.consume(send_chunks(sock, self.chunks))
+        except (BlockingIOError, InterruptedError):
+            pass
+        return not self.chunks
+
+    async def flush_async(self, sock, timeout=None):
+        """Write everything in the buffer to a non-blocking socket, raising
+        asyncio.TimeoutError if the client accepts none of it for `timeout`
+        seconds.
+        """
+        loop = asyncio.get_running_loop()
+        while not self.flush_nowait(sock):
+            # The socket's send buffer is full. Let the event loop wait for it
+            # to drain.
+            writable = loop.create_future()
+            loop.add_writer(sock.fileno(), set_done, writable)
+            try:
+                await asyncio.wait_for(writable, timeout)
+            finally:
+                loop.remove_writer(sock.fileno())
+
+    def consume(self, n):
+        """Remove the first n bytes, which have been sent, from the buffer."""
+        metrics.add_bytes_sent(n)
+        self.size -= n
+        chunks = self.chunks
+        i = 0
+        while i < len(chunks) and n >= len(chunks[i]):
+            n -= len(chunks[i])
+            i += 1
+        del chunks[:i]
+        if n > 0:
+            chunks[0] = memoryview(chunks[0])[n:]
+
+
+def set_done(future):
+    """Mark a future as done, unless it already is."""
+    if not future.done():
+        future.set_result(None)
+
+
+def send_chunks(sock, chunks):
+    """Send as many of the chunks as possible with one system call, and return
+    the number of bytes sent.
+    """
+    if HAVE_SENDMSG:
+        return sock.sendmsg(chunks[:IOV_MAX])
+    else:
+        data = b''.join(chunks)
+        sock.sendall(data)
+        return len(data)
+
+
+def configure_socket(conn, tcp_policy):
+    """Set the options of a newly accepted connection according to one of the
+    policies in TCP_POLICIES.
+    """
+    if tcp_policy in ('nodelay', 'cork'):
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+
+def set_nodelay(sock, nodelay):
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, int(nodelay))
+
+
+def set_cork(sock, cork):
+    """Hold back partial TCP segments while `cork` is set, so that a file
+    response goes out in as few packets as possible. Only supported on Linux.
+    """
+    if hasattr(socket, 'TCP_CORK'):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, int(cork))
+
+
+class FileResponse:
+    """A `file` response to a download request, which is sent straight from
+    the open file on disk (with sendfile, where possible) rather than read into
+    memory.
+    """
+
+    def __init__(self, filename, f, offset, length):
+        self.filename = filename
+        self.file = f
+        self.offset = offset
+        self.length = length
+
+    def header(self):
+        return b'file %b %d ' % (self.filename.encode('utf-8'), self.length)
+
+    def close(self):
+        self.file.close()
+
+    def __repr__(self):
+        return '<file {!r}, {} bytes>'.format(self.filename, self.length)
+
+
+def remove_partial_uploads(path_to_files):
+    """Remove the temporary files of uploads that were interrupted by the
+    server shutting down.
+    """
+    for name in os.listdir(path_to_files):
+        if name.startswith(PARTIAL_UPLOAD_PREFIX):
+            try:
+                os.remove(os.path.join(path_to_files, name))
+            except OSError:
+                pass
+
+
+class FileIndex:
+    """A sorted, in-memory list of the names of the uploaded files, so that
+    listfiles does not have to list and sort them each time.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sorted_names = []
+        # The response to a listfiles message without arguments, or None if
+        # it needs to be rebuilt.
+        self.cached_listing = None
+
+    def load(self, names):
+        names = sorted(names)
+        with self.lock:
+            self.sorted_names = names
+            self.cached_listing = None
+
+    def add(self, name):
+        with self.lock:
+            i = bisect.bisect_left(self.sorted_names, name)
+            if i == len(self.sorted_names) or self.sorted_names[i] != name:
+                self.sorted_names.insert(i, name)
+                self.cached_listing = None
+
+    def listing(self):
+        """Return the response to a listfiles message without arguments."""
+        with self.lock:
+            if self.cached_listing is None:
+                if self.sorted_names:
+                    self.cached_listing = (
+                        'filelist ' + ' '.join(self.sorted_names)
+                    ).encode('utf-8') + b'\r\n'
+                else:
+                    self.cached_listing = b'filelist\r\n'
+            return self.cached_listing
+
+    def names(self, offset, limit, prefix=''):
+        """Return up to `limit` names that begin with `prefix`, skipping the
+        first `offset` of them.
+        """
+        with self.lock:
+            start = bisect.bisect_left(self.sorted_names, prefix) + offset
+            page = self.sorted_names[start:start+limit]
+        # The names that begin with the prefix are all next to each other.
+        for i, name in enumerate(page):
+            if not name.startswith(prefix):
+                return page[:i]
+        return page
+
+
+class FileStore:
+    """The uploaded files, each stored under its own name in the files
+    directory.
+
+    The names are also kept in a FileIndex, which is loaded from the directory
+    once and then kept up to date by `store`. If the directory is `shared`
+    with other processes, whose uploads the index does not hear about, the
+    index is also reloaded whenever the directory's modification time has
+    changed.
+    """
+
+    def __init__(self, path, shared=False):
+        self.path = path
+        self.shared = shared
+        self.index = FileIndex()
+        self.mtime = None
+
+    def load(self):
+        # Record the modification time first, so that an upload that happens
+        # while the directory is being listed is noticed next time.
+        mtime = os.stat(self.path).st_mtime_ns
+        self.index.load(list_plain_files(self.path))
+        self.mtime = mtime
+
+    def refresh(self):
+        if self.shared and os.stat(self.path).st_mtime_ns != self.mtime:
+            self.load()
+
+    def listing(self):
+        self.refresh()
+        return self.index.listing()
+
+    def names(self, offset, limit, prefix=''):
+        self.refresh()
+        return self.index.names(offset, limit, prefix)
+
+    def new_upload(self):
+        """Return a PartialUpload to stream a new file into."""
+        return PartialUpload(self.path)
+
+    def store(self, upload, filename):
+        """Save a finished upload under `filename`. Raise FileExistsError if
+        there is already a file with that name, and OSError if the file could
+        not be saved.
+        """
+        # Linking the temporary file into place, rather than renaming it, means
+        # that an existing file with the same name is never overwritten.
+        os.link(upload.path, os.path.join(self.path, filename))
+        # In shared mode, the modification time is not updated, so the next
+        # read reloads the index in case other processes have also uploaded
+        # files in the meantime.
+        self.index.add(filename)
+
+    def open(self, filename):
+        """Return an open binary file object for the file and its length, or
+        raise OSError.
+        """
+        return open_with_length(os.path.join(self.path, filename))
+
+
+class DedupFileStore(FileStore):
+    """The uploaded files, stored once per distinct content.
+
+    Each upload is hashed as it is streamed to disk, and saved as a blob named
+    after its SHA-256 digest under the blobs directory, unless a blob with the
+    same digest already exists. The files table maps filenames to blobs.
+
+    Files uploaded without deduplication, which are stored under their own
+    names, are added to the files table when the store is loaded. They are
+    left in place, so that they are still there if deduplication is turned
+    off again.
+    """
+
+    def __init__(self, path, storage, shared=False):
+        super().__init__(path, shared)
+        self.storage = storage
+        self.blob_dir = os.path.join(path, 'blobs')
+        # The highest file ID when the index was loaded.
+        self.version = None
+
+    def load(self):
+        os.makedirs(self.blob_dir, exist_ok=True)
+        self.import_plain_files()
+        self.load_index()
+
+    def load_index(self):
+        version = self.storage.get_files_version()
+        self.index.load(self.storage.get_filenames())
+        self.version = version
+
+    def refresh(self):
+        if self.shared and self.storage.get_files_version() != self.version:
+            self.load_index()
+
+    def import_plain_files(self):
+        known = set(self.storage.get_filenames())
+        for name in list_plain_files(self.path):
+            if name in known:
+                continue
+            path = os.path.join(self.path, name)
+            digest = hash_file(path)
+            self.link_blob(path, digest)
+            # Another process may import the same file at the same time.
+            self.storage.create_file(name, digest)
+            logger.info('Added %s to the files table', name)
+
+    def new_upload(self):
+        return PartialUpload(self.path, hashed=True)
+
+    def store(self, upload, filename):
+        digest = upload.hexdigest()
+        self.link_blob(upload.path, digest)
+
+        # If the filename is taken, the blob may now be unused. Unused blobs
+        # cost nothing but disk space, so they are left alone.
+        if self.storage.create_file(filename, digest) is None:
+            raise FileExistsError(filename)
+        self.index.add(filename)
+
+    def open(self, filename):
+        digest = self.storage.get_file_blob(filename)
+        if digest is None:
+            raise FileNotFoundError(filename)
+        return open_with_length(self.blob_path(digest))
+
+    def link_blob(self, path, digest):
+        """Link the file at `path` into place as the blob with the given
+        digest, unless the blob already exists.
+        """
+        blob_path = self.blob_path(digest)
+        os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+        try:
+            os.link(path, blob_path)
+        except FileExistsError:
+            # The same content has been uploaded before.
+            pass
+
+    def blob_path(self, digest):
+        # Blobs are spread over subdirectories so that none gets too large.
+        return os.path.join(self.blob_dir, digest[:2], digest)
+
+
+def list_plain_files(path):
+    """Return the names of the files in the files directory that were
+    uploaded without deduplication. The blobs directory and partial uploads
+    are left out.
+    """
+    with os.scandir(path) as entries:
+        return [
+            entry.name for entry in entries
+            if entry.is_file() and
+                not entry.name.startswith(PARTIAL_UPLOAD_PREFIX)
+        ]
+
+
+def hash_file(path):
+    """Return the SHA-256 digest of a file, as a hex string."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(UPLOAD_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def open_with_length(path):
+    """Open a file for reading in binary mode, and return it and its length."""
+    f = open(path, 'rb')
+    try:
+        length = os.fstat(f.fileno()).st_size
+    except OSError:
+        f.close()
+        raise
+    return f, length
+
+
+class Histogram:
+    """Counts of observed values in buckets with fixed upper bounds."""
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        # The last bucket counts the values above every bound.
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+    def render(self, name, labels):
+        """Return the histogram in the Prometheus text format."""
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.bounds + ('+Inf',), self.counts):
+            cumulative += count
+            lines.append('{}_bucket{{{},le="{}"}} {}'.format(
+                name, labels, bound, cumulative))
+        lines.append('{}_sum{{{}}} {}'.format(name, labels, self.sum))
+        lines.append('{}_count{{{}}} {}'.format(name, labels, cumulative))
+        return lines
+
+
+class Metrics:
+    """Counters and latency histograms of what the server is doing.
+
+    Every update takes a single uncontended lock, so the metrics are cheap
+    enough to leave on. Each worker process has its own.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.connections_active = 0
+        self.connections_total = 0
+        # Connections dropped for exceeding a limit, keyed by reason.
+        self.connections_dropped = {}
+        self.bytes_received = 0
+        self.bytes_sent = 0
+        # Keyed by command name, as bytes.
+        self.requests = {}
+        # Keyed by (command name, error message).
+        self.errors = {}
+        # Keyed by StorageLayer method name.
+        self.storage = {}
+        # Messages deleted by the retention policies, keyed by policy.
+        self.messages_deleted = {}
+        # Log records dropped because the queue of the logging thread was full.
+        self.log_records_dropped = 0
+
+    def connection_opened(self):
+        with self.lock:
+            self.connections_active += 1
+            self.connections_total += 1
+
+    def connection_closed(self):
+        with self.lock:
+            self.connections_active -= 1
+
+    def connection_dropped(self, reason):
+        with self.lock:
+            self.connections_dropped[reason] = (
+                self.connections_dropped.get(reason, 0) + 1
+            )
+
+    def add_bytes_received(self, n):
+        with self.lock:
+            self.bytes_received += n
+
+    def add_bytes_sent(self, n):
+        with self.lock:
+            self.bytes_sent += n
+
+    def log_record_dropped(self):
+        with self.lock:
+            self.log_records_dropped += 1
+
+    def observe_request(self, command, seconds, response):
+        """Record the latency of a request and, if its response was an error,
+        the error message.
+        """
+        if isinstance(response, bytes) and response.startswith(b'error '):
+            error = response[6:-2].decode('utf-8', 'replace')
+        else:
+            error = None
+        with self.lock:
+            histogram = self.requests.get(command)
+            if histogram is None:
+                histogram = self.requests[command] = Histogram(
+                    LATENCY_BUCKETS
+                )
+            histogram.observe(seconds)
+            if error is not None:
+                key = (command, error)
+                self.errors[key] = self.errors.get(key, 0) + 1
+
+    def add_messages_deleted(self, policy, n):
+        with self.lock:
+            self.messages_deleted[policy] = (
+                self.messages_deleted.get(policy, 0) + n
+            )
+
+    def observe_error(self, command, error):
+        with self.lock:
+            key = (command, error)
+            self.errors[key] = self.errors.get(key, 0) + 1
+
+    def observe_storage(self, method, seconds):
+        with self.lock:
+            histogram = self.storage.get(method)
+            if histogram is None:
+                histogram = self.storage[method] = Histogram(LATENCY_BUCKETS)
+            histogram.observe(seconds)
+
+    def render(self):
+        """Return every metric in the Prometheus text format."""
+        with self.lock:
+            lines = [
+                'chat_connections_active {}'.format(self.connections_active),
+                'chat_connections_total {}'.format(self.connections_total),
+                'chat_bytes_received_total {}'.format(self.bytes_received),
+                'chat_bytes_sent_total {}'.format(self.bytes_sent),
+                'chat_log_records_dropped_total {}'.format(
+                    self.log_records_dropped
+                ),
+            ]
+            for reason, count in sorted(self.connections_dropped.items()):
+                lines.append(
+                    'chat_connections_dropped_total{{reason="{}"}} {}'.format(
+                        reason, count
+                    )
+                )
+            for command, histogram in sorted(self.requests.items()):
+                lines.extend(histogram.render(
+                    'chat_request_seconds',
+                    'command="{}"'.format(command.decode('ascii')),
+                ))
+            for (command, error), count in sorted(self.errors.items()):
+                lines.append(
+                    'chat_errors_total{{command="{}",error="{}"}} {}'.format(
+                        command.decode('ascii'), escape_label(error), count
+                    )
+                )
+            for method, histogram in sorted(self.storage.items()):
+                lines.extend(histogram.render(
+                    'chat_storage_seconds', 'method="{}"'.format(method)
+                ))
+            for policy, count in sorted(self.messages_deleted.items()):
+                lines.append(
+                    'chat_messages_deleted_total{{policy="{}"}} {}'.format(
+                        policy, count
+                    )
+                )
+        return '\n'.join(lines) + '\n'
+
+
+def escape_label(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"')
+
+
+# The metrics of this process.
+metrics = Metrics()
+
+
+def timed(f):
+    """A decorator for the methods of storage backends, to record the time
+    that they take in the metrics.
+    """
+    name = f.__name__
+
+    @functools.wraps(f)
+    def wrapped(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return f(*args, **kwargs)
+        finally:
+            metrics.observe_storage(name, time.perf_counter() - start)
+    return wrapped
+
+
+class MetricsRequestHandler(http.server.BaseHTTPRequestHandler):
+    """Serve the metrics as plain text to any GET request."""
+
+    def do_GET(self):
+        body = metrics.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_metrics_server(port):
+    """Serve the metrics over HTTP on a background thread."""
+    try:
+        httpd = http.server.ThreadingHTTPServer(
+            (socket.gethostbyname('localhost'), port), MetricsRequestHandler
+        )
+    except OSError:
+        fatal('Could not bind metrics server to port %d', port)
+    httpd.daemon_threads = True
+    thread = threading.Thread(
+        target=httpd.serve_forever, name='metrics', daemon=True
+    )
+    thread.start()
+    logger.info('Serving metrics on port %d', port)
+
+
+class Profiler:
+    """Profile the server for a window of time on demand, and write out the
+    stats merged across threads.
+
+    Before Python 3.12, cProfile only sees the thread that enables it, so while
+    a window is open each thread that handles a message or commits a batch of
+    writes does so under a cProfile.Profile of its own (see run). When no
+    window is open, the only cost is the check of self.active by the callers
+    of run.
+
+    The stats are written to `<path>-<pid>-<time>.prof`, which can be read
+    with the pstats module, along with a summary of the time spent in each
+    message handler and each StorageLayer method in a .txt file of the same
+    name.
+    """
+
+    def __init__(self):
+        self.path = None
+        self.window = PROFILE_WINDOW
+        self.active = False
+        self.started = None
+        self.condition = threading.Condition()
+        # The profiles of the current window, keyed by thread ID.
+        self.profiles = {}
+        # The number of calls to run that are still in progress.
+        self.running = 0
+        # Which threads are in the middle of a call to run.
+        self.local = threading.local()
+        # From Python 3.12, a single profile sees every thread.
+        self.global_profile = None
+
+    def start(self, signum=None, frame=None):
+        """Open a window of self.window seconds. Safe to call from a signal
+        handler.
+        """
+        if self.active or self.global_profile is not None:
+            logger.warning('Already profiling')
+            return
+
+        logger.warning('Profiling for %.1f seconds', self.window)
+        self.started = datetime.datetime.now()
+        if PROFILE_PER_THREAD:
+            self.active = True
+        else:
+            self.global_profile = cProfile.Profile()
+            self.global_profile.enable()
+        timer = threading.Timer(self.window, self.finish)
+        timer.daemon = True
+        timer.start()
+
+    def run(self, f, *args):
+        """Call f(*args) under the calling thread's profile."""
+        if getattr(self.local, 'running', False):
+            # Already profiled by an outer call.
+            return f(*args)
+
+        with self.condition:
+            if not self.active:
+                profile = None
+            else:
+                ident = threading.get_ident()
+                profile = self.profiles.get(ident)
+                if profile is None:
+                    profile = self.profiles[ident] = cProfile.Profile()
+                self.running += 1
+
+        if profile is None:
+            return f(*args)
+
+        self.local.running = True
+        try:
+            return profile.runcall(f, *args)
+        finally:
+            self.local.running = False
+            with self.condition:
+                self.running -= 1
+                self.condition.notify_all()
+
+    def finish(self):
+        if PROFILE_PER_THREAD:
+            with self.condition:
+                self.active = False
+                # A profile cannot be read while it is still enabled.
+                self.condition.wait_for(lambda: self.running == 0)
+                profiles = list(self.profiles.values())
+                self.profiles = {}
+        else:
+            self.global_profile.disable()
+            profiles = [self.global_profile]
+            self.global_profile = None
+
+        if not profiles:
+            logger.warning('Nothing happened while profiling')
+            return
+
+        path = '{}-{}-{}'.format(
+            self.path, os.getpid(), self.started.strftime('%Y%m%dT%H%M%S')
+        )
+        stats = pstats.Stats(*profiles)
+        try:
+            stats.dump_stats(path + '.prof')
+            with open(path + '.txt', 'w') as f:
+                f.write(self.summarize(stats))
+        except OSError as e:
+            logger.error('Could not write profile: %s', e)
+        else:
+            logger.warning('Wrote profile to %s.prof', path)
+
+    def summarize(self, stats):
+        """Return a table of the calls to each message handler and StorageLayer
+        method in `stats`, and their cumulative time.
+        """
+        sections = [
+            ('handler', {
+                code_key(f): name for name, f in vars(ChatSession).items()
+                if name.startswith('process_')
+            }),
+            ('storage', {
+                code_key(f): name for name, f in vars(StorageLayer).items()
+                if isinstance(f, (staticmethod, types.FunctionType))
+            }),
+        ]
+        lines = ['Profile of process {} for {:.1f} seconds from {}'.format(
+            os.getpid(), self.window, self.started.isoformat(' ', 'seconds')
+        )]
+        for title, names in sections:
+            rows = []
+            for key, (cc, nc, tt, ct, callers) in stats.stats.items():
+                if key in names:
+                    rows.append((ct, names[key], nc))
+            rows.sort(reverse=True)
+
+            lines.append('')
+            lines.append('{:32} {:>8} {:>10} {:>12}'.format(
+                title, 'calls', 'total s', 'per call ms'
+            ))
+            for ct, name, nc in rows:
+                lines.append('{:32} {:8d} {:10.3f} {:12.3f}'.format(
+                    name, nc, ct, ct / nc * 1000
+                ))
+        return '\n'.join(lines) + '\n'
+
+
+def code_key(f):
+    """Return the key of a function in pstats.Stats.stats, looking through
+    decorators.
+    """
+    if isinstance(f, staticmethod):
+        f = f.__func__
+    f = inspect.unwrap(f)
+    code = f.__code__
+    return (code.co_filename, code.co_firstlineno, code.co_name)
+
+
+# The profiler of this process.
+profiler = Profiler()
+
+
+class MessageLogFilter(logging.Filter):
+    """Keep the log of every message usable under heavy load.
+
+    Payloads longer than `max_payload` bytes are cut down to a preview, and
+    only a fraction of the messages of each command in `sample_rates`, a
+    dictionary from command names (as bytes) to rates between 0 and 1, are
+    logged at all.
+
+    The filter runs in the thread that logs the record, before it is queued
+    for the logging thread, so that a record that is sampled out costs nothing
+    more and a queued one holds only the preview of a long payload.
+    """
+
+    def __init__(self, max_payload=LOG_MAX_PAYLOAD, sample_rates=None):
+        super().__init__()
+        self.max_payload = max_payload
+        self.sample_rates = sample_rates if sample_rates is not None else {}
+
+    def filter(self, record):
+        rate = self.sample_rates.get(getattr(record, 'command', None))
+        if rate is not None and random.random() >= rate:
+            return False
+
+        if isinstance(record.args, tuple):
+            record.args = tuple(self.truncate(arg) for arg in record.args)
+        return True
+
+    def truncate(self, arg):
+        if isinstance(arg, (bytes, bytearray)) and len(arg) > self.max_payload:
+            return PayloadPreview(arg[:self.max_payload], len(arg))
+        else:
+            return arg
+
+
+class PayloadPreview:
+    """The beginning of a payload that was too long to log in full."""
+
+    def __init__(self, data, length):
+        self.data = data
+        self.length = length
+
+    def __repr__(self):
+        return '{!r}... ({} bytes)'.format(self.data, self.length)
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """A QueueHandler that drops records rather than blocking the thread that
+    logged them when the queue is full. The dropped records are counted in
+    the metrics.
+
+    As with any QueueHandler, the message is formatted from its arguments
+    before it is queued, since they may change once the logging call returns.
+    The rest of the formatting happens on the logging thread.
+    """
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            metrics.log_record_dropped()
+
+
+def configure_logging(quiet, max_payload=LOG_MAX_PAYLOAD, sample_rates=None,
+        background=True):
+    """Set up the module's logger to write to stderr and to LOG_FILE, replacing
+    any previous configuration.
+
+    If `background` is true, the handlers, which format the log lines and
+    write them out, run on a background thread, so that connections do not
+    wait on each other, or on the disk, to log their messages. The
+    MessageLogFilter and the formatting of each message from its arguments
+    still happen in the thread that logs it. Return the thread's
+    QueueListener, which should be stopped before the process exits, or None.
+    """
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+        handler.close()
+    for log_filter in list(logger.filters):
+        logger.removeFilter(log_filter)
+    if quiet:
+        logger.setLevel(logging.CRITICAL)
+    else:
+        logger.setLevel(logging.DEBUG)
+
+    stream_handler = logging.StreamHandler()
+    stream_handler.setLevel(logging.DEBUG)
+    file_handler = logging.FileHandler(LOG_FILE)
+    file_handler.setLevel(logging.INFO)
+    formatter = logging.Formatter(
+        '[%(levelname)s] (%(threadName)s) %(asctime)s: %(message)s'
+    )
+    stream_handler.setFormatter(formatter)
+    file_handler.setFormatter(formatter)
+    logger.addFilter(MessageLogFilter(max_payload, sample_rates))
+
+    if not background:
+        logger.addHandler(stream_handler)
+        logger.addHandler(file_handler)
+        return None
+
+    log_queue = queue.Queue(LOG_QUEUE_SIZE)
+    listener = logging.handlers.QueueListener(
+        log_queue, stream_handler, file_handler, respect_handler_level=True
+    )
+    listener.start()
+    logger.addHandler(DroppingQueueHandler(log_queue))
+    return listener
+
+
+def sample_rate(arg):
+    """Parse a --log-sample argument of the form COMMAND=RATE."""
+    command, _, rate = arg.partition('=')
+    try:
+        rate = float(rate)
+    except ValueError:
+        rate = -1.0
+    if not command or not 0.0 <= rate <= 1.0:
+        raise argparse.ArgumentTypeError(
+            'expected COMMAND=RATE with a rate between 0 and 1'
+        )
+    return command.encode('utf-8'), rate
+
+
+def fatal(msg, *args, retcode=FATAL_EXIT_CODE):
+    """Log a critical error and bail."""
+    logger.critical(msg, *args)
+    sys.exit(retcode)
+
+
+class StorageBackend:
+    """The interface to wherever the users, messages, groups and the names of
+    deduplicated files are kept. See StorageLayer, which keeps them in SQLite,
+    and MemLogStorage, which keeps them in memory.
+
+    Backends must be safe to share between threads. Every change has to be
+    durable by the time that the method which made it returns.
+    """
+
+    def __init__(self, recv_limit=RECV_LIMIT, shared=False):
+        # Announces new messages to the connections in `recv wait`. If other
+        # processes (`shared`) write to the storage as well, the connections
+        # have to look for their messages every so often.
+        self.notifier = InboxNotifier(RECV_POLL_INTERVAL if shared else None)
+        # The most messages that take_messages returns at once, or None for
+        # no limit.
+        self.recv_limit = recv_limit
+
+    def migrate(self):
+        """Bring the stored data up to date with this version of the server.
+        It is called before the workers are forked, as well as by start.
+        """
+
+    def start(self):
+        """Load the stored data and start any background threads."""
+        raise NotImplementedError
+
+    def close(self):
+        raise NotImplementedError
+
+    def compact(self, stopping):
+        """Give the space that the retention policies have freed back to the
+        file system, unless the `stopping` event is set in the meantime.
+        """
+
+    def get_id_from_username(self, username):
+        """Return the ID of a user, or None if there is no such user."""
+        raise NotImplementedError
+
+    def get_id_from_username_and_password(self, username, password):
+        raise NotImplementedError
+
+    def create_user(self, username, password):
+        """Create a new user and return their ID, or return None if the
+        username is already registered.
+        """
+        raise NotImplementedError
+
+    def create_message(self, sender_id, recipient, recipient_id, message):
+        raise NotImplementedError
+
+    def create_shared_message(self, sender_id, destination, recipient_ids,
+            message):
+        """Store a message for several users, with `destination` as its
+        destination.
+        """
+        raise NotImplementedError
+
+    def create_broadcast(self, sender_id, message):
+        raise NotImplementedError
+
+    def take_messages(self, recipient_id, limit=None):
+        """Remove up to `limit` of the oldest messages from a user's inbox, and
+        return them as (timestamp, sender, destination, body) tuples. No more
+        than `recv_limit` messages are returned in any case.
+
+        A message is never returned twice. Broadcasts are merged with the
+        direct messages in the order they were sent.
+        """
+        raise NotImplementedError
+
+    def create_group(self, name, owner_id):
+        """Create a new group with its owner as its only member and return its
+        ID, or return None if the name is already taken.
+        """
+        raise NotImplementedError
+
+    def get_group_id(self, name):
+        raise NotImplementedError
+
+    def get_group_members(self, group_id):
+        raise NotImplementedError
+
+    def add_group_member(self, group_id, user_id):
+        raise NotImplementedError
+
+    def remove_group_member(self, group_id, user_id):
+        """Remove a user from a group, and return whether they were in it."""
+        raise NotImplementedError
+
+    def get_filenames(self):
+        """Return the names of the files in DedupFileStore."""
+        raise NotImplementedError
+
+    def get_files_version(self):
+        """Return a number that changes whenever a file is added."""
+        raise NotImplementedError
+
+    def get_file_blob(self, filename):
+        raise NotImplementedError
+
+    def create_file(self, filename, blob):
+        """Map a filename to a blob and return the file's ID, or return None if
+        the filename is already taken.
+        """
+        raise NotImplementedError
+
+    def expire_messages(self, cutoff, batch_size):
+        """Delete up to about `batch_size` of the direct messages that were
+        sent before `cutoff`, a timestamp in the same format as the timestamps
+        of messages, and return how many were deleted.
+        """
+        raise NotImplementedError
+
+    def expire_broadcasts(self, cutoff, batch_size):
+        """Like expire_messages, but for broadcasts."""
+        raise NotImplementedError
+
+    def delete_orphan_bodies(self, batch_size):
+        """Delete up to about `batch_size` of the stored bodies of messages to
+        several users that no inbox refers to any more, and return how many
+        were deleted.
+        """
+        return 0
+
+    def get_full_inboxes(self, cap):
+        """Return the IDs of the users with more than `cap` direct messages
+        waiting for them.
+        """
+        raise NotImplementedError
+
+    def trim_inbox(self, inbox_id, cap, batch_size):
+        """Delete up to `batch_size` of the oldest direct messages in a user's
+        inbox that do not fit in the newest `cap`, and return how many were
+        deleted.
+        """
+        raise NotImplementedError
+
+
+class StorageLayer(StorageBackend):
+    """The storage backend that keeps everything in an SQLite3 database.
+
+    A StorageLayer is safe to share between threads: each read borrows a
+    connection from the pool for the duration of one query, and each write is
+    handed to the StorageWriter, if there is one. Usernames are looked up in a
+    UserDirectory instead of the database.
+
+    The messages table may be partitioned across several database files by
+    the recipient's user ID, so that sends to different inboxes can commit in
+    parallel. `shards` are the MessageShards for the files other than the
+    main database, which holds the inboxes of every user whose ID is a
+    multiple of the number of shards, as well as everything else.
+    """
+
+    def __init__(self, pool, writer=None, recv_limit=RECV_LIMIT,
+            shared=False, shards=()):
+        super().__init__(recv_limit, shared)
+        self.pool = pool
+        self.writer = writer
+        self.shards = [MessageShard(pool, writer)] + list(shards)
+        self.users = UserDirectory()
+        self.warned_about_vacuum = False
+        # The ID of the last broadcast, if no other process sends any (see
+        # get_broadcast_seq).
+        self.shared = shared
+        self.broadcast_seq = 0
+        self.broadcast_seq_lock = threading.Lock()
+
+    def migrate(self):
+        """Bring the database's schema up to date, and move any messages that
+        are not in their shard, e.g. because the number of shards has changed,
+        to the right one.
+        """
+        db = self.pool.connect()
+        try:
+            migrate_database(db)
+        finally:
+            db.close()
+
+        for shard in self.shards[1:]:
+            db = shard.pool.connect()
+            try:
+                create_shard_schema(db)
+            finally:
+                db.close()
+
+        dbs = [shard.pool.connect() for shard in self.shards]
+        try:
+            if len(dbs) > 1:
+                for index, db in enumerate(dbs):
+                    rebalance_shard(db, index, dbs)
+            # The shards that are no longer in use are emptied as well.
+            index = len(dbs)
+            path = shard_path(self.pool.path_to_db, index)
+            while os.path.exists(path):
+                db = sqlite3.connect(path, isolation_level=None)
+                try:
+                    if rebalance_shard(db, index, dbs):
+                        logger.info('Shard %s is no longer in use, and can be '
+                            'deleted', path)
+                finally:
+                    db.close()
+                index += 1
+                path = shard_path(self.pool.path_to_db, index)
+        finally:
+            for db in dbs:
+                db.close()
+
+    def start(self):
+        self.migrate()
+        with self.pool.connection() as db:
+            self.users.load(
+                db.execute('SELECT username, user_id FROM users;')
+            )
+            self.broadcast_seq = self._get_broadcast_seq(db.cursor())
+        for shard in self.shards:
+            if shard.writer is not None:
+                shard.writer.start()
+
+    def shard_for(self, user_id):
+        """Return the MessageShard that holds a user's inbox."""
+        return self.shards[user_id % len(self.shards)]
+
+    @timed
+    def get_id_from_username(self, username):
+        user_id = self.users.get(username)
+        if user_id is None:
+            # The user may have been registered by another process since the
+            # directory was loaded.
+            with self.pool.connection() as db:
+                row = db.execute(
+                    'SELECT user_id FROM users WHERE username=?;', (username,)
+                ).fetchone()
+            if row is not None:
+                user_id = row[0]
+                self.users.add(username, user_id)
+        return user_id
+
+    @timed
+    def get_username(self, user_id):
+        username = self.users.get_name(user_id)
+        if username is None:
+            # As in get_id_from_username.
+            with self.pool.connection() as db:
+                row = db.execute(
+                    'SELECT username FROM users WHERE user_id=?;', (user_id,)
+                ).fetchone()
+            if row is not None:
+                username = row[0]
+                self.users.add(username, user_id)
+        return username
+
+    @timed
+    def get_id_from_username_and_password(self, username, password):
+        with self.pool.connection() as db:
+            row = db.execute(
+                'SELECT user_id FROM users WHERE username=? AND password=?;',
+                (username, password)
+            ).fetchone()
+        return row[0] if row else None
+
+    @timed
+    def create_message(self, sender_id, recipient, recipient_id, message):
+        timestamp = datetime.datetime.utcnow().isoformat() + 'Z'
+        shard = self.shard_for(recipient_id)
+        message_id = shard.write(
+            self._create_message, timestamp, sender_id, recipient,
+            recipient_id, message, self.get_broadcast_seq(shard)
+        )
+        self.notifier.notify(recipient_id)
+        return message_id
+
+    @staticmethod
+    def _create_message(cursor, timestamp, sender_id, recipient, recipient_id,
+            message, broadcast_seq):
+        if broadcast_seq is None:
+            broadcast_seq = StorageLayer._get_broadcast_seq(cursor)
+        # The broadcast_seq of an inbox's messages must not go down as their
+        # IDs go up, even if a broadcast was sent while the message waited to
+        # be committed to a shard, since _take_messages deletes the messages
+        # that it returns by ID.
+        cursor.execute(
+            '''
+            INSERT INTO messages (timestamp, source_id, destination, inbox_id,
+                body, broadcast_seq)
+            VALUES (?, ?, ?, ?, ?, MAX(?, COALESCE((
+                SELECT broadcast_seq FROM messages WHERE inbox_id=?
+                    ORDER BY message_id DESC LIMIT 1
+            ), 0)));
+            ''',
+            (timestamp, sender_id, recipient, recipient_id, message,
+                broadcast_seq, recipient_id)
+        )
+        return cursor.lastrowid
+
+    @timed
+    def create_shared_message(self, sender_id, destination, recipient_ids,
+            message):
+        """Store a message for several users, with its body in a single row
+        of each shard that holds one of their inboxes.
+        """
+        timestamp = datetime.datetime.utcnow().isoformat() + 'Z'
+        by_shard = {}
+        for recipient_id in recipient_ids:
+            by_shard.setdefault(
+                self.shard_for(recipient_id), []
+            ).append(recipient_id)
+        for shard, shard_recipient_ids in by_shard.items():
+            shard.write(
+                self._create_shared_message, timestamp, sender_id,
+                destination, shard_recipient_ids, message,
+                self.get_broadcast_seq(shard)
+            )
+        for recipient_id in recipient_ids:
+            self.notifier.notify(recipient_id)
+
+    @staticmethod
+    def _create_shared_message(cursor, timestamp, sender_id, destination,
+            recipient_ids, message, broadcast_seq):
+        if broadcast_seq is None:
+            broadcast_seq = StorageLayer._get_broadcast_seq(cursor)
+        cursor.execute(
+            'INSERT INTO message_bodies (destination, body) VALUES (?, ?);',
+            (destination, message)
+        )
+        body_id = cursor.lastrowid
+        # The inbox rows point to the body instead of holding a copy of it.
+        # See _create_message for their broadcast_seq.
+        cursor.executemany(
+            '''
+            INSERT INTO messages (timestamp, source_id, destination, inbox_id,
+                body, broadcast_seq, body_id)
+            VALUES (?, ?, '', ?, '', MAX(?, COALESCE((
+                SELECT broadcast_seq FROM messages WHERE inbox_id=?
+                    ORDER BY message_id DESC LIMIT 1
+            ), 0)), ?);
+            ''',
+            (
+                (timestamp, sender_id, recipient_id, broadcast_seq,
+                    recipient_id, body_id)
+                for recipient_id in recipient_ids
+            )
+        )
+
+    def get_broadcast_seq(self, shard):
+        """Return the ID of the last broadcast that has been sent, to store
+        with a message in `shard`.
+
+        Unless other processes send broadcasts too, the ID is kept in memory,
+        so that a send touches only the shard that it is stored in. Otherwise,
+        it is read from the main database: return None if the message is
+        stored there, so that it is read in the same transaction.
+        """
+        if not self.shared:
+            return self.broadcast_seq
+        if shard is self.shards[0]:
+            return None
+        with self.pool.connection() as db:
+            return self._get_broadcast_seq(db.cursor())
+
+    @staticmethod
+    def _get_broadcast_seq(cursor):
+        # The ID of the last broadcast is read from sqlite_sequence rather
+        # than the broadcasts table, since every broadcast may have been
+        # cleaned up, but the sequence number of the next message must not go
+        # backwards.
+        cursor.execute(
+            '''
+            SELECT COALESCE(MAX(seq), 0) FROM sqlite_sequence
+                WHERE name='broadcasts';
+            '''
+        )
+        return cursor.fetchone()[0]
+
+    @timed
+    def create_broadcast(self, sender_id, message):
+        """Store a message for every registered user in a single row."""
+        timestamp = datetime.datetime.utcnow().isoformat() + 'Z'
+        broadcast_id = self.write(
+            self._create_broadcast, timestamp, sender_id, message
+        )
+        # Before the sender hears of it, so that any message sent afterwards
+        # is received after the broadcast.
+        with self.broadcast_seq_lock:
+            self.broadcast_seq = max(self.broadcast_seq, broadcast_id)
+        self.notifier.notify_all()
+        return broadcast_id
+
+    @staticmethod
+    def _create_broadcast(cursor, timestamp, sender_id, message):
+        cursor.execute(
+            '''
+            INSERT INTO broadcasts (timestamp, source_id, body)
+            VALUES (?, ?, ?);
+            ''',
+            (timestamp, sender_id, message)
+        )
+        broadcast_id = cursor.lastrowid
+        # Now is a good time to clean up the broadcasts that every user has
+        # already received.
+        cursor.execute(
+            '''
+            DELETE FROM broadcasts WHERE broadcast_id <= (
+                SELECT MIN(broadcast_cursor) FROM users
+            );
+            '''
+        )
+        return broadcast_id
+
+    @timed
+    def create_user(self, username, password):
+        user_id = self.write(self._create_user, username, password)
+        if user_id is not None:
+            self.users.add(username, user_id)
+        return user_id
+
+    @staticmethod
+    def _create_user(cursor, username, password):
+        # NOTE: Storing plaintext passwords is a terrible idea, but this
+        # project is not designed to be cryptographically secure.
+        # New users do not receive broadcasts that were sent before they
+        # registered.
+        cursor.execute(
+            '''
+            INSERT INTO users (username, password, broadcast_cursor)
+            SELECT ?, ?, (
+                SELECT COALESCE(MAX(seq), 0) FROM sqlite_sequence
+                    WHERE name='broadcasts'
+            )
+            WHERE NOT EXISTS (SELECT 1 FROM users WHERE username=?);
+            ''',
+            (username, password, username)
+        )
+        return cursor.lastrowid if cursor.rowcount == 1 else None
+
+    @timed
+    def create_group(self, name, owner_id):
+        return self.write(self._create_group, name, owner_id)
+
+    @staticmethod
+    def _create_group(cursor, name, owner_id):
+        cursor.execute(
+            'INSERT OR IGNORE INTO groups (name, owner_id) VALUES (?, ?);',
+            (name, owner_id)
+        )
+        if cursor.rowcount != 1:
+            return None
+        group_id = cursor.lastrowid
+        cursor.execute(
+            'INSERT INTO group_members (group_id, user_id) VALUES (?, ?);',
+            (group_id, owner_id)
+        )
+        return group_id
+
+    @timed
+    def get_group_id(self, name):
+        with self.pool.connection() as db:
+            row = db.execute(
+                'SELECT group_id FROM groups WHERE name=?;', (name,)
+            ).fetchone()
+        return row[0] if row else None
+
+    @timed
+    def get_group_members(self, group_id):
+        with self.pool.connection() as db:
+            return [
+                row[0] for row in db.execute(
+                    'SELECT user_id FROM group_members WHERE group_id=?;',
+                    (group_id,)
+                )
+            ]
+
+    @timed
+    def add_group_member(self, group_id, user_id):
+        self.write(self._add_group_member, group_id, user_id)
+
+    @staticmethod
+    def _add_group_member(cursor, group_id, user_id):
+        cursor.execute(
+            '''
+            INSERT OR IGNORE INTO group_members (group_id, user_id)
+            VALUES (?, ?);
+            ''',
+            (group_id, user_id)
+        )
+
+    @timed
+    def remove_group_member(self, group_id, user_id):
+        return self.write(self._remove_group_member, group_id, user_id)
+
+    @staticmethod
+    def _remove_group_member(cursor, group_id, user_id):
+        cursor.execute(
+            'DELETE FROM group_members WHERE group_id=? AND user_id=?;',
+            (group_id, user_id)
+        )
+        return cursor.rowcount == 1
+
+    @timed
+    def get_filenames(self):
+        with self.pool.connection() as db:
+            return [
+                row[0] for row in db.execute('SELECT filename FROM files;')
+            ]
+
+    @timed
+    def get_files_version(self):
+        with self.pool.connection() as db:
+            return db.execute(
+                'SELECT COALESCE(MAX(file_id), 0) FROM files;'
+            ).fetchone()[0]
+
+    @timed
+    def get_file_blob(self, filename):
+        with self.pool.connection() as db:
+            row = db.execute(
+                'SELECT blob FROM files WHERE filename=?;', (filename,)
+            ).fetchone()
+        return row[0] if row else None
+
+    @timed
+    def create_file(self, filename, blob):
+        return self.write(self._create_file, filename, blob)
+
+    @staticmethod
+    def _create_file(cursor, filename, blob):
+        cursor.execute(
+            'INSERT OR IGNORE INTO files (filename, blob) VALUES (?, ?);',
+            (filename, blob)
+        )
+        return cursor.lastrowid if cursor.rowcount == 1 else None
+
+    @timed
+    def take_messages(self, recipient_id, limit=None):
+        """The messages are read and deleted in the same transaction, so a
+        message that arrives in the meantime is left for the next call. If
+        the user's inbox is not in the main database, the broadcasts and the
+        direct messages are taken in a transaction each.
+        """
+        if self.recv_limit is not None:
+            limit = min(limit or self.recv_limit, self.recv_limit)
+        shard = self.shard_for(recipient_id)
+        if shard is not self.shards[0]:
+            return self.take_from_shard(shard, recipient_id, limit)
+        if not self.has_messages(recipient_id):
+            # Save a write transaction in the common case.
+            return []
+        return self.write(self._take_messages, recipient_id, limit)
+
+    def take_from_shard(self, shard, recipient_id, limit):
+        # Which broadcasts are among the first `limit` messages depends on the
+        # broadcast_seq of the direct messages ahead of them. If the user
+        # receives on two connections at once, messages may be delivered out
+        # of order, but never twice.
+        with shard.pool.connection() as db:
+            seqs = [
+                row[0] for row in db.execute(
+                    '''
+                    SELECT broadcast_seq FROM messages WHERE inbox_id=?
+                        ORDER BY message_id LIMIT ?;
+                    ''',
+                    (recipient_id, -1 if limit is None else limit)
+                )
+            ]
+        broadcasts = []
+        if self.has_broadcasts(recipient_id):
+            broadcasts = self.write(
+                self._take_broadcasts, recipient_id, limit, seqs
+            )
+        if limit is not None:
+            limit -= len(broadcasts)
+        direct_messages = []
+        if seqs and limit != 0:
+            direct_messages = shard.write(
+                self._take_direct_messages, recipient_id, limit
+            )
+
+        inbox = [
+            (broadcast_id, 0, broadcast_id, timestamp, sender, '*', body)
+            for broadcast_id, timestamp, sender, body in broadcasts
+        ]
+        inbox.extend(
+            (seq, 1, message_id, timestamp, self.get_username(sender_id),
+                destination, body)
+            for seq, message_id, timestamp, sender_id, destination, body
+            in direct_messages
+        )
+        inbox.sort()
+        return [message[3:] for message in inbox]
+
+    def has_broadcasts(self, recipient_id):
+        with self.pool.connection() as db:
+            row = db.execute(
+                '''
+                SELECT EXISTS (
+                    SELECT 1 FROM broadcasts WHERE broadcast_id > (
+                        SELECT broadcast_cursor FROM users WHERE user_id=?
+                    )
+                );
+                ''',
+                (recipient_id,)
+            ).fetchone()
+        return bool(row[0])
+
+    def has_messages(self, recipient_id):
+        with self.pool.connection() as db:
+            row = db.execute(
+                '''
+                SELECT EXISTS (SELECT 1 FROM messages WHERE inbox_id=?)
+                    OR EXISTS (
+                        SELECT 1 FROM broadcasts WHERE broadcast_id > (
+                            SELECT broadcast_cursor FROM users WHERE user_id=?
+                        )
+                    );
+                ''',
+                (recipient_id, recipient_id)
+            ).fetchone()
+        return bool(row[0])
+
+    @staticmethod
+    def _take_messages(cursor, recipient_id, limit):
+        # Direct messages are ordered after every broadcast that was sent
+        # before them (see the comments in test/createdb.py). A negative limit
+        # means no limit to SQLite.
+        cursor.execute(
+            '''
+            SELECT inbox.timestamp, users.username, inbox.destination,
+                inbox.body, inbox.kind, inbox.id, inbox.body_id FROM (
+                    SELECT m.timestamp, m.source_id,
+                        COALESCE(b.destination, m.destination) AS destination,
+                        COALESCE(b.body, m.body) AS body,
+                        m.broadcast_seq AS seq, 1 AS kind, m.message_id AS id,
+                        m.body_id AS body_id
+                        FROM messages AS m
+                        LEFT JOIN message_bodies AS b ON b.body_id=m.body_id
+                        WHERE m.inbox_id=?
+                    UNION ALL
+                    SELECT timestamp, source_id, '*', body,
+                        broadcast_id, 0, broadcast_id, NULL
+                        FROM broadcasts WHERE broadcast_id > (
+                            SELECT broadcast_cursor FROM users
+                                WHERE user_id=?
+                        )
+                ) AS inbox
+                INNER JOIN users ON users.user_id=inbox.source_id
+                ORDER BY inbox.seq, inbox.kind, inbox.id
+                LIMIT ?;
+            ''',
+            (recipient_id, recipient_id, -1 if limit is None else limit)
+        )
+
+        messages = []
+        last_message_id = None
+        last_broadcast_id = None
+        body_ids = set()
+        while True:
+            rows = cursor.fetchmany(RECV_FETCH_SIZE)
+            if not rows:
+                break
+            for row in rows:
+                timestamp, sender, destination, body, kind, id, body_id = row
+                messages.append((timestamp, sender, destination, body))
+                if kind == 1:
+                    last_message_id = id
+                else:
+                    last_broadcast_id = id
+                if body_id is not None:
+                    body_ids.add(body_id)
+
+        # Message IDs and broadcast sequence numbers both only go up, so the
+        # direct messages that were delivered are exactly those up to the last
+        # one, and likewise for broadcasts.
+        if last_message_id is not None:
+            cursor.execute(
+                'DELETE FROM messages WHERE inbox_id=? AND message_id<=?;',
+                (recipient_id, last_message_id)
+            )
+        # A shared body is deleted along with the last inbox row that
+        # points to it.
+        StorageLayer._delete_bodies(cursor, body_ids)
+        if last_broadcast_id is not None:
+            cursor.execute(
+                '''
+                UPDATE users SET broadcast_cursor=MAX(broadcast_cursor, ?)
+                    WHERE user_id=?;
+                ''',
+                (last_broadcast_id, recipient_id)
+            )
+        return messages
+
+    @staticmethod
+    def _take_broadcasts(cursor, recipient_id, limit, seqs):
+        # `seqs` are the broadcast_seq of the first direct messages in the
+        # user's inbox. A broadcast goes after those whose broadcast_seq is
+        # less than its ID.
+        cursor.execute(
+            '''
+            SELECT broadcasts.broadcast_id, broadcasts.timestamp,
+                users.username, broadcasts.body
+                FROM broadcasts
+                INNER JOIN users ON users.user_id=broadcasts.source_id
+                WHERE broadcasts.broadcast_id > (
+                    SELECT broadcast_cursor FROM users WHERE user_id=?
+                )
+                ORDER BY broadcasts.broadcast_id
+                LIMIT ?;
+            ''',
+            (recipient_id, -1 if limit is None else limit)
+        )
+        broadcasts = []
+        ahead = 0
+        for row in cursor.fetchall():
+            while ahead < len(seqs) and seqs[ahead] < row[0]:
+                ahead += 1
+            if limit is not None and ahead + len(broadcasts) >= limit:
+                break
+            broadcasts.append(row)
+        if broadcasts:
+            cursor.execute(
+                '''
+                UPDATE users SET broadcast_cursor=MAX(broadcast_cursor, ?)
+                    WHERE user_id=?;
+                ''',
+                (broadcasts[-1][0], recipient_id)
+            )
+        return broadcasts
+
+    @staticmethod
+    def _take_direct_messages(cursor, recipient_id, limit):
+        cursor.execute(
+            '''
+            SELECT m.broadcast_seq, m.message_id, m.timestamp, m.source_id,
+                COALESCE(b.destination, m.destination),
+                COALESCE(b.body, m.body), m.body_id
+                FROM messages AS m
+                LEFT JOIN message_bodies AS b ON b.body_id=m.body_id
+                WHERE m.inbox_id=?
+                ORDER BY m.message_id
+                LIMIT ?;
+            ''',
+            (recipient_id, -1 if limit is None else limit)
+        )
+        rows = cursor.fetchall()
+        if rows:
+            cursor.execute(
+                'DELETE FROM messages WHERE inbox_id=? AND message_id<=?;',
+                (recipient_id, rows[-1][1])
+            )
+            StorageLayer._delete_bodies(
+                cursor, {row[6] for row in rows if row[6] is not None}
+            )
+        return [row[:6] for row in rows]
+
+    @staticmethod
+    def _delete_bodies(cursor, body_ids):
+        """Delete the shared message bodies with the given IDs that no inbox
+        points to any more.
+        """
+        cursor.executemany(
+            '''
+            DELETE FROM message_bodies WHERE body_id=? AND NOT EXISTS (
+                SELECT 1 FROM messages WHERE body_id=?
+            );
+            ''',
+            ((body_id, body_id) for body_id in body_ids)
+        )
+
+    @timed
+    def expire_messages(self, cutoff, batch_size):
+        """Each shard deletes a batch of its own."""
+        return sum(
+            shard.write(
+                self._expire, 'messages', 'message_id', cutoff, batch_size
+            )
+            for shard in self.shards
+        )
+
+    @timed
+    def expire_broadcasts(self, cutoff, batch_size):
+        return self.write(
+            self._expire, 'broadcasts', 'broadcast_id', cutoff, batch_size
+        )
+
+    @staticmethod
+    def _expire(cursor, table, key, cutoff, batch_size):
+        # IDs and timestamps go up together, so the expired rows are a prefix
+        # of the table in ID order, which can be read off the primary key
+        # without scanning the whole table for old timestamps.
+        cursor.execute(
+            '''
+            SELECT MAX({key}) FROM (
+                SELECT {key}, timestamp FROM {table} ORDER BY {key} LIMIT ?
+            ) WHERE timestamp < ?;
+            '''.format(table=table, key=key),
+            (batch_size, cutoff)
+        )
+        last_id = cursor.fetchone()[0]
+        if last_id is None:
+            return 0
+        cursor.execute(
+            'DELETE FROM {table} WHERE {key}<=?;'.format(table=table, key=key),
+            (last_id,)
+        )
+        return cursor.rowcount
+
+    @timed
+    def delete_orphan_bodies(self, batch_size):
+        """Each shard deletes a batch of its own."""
+        return sum(
+            shard.write(self._delete_orphan_bodies, batch_size)
+            for shard in self.shards
+        )
+
+    @staticmethod
+    def _delete_orphan_bodies(cursor, batch_size):
+        cursor.execute(
+            '''
+            DELETE FROM message_bodies WHERE body_id IN (
+                SELECT body_id FROM message_bodies AS b WHERE NOT EXISTS (
+                    SELECT 1 FROM messages WHERE body_id=b.body_id
+                ) LIMIT ?
+            );
+            ''',
+            (batch_size,)
+        )
+        return cursor.rowcount
+
+    @timed
+    def get_full_inboxes(self, cap):
+        inbox_ids = []
+        for shard in self.shards:
+            with shard.pool.connection() as db:
+                inbox_ids.extend(
+                    row[0] for row in db.execute(
+                        '''
+                        SELECT inbox_id FROM messages GROUP BY inbox_id
+                            HAVING COUNT(*) > ?;
+                        ''',
+                        (cap,)
+                    )
+                )
+        return inbox_ids
+
+    @timed
+    def trim_inbox(self, inbox_id, cap, batch_size):
+        return self.shard_for(inbox_id).write(
+            self._trim_inbox, inbox_id, cap, batch_size
+        )
+
+    @staticmethod
+    def _trim_inbox(cursor, inbox_id, cap, batch_size):
+        cursor.execute(
+            '''
+            DELETE FROM messages WHERE message_id IN (
+                SELECT message_id FROM messages
+                    WHERE inbox_id=? AND message_id <= (
+                        SELECT message_id FROM messages WHERE inbox_id=?
+                            ORDER BY message_id DESC LIMIT 1 OFFSET ?
+                    )
+                    ORDER BY message_id LIMIT ?
+            );
+            ''',
+            (inbox_id, inbox_id, cap, batch_size)
+        )
+        return cursor.rowcount
+
+    def compact(self, stopping):
+        """Return the free pages of each shard to the file system, and
+        truncate its write-ahead log.
+        """
+        for shard in self.shards:
+            # A connection of its own, for the pragmas that cannot run in a
+            # transaction.
+            db = shard.pool.connect()
+            try:
+                # 2 is INCREMENTAL. The other shards are always created with
+                # it.
+                if db.execute('PRAGMA auto_vacuum;').fetchone()[0] != 2:
+                    if not self.warned_about_vacuum:
+                        logger.warning(
+                            'The database file will not shrink as messages '
+                            'expire, since it does not have '
+                            'auto_vacuum=INCREMENTAL (set it and run VACUUM '
+                            'while the server is stopped)'
+                        )
+                        self.warned_about_vacuum = True
+                    continue
+                self.compact_shard(db, stopping)
+            finally:
+                db.close()
+
+    @staticmethod
+    def compact_shard(db, stopping):
+        # Each incremental vacuum holds the write lock only briefly.
+        while not stopping.is_set():
+            if db.execute('PRAGMA freelist_count;').fetchone()[0] == 0:
+                break
+            db.execute(
+                'PRAGMA incremental_vacuum({:d});'.format(VACUUM_PAGES)
+            ).fetchall()
+            stopping.wait(MAINTENANCE_PAUSE)
+        # A passive checkpoint copies what it can without blocking anybody, so
+        # that the truncating one, which does block writers, has little left
+        # to do.
+        db.execute('PRAGMA wal_checkpoint(PASSIVE);').fetchall()
+        db.execute('PRAGMA wal_checkpoint(TRUNCATE);').fetchall()
+
+    def write(self, f, *args):
+        """Call f(cursor, *args) to modify the main database; see
+        MessageShard.write.
+        """
+        return self.shards[0].write(f, *args)
+
+    def close(self):
+        for shard in self.shards:
+            shard.pool.close()
+
+
+class MessageShard:
+    """One of the database files that the messages table is partitioned
+    across, and the StorageWriter that commits to it, if any.
+    """
+
+    def __init__(self, pool, writer=None):
+        self.pool = pool
+        self.writer = writer
+
+    def write(self, f, *args):
+        """Call f(cursor, *args) to modify the database and return its result
+        once the change has been committed.
+
+        If the shard has a StorageWriter, the change is committed in a batch
+        with writes from other connections.
+        """
+        if self.writer is not None:
+            return self.writer.submit(f, *args)
+
+        with self.pool.connection() as db:
+            cursor = db.cursor()
+            cursor.execute('BEGIN IMMEDIATE;')
+            try:
+                result = f(cursor, *args)
+            except Exception:
+                cursor.execute('ROLLBACK;')
+                raise
+            cursor.execute('COMMIT;')
+            return result
+
+
+def shard_path(path_to_db, index):
+    """Return the path of the index-th shard of the messages table, where the
+    0th is the main database.
+    """
+    if index == 0:
+        return path_to_db
+    return '{}-shard{:d}'.format(path_to_db, index)
+
+
+def create_shard_schema(db):
+    """Create the tables of a shard other than the main database, which holds
+    just the messages of some inboxes.
+
+    Rows in a shard cannot refer to the users table of the main database, so
+    unlike in test/createdb.py, there are no foreign keys.
+    """
+    # Must come before any table is created; see test/createdb.py.
+    db.execute('PRAGMA auto_vacuum=INCREMENTAL;')
+    db.execute('''
+        CREATE TABLE IF NOT EXISTS messages (
+            message_id INTEGER PRIMARY KEY,
+            timestamp varchar(25) NOT NULL,
+            source_id INTEGER NOT NULL,
+            destination varchar(30) NOT NULL,
+            inbox_id INTEGER NOT NULL,
+            body varchar(256) NOT NULL,
+            broadcast_seq INTEGER NOT NULL DEFAULT 0,
+            body_id INTEGER
+        );
+    ''')
+    db.execute('''
+        CREATE TABLE IF NOT EXISTS message_bodies (
+            body_id INTEGER PRIMARY KEY,
+            destination varchar(30) NOT NULL,
+            body varchar(256) NOT NULL
+        );
+    ''')
+    db.execute('''
+        CREATE INDEX IF NOT EXISTS messages_inbox
+            ON messages (inbox_id, message_id);
+    ''')
+    db.execute('''
+        CREATE INDEX IF NOT EXISTS messages_body ON messages (body_id)
+            WHERE body_id IS NOT NULL;
+    ''')
+
+
+def rebalance_shard(db, index, shards):
+    """Move the messages in the index-th shard whose inboxes belong in another
+    one to it, where `shards` are connections to every shard in use, and
+    return how many were moved.
+
+    The messages are copied before they are deleted, so if the server is
+    stopped halfway, some of them may be delivered twice, but none is lost.
+    Shared bodies are copied into the messages that point to them.
+    """
+    moved = 0
+    while True:
+        rows = db.execute(
+            '''
+            SELECT m.message_id, m.timestamp, m.source_id,
+                COALESCE(b.destination, m.destination), m.inbox_id,
+                COALESCE(b.body, m.body), m.broadcast_seq
+                FROM messages AS m
+                LEFT JOIN message_bodies AS b ON b.body_id=m.body_id
+                WHERE m.inbox_id % ? != ?
+                ORDER BY m.message_id
+                LIMIT ?;
+            ''',
+            (len(shards), index, MAINTENANCE_BATCH_SIZE)
+        ).fetchall()
+        if not rows:
+            break
+
+        by_shard = {}
+        for row in rows:
+            by_shard.setdefault(row[4] % len(shards), []).append(row[1:])
+        for target, messages in by_shard.items():
+            shards[target].execute('BEGIN IMMEDIATE;')
+            shards[target].executemany(
+                '''
+                INSERT INTO messages (timestamp, source_id, destination,
+                    inbox_id, body, broadcast_seq)
+                VALUES (?, ?, ?, ?, ?, ?);
+                ''',
+                messages
+            )
+            shards[target].execute('COMMIT;')
+
+        db.execute(
+            '''
+            DELETE FROM messages WHERE message_id<=? AND inbox_id % ? != ?;
+            ''',
+            (rows[-1][0], len(shards), index)
+        )
+        moved += len(rows)
+
+    if moved:
+        db.execute(
+            '''
+            DELETE FROM message_bodies WHERE NOT EXISTS (
+                SELECT 1 FROM messages
+                    WHERE messages.body_id=message_bodies.body_id
+            );
+            '''
+        )
+        logger.info('Moved %d messages out of shard %d', moved, index)
+    return moved
+
+
+def migrate_database(db):
+    """Bring the schema of the database up to date, using SQLite's user_version
+    pragma to record which migrations have already been applied.
+
+    `db` must be in autocommit mode. Each migration runs in its own
+    transaction.
+    """
+    version = db.execute('PRAGMA user_version;').fetchone()[0]
+    for new_version, migration in enumerate(MIGRATIONS[version:], version + 1):
+        logger.info('Migrating database to version %d', new_version)
+        cursor = db.cursor()
+        cursor.execute('BEGIN IMMEDIATE;')
+        try:
+            migration(cursor)
+            cursor.execute('PRAGMA user_version={:d};'.format(new_version))
+        except Exception:
+            cursor.execute('ROLLBACK;')
+            raise
+        cursor.execute('COMMIT;')
+
+
+# Migrations must be idempotent, because test/createdb.py creates the latest
+# schema directly.
+
+def migrate_to_broadcasts_table(cursor):
+    """Store broadcasts once instead of once per inbox."""
+    if not column_exists(cursor, 'users', 'broadcast_cursor'):
+        cursor.execute('''
+            ALTER TABLE users
+                ADD COLUMN broadcast_cursor INTEGER NOT NULL DEFAULT 0;
+        ''')
+    if not column_exists(cursor, 'messages', 'broadcast_seq'):
+        cursor.execute('''
+            ALTER TABLE messages
+                ADD COLUMN broadcast_seq INTEGER NOT NULL DEFAULT 0;
+        ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS broadcasts (
+            broadcast_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            timestamp varchar(25) NOT NULL,
+            source_id INTEGER NOT NULL,
+            body varchar(256) NOT NULL,
+            FOREIGN KEY (source_id) REFERENCES users (user_id)
+                ON UPDATE CASCADE ON DELETE CASCADE
+        );
+    ''')
+
+
+def migrate_to_indexes(cursor):
+    """Index the columns that logins and inbox queries filter on."""
+    cursor.execute(
+        'CREATE INDEX IF NOT EXISTS users_username ON users (username);'
+    )
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS messages_inbox
+            ON messages (inbox_id, message_id);
+    ''')
+
+
+def migrate_to_files_table(cursor):
+    """Add the table that maps filenames to blobs in DedupFileStore."""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS files (
+            file_id INTEGER PRIMARY KEY,
+            filename varchar(255) NOT NULL UNIQUE,
+            blob varchar(64) NOT NULL
+        );
+    ''')
+
+
+def migrate_to_shared_messages(cursor):
+    """Store the body of a message to several recipients once, and add named
+    groups of users.
+    """
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS message_bodies (
+            body_id INTEGER PRIMARY KEY,
+            destination varchar(30) NOT NULL,
+            body varchar(256) NOT NULL
+        );
+    ''')
+    if not column_exists(cursor, 'messages', 'body_id'):
+        cursor.execute('''
+            ALTER TABLE messages ADD COLUMN body_id INTEGER
+                REFERENCES message_bodies (body_id);
+        ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS messages_body ON messages (body_id)
+            WHERE body_id IS NOT NULL;
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS groups (
+            group_id INTEGER PRIMARY KEY,
+            name varchar(30) NOT NULL UNIQUE,
+            owner_id INTEGER NOT NULL,
+            FOREIGN KEY (owner_id) REFERENCES users (user_id)
+                ON UPDATE CASCADE ON DELETE CASCADE
+        );
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS group_members (
+            group_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            PRIMARY KEY (group_id, user_id),
+            FOREIGN KEY (group_id) REFERENCES groups (group_id)
+                ON UPDATE CASCADE ON DELETE CASCADE,
+            FOREIGN KEY (user_id) REFERENCES users (user_id)
+                ON UPDATE CASCADE ON DELETE CASCADE
+        ) WITHOUT ROWID;
+    ''')
+
+
+def column_exists(cursor, table, column):
+    cursor.execute('PRAGMA table_info({});'.format(table))
+    return any(row[1] == column for row in cursor.fetchall())
+
+
+# Migration number i (counting from 1) upgrades the database from version i-1
+# to version i.
+MIGRATIONS = [
+    migrate_to_broadcasts_table,
+    migrate_to_indexes,
+    migrate_to_files_table,
+    migrate_to_shared_messages,
+]
+
+
+class UserDirectory:
+    """An in-memory copy of the mapping from usernames to user IDs, and back.
+
+    Users are never renamed or deleted, so once the directory has been loaded
+    from the database, the only updates it needs are the users created through
+    StorageLayer.create_user and, when several processes share the database,
+    the users that StorageLayer finds in the database after a miss.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.ids = {}
+        self.names = {}
+
+    def load(self, rows):
+        """Load the directory from an iterable of (username, user_id) pairs."""
+        with self.lock:
+            self.ids = dict(rows)
+            self.names = {
+                user_id: username for username, user_id in self.ids.items()
+            }
+
+    def get(self, username):
+        with self.lock:
+            return self.ids.get(username)
+
+    def get_name(self, user_id):
+        with self.lock:
+            return self.names.get(user_id)
+
+    def add(self, username, user_id):
+        with self.lock:
+            self.ids[username] = user_id
+            self.names[user_id] = username
+
+
+class InboxNotifier:
+    """Wakes up the connections that are waiting in `recv wait` when a message
+    arrives for their user.
+
+    Only the messages stored by this process are announced. If other processes
+    share the database, `poll_interval` is the number of seconds after which
+    waiting connections should check their inboxes anyway.
+    """
+
+    def __init__(self, poll_interval=None):
+        self.poll_interval = poll_interval
+        self.lock = threading.Lock()
+        # Maps user IDs to sets of functions to call with no arguments when a
+        # message arrives for the user.
+        self.waiters = {}
+
+    def subscribe(self, uid, callback):
+        with self.lock:
+            self.waiters.setdefault(uid, set()).add(callback)
+
+    def unsubscribe(self, uid, callback):
+        with self.lock:
+            callbacks = self.waiters.get(uid)
+            if callbacks is not None:
+                callbacks.discard(callback)
+                if not callbacks:
+                    del self.waiters[uid]
+
+    def notify(self, uid):
+        if not self.waiters:
+            # Save taking the lock when nobody is waiting.
+            return
+        with self.lock:
+            callbacks = list(self.waiters.get(uid, ()))
+        for callback in callbacks:
+            callback()
+
+    def notify_all(self):
+        with self.lock:
+            callbacks = [
+                callback for callbacks in self.waiters.values()
+                for callback in callbacks
+            ]
+        for callback in callbacks:
+            callback()
+
+
+class ConnectionPool:
+    """A bounded pool of SQLite connections, shared by every connection to the
+    server.
+
+    Connections are opened lazily, up to `size` of them, after which a thread
+    that wants a connection waits for another thread to return one. Every
+    connection is in autocommit mode, so callers that write to the database
+    must manage their own transactions.
+
+    The database is put in write-ahead logging mode, so that readers do not
+    block the writer and vice versa.
+    """
+
+    def __init__(self, path_to_db, size=8, synchronous='FULL', cache_size=8192,
+            mmap_size=268435456, cached_statements=256):
+        self.path_to_db = path_to_db
+        self.size = size
+        self.synchronous = synchronous
+        # In kibibytes, per connection.
+        self.cache_size = cache_size
+        # In bytes.
+        self.mmap_size = mmap_size
+        # Size of each connection's cache of prepared statements.
+        self.cached_statements = cached_statements
+
+        self.idle = queue.LifoQueue()
+        self.lock = threading.Lock()
+        self.nopen = 0
+        self.all_connections = []
+
+    def connect(self):
+        """Open and configure a new connection that is not part of the pool."""
+        db = sqlite3.connect(
+            self.path_to_db,
+            isolation_level=None,
+            check_same_thread=False,
+            cached_statements=self.cached_statements,
+        )
+        db.execute('PRAGMA journal_mode=WAL;')
+        db.execute('PRAGMA synchronous={};'.format(self.synchronous))
+        db.execute('PRAGMA cache_size=-{:d};'.format(self.cache_size))
+        db.execute('PRAGMA mmap_size={:d};'.format(self.mmap_size))
+        return db
+
+    @contextlib.contextmanager
+    def connection(self):
+        """Borrow a connection from the pool for the duration of a with
+        statement.
+        """
+        db = self.acquire()
+        try:
+            yield db
+        finally:
+            if db.in_transaction:
+                db.rollback()
+            self.idle.put(db)
+
+    def acquire(self):
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self.lock:
+            if self.nopen < self.size:
+                self.nopen += 1
+                open_new = True
+            else:
+                open_new = False
+
+        if not open_new:
+            return self.idle.get()
+
+        try:
+            db = self.connect()
+        except Exception:
+            with self.lock:
+                self.nopen -= 1
+            raise
+
+        with self.lock:
+            self.all_connections.append(db)
+        return db
+
+    def close(self):
+        for db in self.all_connections:
+            db.close()
+
+
+class StorageWriter(threading.Thread):
+    """A single thread that applies the writes of every connection to the
+    database.
+
+    Writes are collected from a queue and committed together in one
+    transaction ("group commit"), so that many concurrent senders share the
+    cost of each fsync. A batch is committed once `batch_size` writes have been
+    collected or `window` seconds have passed since the first one, whichever
+    comes first. With a window of zero, the writer commits as soon as the queue
+    is empty, which still batches together the writes that arrive while the
+    previous commit is in progress.
+    """
+
+    def __init__(self, pool, window=0.0, batch_size=256):
+        super().__init__(name='StorageWriter', daemon=True)
+        self.pool = pool
+        self.window = window
+        self.batch_size = batch_size
+        self.queue = queue.Queue()
+
+    def submit(self, f, *args):
+        """Queue f(cursor, *args) to be run in the next batch, and block until
+        the batch has been committed. Return the result of f or raise the
+        exception that it raised.
+        """
+        write = PendingWrite(f, args)
+        self.queue.put(write)
+        write.done.wait()
+        if write.error is not None:
+            raise write.error
+        return write.result
+
+    def run(self):
+        # The writer has a connection of its own rather than one from the pool,
+        # so that it never has to wait for a reader to return one.
+        db = self.pool.connect()
+        cursor = db.cursor()
+        while True:
+            batch = self.collect_batch()
+            try:
+                if profiler.active:
+                    profiler.run(self.commit_batch, db, cursor, batch)
+                else:
+                    self.commit_batch(db, cursor, batch)
+            finally:
+                # Whatever happens, the submitters must not wait forever.
+                for write in batch:
+                    write.done.set()
+
+    def collect_batch(self):
+        batch = [self.queue.get()]
+        deadline = time.monotonic() + self.window
+        while len(batch) < self.batch_size:
+            try:
+                timeout = deadline - time.monotonic()
+                if timeout > 0:
+                    batch.append(self.queue.get(timeout=timeout))
+                else:
+                    batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def commit_batch(self, db, cursor, batch):
+        try:
+            cursor.execute('BEGIN IMMEDIATE;')
+            for write in batch:
+                # A savepoint around each write means that one failed write
+                # doesn't roll back the rest of the batch.
+                cursor.execute('SAVEPOINT write;')
+                try:
+                    write.result = write.f(cursor, *write.args)
+                except Exception as e:
+                    # Not only SQLite errors: any exception that escaped would
+                    # kill the thread, and leave every later write waiting.
+                    cursor.execute('ROLLBACK TO write;')
+                    write.error = e
+                cursor.execute('RELEASE write;')
+            cursor.execute('COMMIT;')
+        except Exception as e:
+            logger.error('Could not commit batch of %d writes: %s',
+                len(batch), e)
+            for write in batch:
+                write.error = e
+            try:
+                if db.in_transaction:
+                    cursor.execute('ROLLBACK;')
+            except sqlite3.Error as e:
+                logger.error('Could not roll back batch: %s', e)
+
+
+class PendingWrite:
+    """A write that has been submitted to a StorageWriter or AppendLog."""
+
+    def __init__(self, f, args):
+        self.f = f
+        self.args = args
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class AppendLog(StorageWriter):
+    """The log of a MemLogStorage: a single thread that appends the changes to
+    the current log file, and with `sync`, fsyncs them, in batches as the
+    StorageWriter commits to SQLite.
+
+    The log files are numbered, so that a snapshot can tell which of them it
+    makes redundant. `segment` is the number of the first one to write to.
+    """
+
+    def __init__(self, path, segment, sync=True, window=0.0, batch_size=256):
+        super().__init__(None, window, batch_size)
+        self.name = 'AppendLog'
+        self.path = path
+        self.segment = segment
+        self.sync = sync
+        self.file = open(log_segment_path(path, segment), 'ab')
+
+    def append(self, record):
+        """Queue a JSON-serializable record to be written, and return the
+        PendingWrite to wait on.
+        """
+        write = PendingWrite(None, record)
+        self.queue.put(write)
+        return write
+
+    def rotate(self):
+        """Start a new log file once the records appended so far have been
+        written. Return its number and the PendingWrite to wait on.
+        """
+        self.segment += 1
+        write = PendingWrite(self.open_segment, (self.segment,))
+        self.queue.put(write)
+        return self.segment, write
+
+    def stop(self):
+        """Close the log once the records appended so far have been written,
+        and wait for it.
+        """
+        write = PendingWrite(self.close_file, ())
+        self.queue.put(write)
+        write.done.wait()
+
+    def run(self):
+        while True:
+            batch = self.collect_batch()
+            if profiler.active:
+                profiler.run(self.commit_batch, batch)
+            else:
+                self.commit_batch(batch)
+            for write in batch:
+                write.done.set()
+
+    def commit_batch(self, batch):
+        lines = []
+        try:
+            for write in batch:
+                if write.f is None:
+                    lines.append(json.dumps(write.args).encode('utf-8'))
+                    lines.append(b'\n')
+                else:
+                    # The log files change between the records that were
+                    # appended before and after.
+                    self.write_lines(lines)
+                    lines = []
+                    write.result = write.f(*write.args)
+            self.write_lines(lines)
+        except (OSError, ValueError) as e:
+            logger.error('Could not write batch of %d changes to the log: %s',
+                len(batch), e)
+            for write in batch:
+                write.error = e
+
+    def write_lines(self, lines):
+        if lines:
+            self.file.write(b''.join(lines))
+            self.file.flush()
+            if self.sync:
+                os.fsync(self.file.fileno())
+
+    def open_segment(self, segment):
+        self.close_file()
+        self.file = open(log_segment_path(self.path, segment), 'ab')
+
+    def close_file(self):
+        if self.sync:
+            os.fsync(self.file.fileno())
+        self.file.close()
+
+
+def log_segment_path(path, segment):
+    return os.path.join(path, 'log.{:08d}'.format(segment))
+
+
+class MemLogStorage(StorageBackend):
+    """The storage backend that keeps everything in memory, and makes it
+    durable with an append-only log of the changes, in the directory `path`.
+
+    On startup, the state is loaded from the latest snapshot, and the changes
+    that were logged since then are replayed. A new snapshot is written every
+    `snapshot_interval` seconds if anything has changed, when the retention
+    policies have deleted messages, and when the storage is closed, after which
+    the log files that it covers are deleted. As with SQLite's synchronous
+    pragma, if `sync` is true, each change is fsynced before the call that made
+    it returns.
+
+    Since the state lives in the memory of one process, it cannot be shared
+    with other processes.
+    """
+
+    def __init__(self, path, recv_limit=RECV_LIMIT, sync=True,
+            snapshot_interval=SNAPSHOT_INTERVAL):
+        super().__init__(recv_limit)
+        self.path = path
+        self.sync = sync
+        self.snapshot_interval = snapshot_interval
+        self.log = None
+        self.stopping = threading.Event()
+        # Each change to the state is applied and appended to the log while
+        # the lock is held, so that the log has the changes in the order that
+        # they were made. See `record`.
+        self.lock = threading.Lock()
+        self.changed = False
+        self.snapshot_lock = threading.Lock()
+
+        self.user_ids = {}
+        self.usernames = {}
+        self.passwords = {}
+        self.last_user_id = 0
+        # The ID of the last broadcast that each user has received.
+        self.cursors = {}
+        # Maps user IDs to deques of (broadcast_seq, message) pairs, where the
+        # message is a (timestamp, sender, destination, body) tuple that is
+        # shared by all of its recipients, and broadcast_seq is the ID of the
+        # last broadcast that was sent before it.
+        self.inboxes = {}
+        # (broadcast_id, message) pairs. The IDs are consecutive, since
+        # broadcasts are only ever deleted from the front.
+        self.broadcasts = []
+        self.last_broadcast_id = 0
+        self.group_ids = {}
+        # Maps group IDs to dictionaries with their members' user IDs as keys,
+        # in the order they joined.
+        self.members = {}
+        self.last_group_id = 0
+        self.files = {}
+
+    def start(self):
+        os.makedirs(self.path, exist_ok=True)
+        start = time.perf_counter()
+        segment, nchanges = self.load()
+        logger.info('Loaded the state from %s and replayed %d changes in '
+            '%.3f s', self.path, nchanges, time.perf_counter() - start)
+        self.log = AppendLog(self.path, segment, self.sync)
+        self.log.start()
+        threading.Thread(
+            target=self.snapshot_forever, name='Snapshots', daemon=True
+        ).start()
+
+    def close(self):
+        self.stopping.set()
+        if self.log is not None:
+            if self.changed:
+                self.snapshot()
+            self.log.stop()
+
+    def compact(self, stopping):
+        """Write a snapshot, which leaves out the messages that have been
+        deleted, so that the log files can be deleted.
+        """
+        self.snapshot()
+
+    def load(self):
+        """Load the latest snapshot and replay the log files after it. Return
+        the number of the log file to write to next, and the number of changes
+        that were replayed.
+        """
+        first = 0
+        try:
+            with open(os.path.join(self.path, 'snapshot'), 'rb') as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            pass
+        else:
+            self.restore(state)
+            first = state['segment']
+
+        segments = sorted(
+            int(name[len('log.'):]) for name in os.listdir(self.path)
+            if name.startswith('log.') and name[len('log.'):].isdigit()
+        )
+        nchanges = 0
+        for segment in segments:
+            if segment < first:
+                continue
+            with open(log_segment_path(self.path, segment), 'rb') as f:
+                for line in f:
+                    if not line.endswith(b'\n'):
+                        # The server was stopped in the middle of a write,
+                        # which was never acknowledged.
+                        logger.warning('Ignoring the incomplete last change '
+                            'in log file %d', segment)
+                        break
+                    record = json.loads(line)
+                    self.APPLY[record[0]](self, *record[1:])
+                    nchanges += 1
+        # Start a new log file, rather than append to one that may end in an
+        # incomplete change.
+        return max(segments + [first]) + 1, nchanges
+
+    def record(self, *change):
+        """Apply a change to the state and append it to the log. The lock must
+        be held. Return the change's result, and the PendingWrite to wait on
+        once the lock has been released.
+        """
+        result = self.APPLY[change[0]](self, *change[1:])
+        self.changed = True
+        return result, self.log.append(change)
+
+    @staticmethod
+    def wait(write):
+        write.done.wait()
+        if write.error is not None:
+            raise write.error
+
+    def snapshot(self):
+        """Write the whole state to a new snapshot, and delete the log files
+        that it makes redundant.
+        """
+        with self.snapshot_lock:
+            self.write_snapshot()
+
+    def write_snapshot(self):
+        # Only copying the state holds the lock. Messages are immutable
+        # tuples, so they don't need to be copied.
+        with self.lock:
+            self.changed = False
+            state = {
+                'last_user_id': self.last_user_id,
+                'users': [
+                    (user_id, username, self.passwords[user_id],
+                        self.cursors[user_id])
+                    for username, user_id in self.user_ids.items()
+                ],
+                'inboxes': [
+                    (user_id, list(inbox))
+                    for user_id, inbox in self.inboxes.items()
+                ],
+                'broadcasts': list(self.broadcasts),
+                'last_broadcast_id': self.last_broadcast_id,
+                'groups': [
+                    (group_id, name, list(self.members[group_id]))
+                    for name, group_id in self.group_ids.items()
+                ],
+                'last_group_id': self.last_group_id,
+                'files': list(self.files.items()),
+            }
+            state['segment'], rotation = self.log.rotate()
+
+        # A message to several users is stored once, and referred to by its
+        # index in the list of bodies.
+        indexes = {}
+        bodies = []
+        inboxes = []
+        for user_id, inbox in state['inboxes']:
+            entries = []
+            for seq, message in inbox:
+                index = indexes.get(id(message))
+                if index is None:
+                    index = indexes[id(message)] = len(bodies)
+                    bodies.append(message)
+                entries.append((seq, index))
+            inboxes.append((user_id, entries))
+        state['inboxes'] = inboxes
+        state['bodies'] = bodies
+
+        path = os.path.join(self.path, 'snapshot')
+        with open(path + '.tmp', 'w') as f:
+            json.dump(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + '.tmp', path)
+        if hasattr(os, 'O_DIRECTORY'):
+            # Make the rename durable before the log files are deleted.
+            fd = os.open(self.path, os.O_RDONLY | os.O_DIRECTORY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+        self.wait(rotation)
+        for name in os.listdir(self.path):
+            if (name.startswith('log.') and name[len('log.'):].isdigit() and
+                    int(name[len('log.'):]) < state['segment']):
+                os.remove(os.path.join(self.path, name))
+
+    def restore(self, state):
+        self.last_user_id = state['last_user_id']
+        for user_id, username, password, cursor in state['users']:
+            self.user_ids[username] = user_id
+            self.usernames[user_id] = username
+            self.passwords[user_id] = password
+            self.cursors[user_id] = cursor
+        bodies = [tuple(message) for message in state['bodies']]
+        for user_id, inbox in state['inboxes']:
+            self.inboxes[user_id] = collections.deque(
+                (seq, bodies[index]) for seq, index in inbox
+            )
+        self.broadcasts = [
+            (broadcast_id, tuple(message))
+            for broadcast_id, message in state['broadcasts']
+        ]
+        self.last_broadcast_id = state['last_broadcast_id']
+        for group_id, name, members in state['groups']:
+            self.group_ids[name] = group_id
+            self.members[group_id] = dict.fromkeys(members)
+        self.last_group_id = state['last_group_id']
+        self.files = dict(state['files'])
+
+    def snapshot_forever(self):
+        while not self.stopping.wait(self.snapshot_interval):
+            if self.changed:
+                try:
+                    self.snapshot()
+                except OSError as e:
+                    logger.error('Could not write snapshot: %s', e)
+
+    @timed
+    def get_id_from_username(self, username):
+        with self.lock:
+            return self.user_ids.get(username)
+
+    @timed
+    def get_id_from_username_and_password(self, username, password):
+        with self.lock:
+            user_id = self.user_ids.get(username)
+            if user_id is not None and self.passwords[user_id] == password:
+                return user_id
+            return None
+
+    @timed
+    def create_user(self, username, password):
+        with self.lock:
+            if username in self.user_ids:
+                return None
+            user_id, write = self.record('user', username, password)
+        self.wait(write)
+        return user_id
+
+    def apply_user(self, username, password):
+        self.last_user_id += 1
+        user_id = self.last_user_id
+        self.user_ids[username] = user_id
+        self.usernames[user_id] = username
+        self.passwords[user_id] = password
+        # New users do not receive broadcasts that were sent before they
+        # registered.
+        self.cursors[user_id] = self.last_broadcast_id
+        return user_id
+
+    @timed
+    def create_message(self, sender_id, recipient, recipient_id, message):
+        self.create_shared_message(
+            sender_id, recipient, [recipient_id], message
+        )
+
+    @timed
+    def create_shared_message(self, sender_id, destination, recipient_ids,
+            message):
+        timestamp = datetime.datetime.utcnow().isoformat() + 'Z'
+        with self.lock:
+            _, write = self.record(
+                'message', timestamp, sender_id, destination,
+                list(recipient_ids), message
+            )
+        self.wait(write)
+        for recipient_id in recipient_ids:
+            self.notifier.notify(recipient_id)
+
+    def apply_message(self, timestamp, sender_id, destination, recipient_ids,
+            body):
+        message = (timestamp, self.usernames[sender_id], destination, body)
+        for recipient_id in recipient_ids:
+            inbox = self.inboxes.get(recipient_id)
+            if inbox is None:
+                inbox = self.inboxes[recipient_id] = collections.deque()
+            inbox.append((self.last_broadcast_id, message))
+
+    @timed
+    def create_broadcast(self, sender_id, message):
+        timestamp = datetime.datetime.utcnow().isoformat() + 'Z'
+        with self.lock:
+            broadcast_id, write = self.record(
+                'broadcast', timestamp, sender_id, message
+            )
+        self.wait(write)
+        self.notifier.notify_all()
+        return broadcast_id
+
+    def apply_broadcast(self, timestamp, sender_id, body):
+        self.last_broadcast_id += 1
+        self.broadcasts.append((
+            self.last_broadcast_id,
+            (timestamp, self.usernames[sender_id], '*', body)
+        ))
+        # As in StorageLayer, now is a good time to drop the broadcasts that
+        # every user has already received.
+        received = min(self.cursors.values())
+        ndelete = 0
+        while (ndelete < len(self.broadcasts) and
+                self.broadcasts[ndelete][0] <= received):
+            ndelete += 1
+        del self.broadcasts[:ndelete]
+        return self.last_broadcast_id
+
+    @timed
+    def take_messages(self, recipient_id, limit=None):
+        if self.recv_limit is not None:
+            limit = min(limit or self.recv_limit, self.recv_limit)
+        with self.lock:
+            # Merge the direct messages with the broadcasts that the user has
+            # not received yet. A broadcast goes before the direct messages
+            # that were sent after it.
+            direct_messages = iter(self.inboxes.get(recipient_id, ()))
+            direct = next(direct_messages, None)
+            if self.broadcasts:
+                index = max(
+                    self.cursors[recipient_id] + 1 - self.broadcasts[0][0], 0
+                )
+            else:
+                index = 0
+            messages = []
+            ndirect = 0
+            last_broadcast_id = None
+            while limit is None or len(messages) < limit:
+                if index < len(self.broadcasts) and (
+                        direct is None or
+                        self.broadcasts[index][0] <= direct[0]):
+                    last_broadcast_id, message = self.broadcasts[index]
+                    index += 1
+                elif direct is not None:
+                    message = direct[1]
+                    ndirect += 1
+                    direct = next(direct_messages, None)
+                else:
+                    break
+                messages.append(message)
+
+            if not messages:
+                return []
+            _, write = self.record(
+                'take', recipient_id, ndirect, last_broadcast_id
+            )
+        self.wait(write)
+        return messages
+
+    def apply_take(self, user_id, ndirect, last_broadcast_id):
+        self.drop_messages(user_id, ndirect)
+        if last_broadcast_id is not None:
+            self.cursors[user_id] = max(
+                self.cursors[user_id], last_broadcast_id
+            )
+
+    def drop_messages(self, user_id, n):
+        """Delete the n oldest direct messages in a user's inbox."""
+        if n == 0:
+            return
+        inbox = self.inboxes[user_id]
+        if n == len(inbox):
+            del self.inboxes[user_id]
+        else:
+            for _ in range(n):
+                inbox.popleft()
+
+    @timed
+    def create_group(self, name, owner_id):
+        with self.lock:
+            if name in self.group_ids:
+                return None
+            group_id, write = self.record('group', name, owner_id)
+        self.wait(write)
+        return group_id
+
+    def apply_group(self, name, owner_id):
+        self.last_group_id += 1
+        self.group_ids[name] = self.last_group_id
+        self.members[self.last_group_id] = {owner_id: None}
+        return self.last_group_id
+
+    @timed
+    def get_group_id(self, name):
+        with self.lock:
+            return self.group_ids.get(name)
+
+    @timed
+    def get_group_members(self, group_id):
+        with self.lock:
+            return list(self.members[group_id])
+
+    @timed
+    def add_group_member(self, group_id, user_id):
+        with self.lock:
+            if user_id in self.members[group_id]:
+                return
+            _, write = self.record('join', group_id, user_id)
+        self.wait(write)
+
+    def apply_join(self, group_id, user_id):
+        self.members[group_id][user_id] = None
+
+    @timed
+    def remove_group_member(self, group_id, user_id):
+        with self.lock:
+            if user_id not in self.members[group_id]:
+                return False
+            _, write = self.record('leave', group_id, user_id)
+        self.wait(write)
+        return True
+
+    def apply_leave(self, group_id, user_id):
+        del self.members[group_id][user_id]
+
+    @timed
+    def get_filenames(self):
+        with self.lock:
+            return list(self.files)
+
+    @timed
+    def get_files_version(self):
+        with self.lock:
+            return len(self.files)
+
+    @timed
+    def get_file_blob(self, filename):
+        with self.lock:
+            return self.files.get(filename)
+
+    @timed
+    def create_file(self, filename, blob):
+        with self.lock:
+            if filename in self.files:
+                return None
+            file_id, write = self.record('file', filename, blob)
+        self.wait(write)
+        return file_id
+
+    def apply_file(self, filename, blob):
+        self.files[filename] = blob
+        return len(self.files)
+
+    @timed
+    def expire_messages(self, cutoff, batch_size):
+        with self.lock:
+            counts = []
+            total = 0
+            for user_id, inbox in self.inboxes.items():
+                n = 0
+                for _, message in inbox:
+                    if message[0] >= cutoff or total + n == batch_size:
+                        break
+                    n += 1
+                if n:
+                    counts.append((user_id, n))
+                    total += n
+                if total == batch_size:
+                    break
+            if not counts:
+                return 0
+            _, write = self.record('drop', counts)
+        self.wait(write)
+        return total
+
+    def apply_drop(self, counts):
+        for user_id, n in counts:
+            self.drop_messages(user_id, n)
+
+    @timed
+    def expire_broadcasts(self, cutoff, batch_size):
+        with self.lock:
+            n = 0
+            for _, message in self.broadcasts[:batch_size]:
+                if message[0] >= cutoff:
+                    break
+                n += 1
+            if n == 0:
+                return 0
+            _, write = self.record(
+                'drop_broadcasts', self.broadcasts[n - 1][0]
+            )
+        self.wait(write)
+        return n
+
+    def apply_drop_broadcasts(self, last_broadcast_id):
+        ndelete = 0
+        while (ndelete < len(self.broadcasts) and
+                self.broadcasts[ndelete][0] <= last_broadcast_id):
+            ndelete += 1
+        del self.broadcasts[:ndelete]
+
+    @timed
+    def get_full_inboxes(self, cap):
+        with self.lock:
+            return [
+                user_id for user_id, inbox in self.inboxes.items()
+                if len(inbox) > cap
+            ]
+
+    @timed
+    def trim_inbox(self, inbox_id, cap, batch_size):
+        with self.lock:
+            n = min(len(self.inboxes.get(inbox_id, ())) - cap, batch_size)
+            if n <= 0:
+                return 0
+            _, write = self.record('drop', [(inbox_id, n)])
+        self.wait(write)
+        return n
+
+    # The functions that apply each kind of change, both as it is made and as
+    # it is replayed from the log.
+    APPLY = {
+        'user': apply_user,
+        'message': apply_message,
+        'broadcast': apply_broadcast,
+        'take': apply_take,
+        'group': apply_group,
+        'join': apply_join,
+        'leave': apply_leave,
+        'file': apply_file,
+        'drop': apply_drop,
+        'drop_broadcasts': apply_drop_broadcasts,
+    }
+
+
+class Maintenance(threading.Thread):
+    """A background thread that enforces the retention policies, and gives the
+    space that they free back to the file system.
+
+    Messages and broadcasts older than `ttl` seconds are deleted, as are the
+    oldest direct messages of any inbox that holds more than `inbox_cap`.
+    Either policy may be None. Rows are deleted `batch_size` at a time, each
+    batch in a write of its own, so that send and recv are never held up for
+    long.
+    """
+
+    def __init__(self, storage, ttl=None, inbox_cap=None,
+            interval=MAINTENANCE_INTERVAL, batch_size=MAINTENANCE_BATCH_SIZE):
+        super().__init__(name='Maintenance', daemon=True)
+        self.storage = storage
+        self.ttl = ttl
+        self.inbox_cap = inbox_cap
+        self.interval = interval
+        self.batch_size = batch_size
+        self.stopping = threading.Event()
+
+    def run(self):
+        while not self.stopping.wait(self.interval):
+            try:
+                if self.run_once():
+                    self.storage.compact(self.stopping)
+            except (sqlite3.Error, OSError) as e:
+                logger.error('Maintenance failed: %s', e)
+
+    def stop(self):
+        self.stopping.set()
+
+    def run_once(self):
+        """Apply the retention policies, and return the number of rows that
+        were deleted.
+        """
+        expired = 0
+        if self.ttl is not None:
+            cutoff = datetime.datetime.utcnow() - datetime.timedelta(
+                seconds=self.ttl
+            )
+            cutoff = cutoff.isoformat() + 'Z'
+            expired += self.repeat(self.storage.expire_messages, cutoff)
+            expired += self.repeat(self.storage.expire_broadcasts, cutoff)
+
+        trimmed = 0
+        if self.inbox_cap is not None:
+            for inbox_id in self.storage.get_full_inboxes(self.inbox_cap):
+                trimmed += self.repeat(
+                    self.storage.trim_inbox, inbox_id, self.inbox_cap
+                )
+
+        if expired or trimmed:
+            logger.info('Deleted %d expired messages and %d over inbox caps',
+                expired, trimmed)
+            metrics.add_messages_deleted('ttl', expired)
+            metrics.add_messages_deleted('inbox_cap', trimmed)
+            # The bodies of messages to several users go once every inbox row
+            # that points to them has.
+            self.repeat(self.storage.delete_orphan_bodies)
+        return expired + trimmed
+
+    def repeat(self, f, *args):
+        """Call f(*args, batch_size) until it deletes less than a full batch,
+        and return the total that it deleted.
+        """
+        total = 0
+        while not self.stopping.is_set():
+            deleted = f(*args, self.batch_size)
+            total += deleted
+            if deleted < self.batch_size:
+                break
+            self.stopping.wait(MAINTENANCE_PAUSE)
+        return total
+
+
+if __name__ == '__main__':
+    # Parse command-line arguments.
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-d', '--database', default=DB_FILE,
+        help='path to a SQLite3 database to use')
+    parser.add_argument('-f', '--files', default=FILE_DIR,
+        help='path to a directory to hold files uploaded to the server')
+    parser.add_argument('-p', '--port', default=SERVER_PORT, type=int,
+        help='port for the server to listen on')
+    parser.add_argument('-q', '--quiet', action='store_true', default=False,
+        help='turn off logging')
+    parser.add_argument('--log-max-payload', type=int,
+        default=LOG_MAX_PAYLOAD,
+        help='log at most this many bytes of each message and response')
+    parser.add_argument('--log-sample', type=sample_rate, action='append',
+        default=[], metavar='COMMAND=RATE',
+        help='log only this fraction of the messages of a command, e.g. '
+            'send=0.01 (may be given more than once)')
+    parser.add_argument('--engine', choices=ENGINES, default='threaded',
+        help='serve connections with one thread each (the default) or on a '
+            'single asyncio event loop')
+    parser.add_argument('--file-store', choices=FILE_STORES, default='plain',
+        help="store each upload as a file of the same name ('plain'), or "
+            "store each distinct content once ('dedup')")
+    parser.add_argument('--workers', type=int, default=1,
+        help='number of server processes to run, all listening on the same '
+            'port')
+    parser.add_argument('--metrics-port', type=int, default=None,
+        help='serve metrics in the Prometheus text format over HTTP on this '
+            'port (plus the index of the worker, with --workers)')
+    parser.add_argument('--profile', default=None, metavar='PATH',
+        help='profile the server for a while each time that it receives '
+            'SIGUSR1, and write the stats to files beginning with PATH')
+    parser.add_argument('--profile-window', type=float,
+        default=PROFILE_WINDOW,
+        help='seconds to profile for after each SIGUSR1')
+    parser.add_argument('--tcp-policy', choices=TCP_POLICIES,
+        default='nodelay',
+        help="'nodelay' sends each batch of responses immediately, 'nagle' "
+            "leaves Nagle's algorithm on, and 'cork' also packs each large "
+            'downloaded file into as few packets as possible')
+    parser.add_argument('--max-connections', type=int, default=0,
+        help='most connections for each server process to serve at once, '
+            'leaving the rest waiting to be accepted (0 for no limit)')
+    parser.add_argument('--idle-timeout', type=float, default=0,
+        help='seconds to wait for a message before disconnecting the client '
+            '(default 0, to wait forever)')
+    parser.add_argument('--message-timeout', type=float, default=0,
+        help='seconds for a message to arrive in full once it has begun '
+            '(default 0, to wait forever)')
+    parser.add_argument('--send-timeout', type=float, default=0,
+        help='seconds to wait for a client to accept more of its responses '
+            'before disconnecting it (default 0, to wait forever)')
+    parser.add_argument('--output-limit', type=int, default=OUTPUT_LIMIT,
+        help='bytes of unsent responses to buffer for each connection (0 for '
+            'no limit)')
+    parser.add_argument('--slow-client-policy', choices=SLOW_CLIENT_POLICIES,
+        default='wait',
+        help="when a client's responses exceed the output limit, stop "
+            "reading its messages until it catches up ('wait'), or "
+            "disconnect it ('close')")
+    parser.add_argument('--executor-threads', type=int, default=None,
+        help='number of threads for database and file work in asyncio mode')
+    parser.add_argument('--commit-window', type=float, default=0.0,
+        help='milliseconds to wait for more writes before committing a batch '
+            '(default: commit as soon as no more writes are queued)')
+    parser.add_argument('--commit-batch-size', type=int, default=256,
+        help='maximum number of writes to commit in one transaction')
+    parser.add_argument('--recv-limit', type=int, default=RECV_LIMIT,
+        help='most messages to return for each recv, leaving the rest for '
+            'the next one (0 for no limit)')
+    parser.add_argument('--message-ttl', type=float, default=0,
+        help='seconds to keep undelivered messages before deleting them (0 '
+            'to keep them until they are received)')
+    parser.add_argument('--inbox-cap', type=int, default=0,
+        help='most direct messages to keep in each inbox, deleting the '
+            'oldest ones first (0 for no limit)')
+    parser.add_argument('--maintenance-interval', type=float,
+        default=MAINTENANCE_INTERVAL,
+        help='seconds between runs of the retention policies')
+    parser.add_argument('--maintenance-batch-size', type=int,
+        default=MAINTENANCE_BATCH_SIZE,
+        help='most messages to delete in one transaction')
+    parser.add_argument('--max-recv-wait', type=float, default=MAX_RECV_WAIT,
+        help='longest that a `recv wait` may wait for a message, in seconds')
+    parser.add_argument('--db-pool-size', type=int, default=8,
+        help='maximum number of SQLite connections shared by all clients')
+    parser.add_argument('--db-synchronous', default='FULL',
+        choices=('OFF', 'NORMAL', 'FULL', 'EXTRA'),
+        help='SQLite synchronous pragma (NORMAL is faster, but the most '
+            'recent commits can be lost on power failure)')
+    parser.add_argument('--db-cache-size', type=int, default=8192,
+        help='SQLite page cache size per connection, in KiB')
+    parser.add_argument('--db-mmap-size', type=int, default=268435456,
+        help='bytes of the database file to memory-map (0 to disable)')
+    parser.add_argument('--db-statement-cache', type=int, default=256,
+        help='number of prepared statements to cache per connection')
+    parser.add_argument('--storage', choices=STORAGE_BACKENDS,
+        default='sqlite',
+        help='where to keep users and messages: the SQLite database, or '
+            'memory, with a log of changes in a directory named after the '
+            'database (memlog)')
+    parser.add_argument('--snapshot-interval', type=float,
+        default=SNAPSHOT_INTERVAL,
+        help='seconds between snapshots of the memlog storage\'s state')
+    parser.add_argument('--db-shards', type=int, default=1,
+        help='number of database files to partition the messages across, by '
+            'recipient, so that sends to different inboxes commit in '
+            'parallel (the others are named after the database); on a disk '
+            'with a fast fsync, one file is faster (see '
+            'bench/bench_shards.py)')
+    args = parser.parse_args()
+
+    # Threads do not survive fork, so a supervisor logs without one, and each
+    # worker starts its own.
+    log_options = (args.quiet, args.log_max_payload, dict(args.log_sample))
+    configure_logging(*log_options, background=False)
+    if args.workers > 1 and not hasattr(os, 'fork'):
+        fatal('--workers is not supported on this platform')
+    if args.profile is not None and not hasattr(signal, 'SIGUSR1'):
+        fatal('--profile is not supported on this platform')
+    if args.db_shards < 1:
+        fatal('--db-shards must be at least 1')
+    if args.storage == 'memlog':
+        if args.workers > 1:
+            fatal('--storage memlog cannot be shared by several --workers')
+        if args.db_shards > 1:
+            fatal('--db-shards only applies to --storage sqlite')
+
+    try:
+        os.mkdir(args.files)
+    except FileExistsError:
+        pass
+    except OSError:
+        fatal(
+            'File folder %s does not exist and could not be created', args.files
+        )
+    remove_partial_uploads(args.files)
+
+    if args.storage == 'memlog':
+        # The log is fsynced as often as SQLite would fsync the database.
+        storage = MemLogStorage(args.database + '-memlog',
+            recv_limit=args.recv_limit or None,
+            sync=args.db_synchronous in ('FULL', 'EXTRA'),
+            snapshot_interval=args.snapshot_interval)
+    else:
+        # Each shard has a pool and a writer of its own.
+        shards = []
+        for index in range(args.db_shards):
+            pool = ConnectionPool(shard_path(args.database, index),
+                size=args.db_pool_size, synchronous=args.db_synchronous,
+                cache_size=args.db_cache_size, mmap_size=args.db_mmap_size,
+                cached_statements=args.db_statement_cache)
+            writer = StorageWriter(pool, window=args.commit_window / 1000,
+                batch_size=args.commit_batch_size)
+            shards.append(MessageShard(pool, writer))
+        storage = StorageLayer(shards[0].pool, shards[0].writer,
+            recv_limit=args.recv_limit or None, shared=args.workers > 1,
+            shards=shards[1:])
+    if args.file_store == 'dedup':
+        files = DedupFileStore(args.files, storage, shared=args.workers > 1)
+    else:
+        files = FileStore(args.files, shared=args.workers > 1)
+    # Every worker binds its own socket to the port if the platform allows it.
+    # Otherwise they share one socket, bound before they are forked.
+    reuse_port = args.workers > 1 and hasattr(socket, 'SO_REUSEPORT')
+    limits = ConnectionLimits(
+        idle_timeout=args.idle_timeout or None,
+        message_timeout=args.message_timeout or None,
+        send_timeout=args.send_timeout or None,
+        output_limit=args.output_limit or None,
+        slow_client_policy=args.slow_client_policy,
+        max_connections=args.max_connections or None,
+        max_recv_wait=args.max_recv_wait,
+    )
+    if args.engine == 'asyncio':
+        server = AsyncChatServer(args.port, storage, files, args.tcp_policy,
+            reuse_port, limits, max_workers=args.executor_threads)
+    else:
+        server = ChatServer(args.port, storage, files, args.tcp_policy,
+            reuse_port, limits)
+
+    def run_worker(index):
+        listener = configure_logging(*log_options)
+        if args.metrics_port is not None:
+            # Each worker serves its own metrics, on consecutive ports.
+            start_metrics_server(args.metrics_port + index)
+        if args.profile is not None:
+            profiler.path = args.profile
+            profiler.window = args.profile_window
+            signal.signal(signal.SIGUSR1, profiler.start)
+        # One process is enough to enforce the retention policies.
+        if index == 0 and (args.message_ttl or args.inbox_cap):
+            server.maintenance = Maintenance(storage,
+                ttl=args.message_ttl or None, inbox_cap=args.inbox_cap or None,
+                interval=args.maintenance_interval,
+                batch_size=args.maintenance_batch_size)
+        try:
+            server.run_forever()
+        finally:
+            # Write out whatever is still in the log queue.
+            listener.stop()
+
+    if args.workers > 1:
+        storage.migrate()
+        if not reuse_port:
+            server.bind()
+        # Each worker profiles itself when the supervisor gets SIGUSR1.
+        relay = (signal.SIGUSR1,) if args.profile is not None else ()
+        sys.exit(Supervisor(args.workers, run_worker, relay).run_forever())
+    else:
+        run_worker(0)
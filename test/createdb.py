@@ -8,11 +8,16 @@ if len(sys.argv) != 2:
 else:
     db = sqlite3.connect(sys.argv[1])
     cursor = db.cursor()
+    # Let servers that delete old messages in the background return the space
+    # to the file system bit by bit. This must come before any table is
+    # created.
+    cursor.execute('PRAGMA auto_vacuum=INCREMENTAL;')
     cursor.execute('''
         CREATE TABLE users (
             user_id INTEGER PRIMARY KEY,
             username varchar(30) NOT NULL,
-            password varchar(50) NOT NULL
+            password varchar(50) NOT NULL,
+            broadcast_cursor INTEGER NOT NULL DEFAULT 0
         );
     ''')
     cursor.execute('''
@@ -23,12 +28,82 @@ else:
             destination varchar(30) NOT NULL,
             inbox_id INTEGER NOT NULL,
             body varchar(256) NOT NULL,
+            broadcast_seq INTEGER NOT NULL DEFAULT 0,
+            body_id INTEGER,
             FOREIGN KEY (source_id) REFERENCES users (user_id)
                 ON UPDATE CASCADE ON DELETE CASCADE,
             FOREIGN KEY (inbox_id) REFERENCES users (user_id)
+                ON UPDATE CASCADE ON DELETE CASCADE,
+            FOREIGN KEY (body_id) REFERENCES message_bodies (body_id)
+        );
+    ''')
+    # A message to several users can be stored once in this table, and
+    # referenced by the body_id of a row in each recipient's inbox. The
+    # destination and body columns of those rows are then left empty.
+    cursor.execute('''
+        CREATE TABLE message_bodies (
+            body_id INTEGER PRIMARY KEY,
+            destination varchar(30) NOT NULL,
+            body varchar(256) NOT NULL
+        );
+    ''')
+    # Broadcast messages are stored once, rather than once per inbox. Each
+    # user's broadcast_cursor is the ID of the last broadcast that they have
+    # received, and each direct message's broadcast_seq is the ID of the last
+    # broadcast that was sent before it, so that the two kinds of messages can
+    # be merged in the order they were sent.
+    cursor.execute('''
+        CREATE TABLE broadcasts (
+            broadcast_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            timestamp varchar(25) NOT NULL,
+            source_id INTEGER NOT NULL,
+            body varchar(256) NOT NULL,
+            FOREIGN KEY (source_id) REFERENCES users (user_id)
                 ON UPDATE CASCADE ON DELETE CASCADE
         );
     ''')
+    # Servers that deduplicate uploads can use this table to map filenames to
+    # the SHA-256 digests of their contents.
+    cursor.execute('''
+        CREATE TABLE files (
+            file_id INTEGER PRIMARY KEY,
+            filename varchar(255) NOT NULL UNIQUE,
+            blob varchar(64) NOT NULL
+        );
+    ''')
+    # Named groups of users, which messages can be sent to.
+    cursor.execute('''
+        CREATE TABLE groups (
+            group_id INTEGER PRIMARY KEY,
+            name varchar(30) NOT NULL UNIQUE,
+            owner_id INTEGER NOT NULL,
+            FOREIGN KEY (owner_id) REFERENCES users (user_id)
+                ON UPDATE CASCADE ON DELETE CASCADE
+        );
+    ''')
+    cursor.execute('''
+        CREATE TABLE group_members (
+            group_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            PRIMARY KEY (group_id, user_id),
+            FOREIGN KEY (group_id) REFERENCES groups (group_id)
+                ON UPDATE CASCADE ON DELETE CASCADE,
+            FOREIGN KEY (user_id) REFERENCES users (user_id)
+                ON UPDATE CASCADE ON DELETE CASCADE
+        ) WITHOUT ROWID;
+    ''')
+    cursor.execute('CREATE INDEX users_username ON users (username);')
+    cursor.execute(
+        'CREATE INDEX messages_inbox ON messages (inbox_id, message_id);'
+    )
+    cursor.execute('''
+        CREATE INDEX messages_body ON messages (body_id)
+            WHERE body_id IS NOT NULL;
+    ''')
+    # Servers that migrate their database in place can use this to tell that
+    # the schema is already up to date. It must match the number of migrations
+    # in python/server.py.
+    cursor.execute('PRAGMA user_version=4;')
     db.commit()
     cursor.close()
     db.close()
@@ -1,81 +1,14 @@
-"""A helper module for the polyglot-server test suite.
+"""The polyglot-server test suite.
 
-Although the module is written in Python, it interacts with the server only
-through the standard sockets interface, and thus it can test a server written
-in any language.
+Run it with the testclient script in the top-level directory, which starts the
+server first.
 
 Author:  Ian Fisher (iafisher@protonmail.com)
 Version: August 2018
 """
-import inspect
-import socket
-import sys
 import time
 
-
-# Time to wait, in seconds, before receiving the response to a request. If you
-# get spurious "expected b'...', got nothing" errors, try adjusting this value
-# upwards.
-TIME_TO_WAIT = 0.1
-
-
-def ASSERT(cond, msg, *args):
-    try:
-        assert cond
-    except AssertionError:
-        lineno = inspect.getframeinfo(inspect.stack()[-1][0]).lineno
-        sys.stderr.write(('Error ({}:{}): ' + msg + '\r\n').format(
-            __file__, lineno, *args))
-
-
-def ASSERT_EMPTY(client):
-    time.sleep(TIME_TO_WAIT)
-    try:
-        data = client.recv(1024, socket.MSG_DONTWAIT)
-    except BlockingIOError:
-        pass
-    else:
-        ASSERT(data == b'', 'expected nothing, got {!r}', data)
-
-
-def A(client, request, response):
-    response = to_bytes(response)
-    client.send(to_bytes(request))
-    time.sleep(TIME_TO_WAIT)
-    try:
-        data = client.recv(4096, socket.MSG_DONTWAIT)
-    except BlockingIOError:
-        ASSERT(False, 'expected {!r}, got nothing', response)
-    else:
-        ASSERT(equivalent(response, data), 'expected {!r}, got {!r}',
-            response, data)
-
-
-def new_client(credentials=None):
-    client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    client.connect((socket.gethostbyname('localhost'), 8888))
-    if credentials is not None:
-        A(client, b'register ' + to_bytes(credentials), 'success')
-    return client
-
-
-def to_bytes(str_or_bytes):
-    if isinstance(str_or_bytes, str):
-        return str_or_bytes.encode('utf-8') + b'\r\n'
-    else:
-        return str_or_bytes
-
-
-def equivalent(expected, got):
-    index = expected.find(b'<timestamp>')
-    if index != -1:
-        next_space = got.find(b' ', index + 1)
-        if next_space == -1:
-            next_space = len(got)
-        return expected[:index] == got[:index] \
-            and equivalent(expected[index+11:], got[next_space:])
-    else:
-        return expected == got
+from testhelper import A, ASSERT_EMPTY, new_client
 
 
 # REGISTRATION AND LOG-IN
@@ -147,6 +80,12 @@ A(syntax_user, 'logout', 'success')
 A(syntax_user, 'register jekvnkje ' + 'a'*51, 'error password longer than 50 chars')
 A(syntax_user, 'register jekvnkje ' + 'a'*50, 'success')
 A(syntax_user, 'logout', 'success')
+# Servers that support sending to several users or to a group must not allow
+# usernames that send would read as either.
+A(syntax_user, 'register x,y pwd', 'error username contains a comma or begins with #')
+A(syntax_user, 'register #tag pwd', 'error username contains a comma or begins with #')
+A(syntax_user, 'register tag#1 pwd', 'success')
+A(syntax_user, 'logout', 'success')
 
 
 # UPLOAD AND DOWNLOAD
@@ -237,6 +176,122 @@ pentest_user.send(b'logout')
 pentest_user.close()
 
 
+# LISTING FILES A PAGE AT A TIME (optional)
+A(upload_user, 'listfiles 0 2', 'filelist hello.txt junk.bin')
+A(upload_user, 'listfiles 2 2', 'filelist long.txt long2.txt')
+A(upload_user, 'listfiles 4 10', 'filelist दस्तावेज़')
+A(upload_user, 'listfiles 10 10', 'filelist')
+A(upload_user, 'listfiles 0 0', 'filelist')
+A(upload_user, 'listfiles 0 10 long', 'filelist long.txt long2.txt')
+A(upload_user, 'listfiles 1 10 long', 'filelist long2.txt')
+A(upload_user, 'listfiles 0 10 nothing', 'filelist')
+A(upload_user, 'listfiles -1 2', 'error invalid offset or limit')
+A(upload_user, 'listfiles 0 x', 'error invalid offset or limit')
+A(upload_user, 'listfiles 0', 'error wrong number of fields')
+
+
+# RANGED DOWNLOADS (optional)
+A(upload_user, 'download hello.txt 1 3', 'file hello.txt 3 ell')
+# A range that runs past the end of the file is cut short.
+A(upload_user, 'download hello.txt 4 100', 'file hello.txt 2 o\n')
+A(upload_user, 'download hello.txt 6 10', 'file hello.txt 0 ')
+A(upload_user, 'download hello.txt 2 0', 'file hello.txt 0 ')
+A(upload_user, 'download hello.txt 7 1', 'error invalid offset or length')
+A(upload_user, 'download hello.txt -1 2', 'error invalid offset or length')
+A(upload_user, 'download hello.txt 0 x', 'error invalid offset or length')
+A(upload_user, 'download hello.txt 0', 'error wrong number of fields')
+A(upload_user, 'download nothing.txt 0 1', 'error could not read from file')
+
+
+# RECV WITH A MAXIMUM (optional)
+recv_user = new_client('recv_user pwd')
+A(recv_user, 'send recv_user one', 'success')
+A(recv_user, 'send recv_user two', 'success')
+A(recv_user, 'send recv_user three', 'success')
+# The oldest messages come first, and the rest are left in the inbox.
+A(recv_user, 'recv 2', b'message <timestamp> recv_user recv_user one\r\nmessage <timestamp> recv_user recv_user two\r\n')
+A(recv_user, 'recv 5', 'message <timestamp> recv_user recv_user three')
+A(recv_user, 'recv 1', 'error inbox is empty')
+# A maximum larger than any inbox can hold is not an error.
+A(recv_user, 'send recv_user four', 'success')
+A(recv_user, 'recv 99999999999999999999999', 'message <timestamp> recv_user recv_user four')
+A(recv_user, 'recv 0', 'error invalid maximum number of messages')
+A(recv_user, 'recv -1', 'error wrong number of fields')
+
+
+# SENDING TO SEVERAL USERS AND TO GROUPS (optional)
+group_x = new_client('group_x pwd')
+group_y = new_client('group_y pwd')
+group_z = new_client('group_z pwd')
+A(group_x, 'send group_y,group_z Hello, both!', 'success')
+A(group_y, 'recv', 'message <timestamp> group_x group_y,group_z Hello, both!')
+A(group_z, 'recv', 'message <timestamp> group_x group_y,group_z Hello, both!')
+A(group_x, 'recv', 'error inbox is empty')
+# Nothing is sent if any of the recipients does not exist.
+A(group_x, 'send group_y,nobody Hello?', 'error recipient does not exist')
+A(group_y, 'recv', 'error inbox is empty')
+# Messages are received in the order they were sent, whatever their kind.
+A(group_x, 'send group_y first', 'success')
+A(group_z, 'send group_x,group_y second', 'success')
+A(group_x, 'send * third', 'success')
+A(group_z, 'send group_y,group_x fourth', 'success')
+A(group_y, 'recv', b'message <timestamp> group_x group_y first\r\nmessage <timestamp> group_z group_x,group_y second\r\nmessage <timestamp> group_x * third\r\nmessage <timestamp> group_z group_y,group_x fourth\r\n')
+A(group_x, 'recv', b'message <timestamp> group_z group_x,group_y second\r\nmessage <timestamp> group_x * third\r\nmessage <timestamp> group_z group_y,group_x fourth\r\n')
+A(group_z, 'recv', 'message <timestamp> group_x * third')
+# Groups
+A(group_x, 'send #friends Hi', 'error group does not exist')
+A(group_x, 'group create friends', 'success')
+A(group_y, 'group create friends', 'error group already exists')
+A(group_y, 'group join friends', 'success')
+A(group_z, 'send #friends Let me in', 'error not a member of the group')
+A(group_x, 'send #friends Hi, friends!', 'success')
+A(group_x, 'recv', 'message <timestamp> group_x #friends Hi, friends!')
+A(group_y, 'recv', 'message <timestamp> group_x #friends Hi, friends!')
+A(group_z, 'recv', 'error inbox is empty')
+A(group_y, 'group leave friends', 'success')
+A(group_y, 'group leave friends', 'error not a member of the group')
+A(group_x, 'send #friends Anyone?', 'success')
+A(group_y, 'recv', 'error inbox is empty')
+A(group_x, 'recv', 'message <timestamp> group_x #friends Anyone?')
+A(group_x, 'group join nosuchgroup', 'error group does not exist')
+A(group_x, 'group create bad-name', 'error invalid group name')
+A(group_x, 'group create ' + 'g'*31, 'error invalid group name')
+A(group_x, 'group rename friends', 'error no such group action')
+A(group_x, 'group create', 'error wrong number of fields')
+
+
+# RECV WAIT (optional)
+waiter = new_client('waiter pwd')
+waker = new_client('waker pwd')
+# A message sent while the client waits is returned well before the timeout.
+# Servers with several processes may only notice a message from another
+# process when they next check, so allow them a moment. The recv sent after
+# the wait is handled once it is over.
+waiter.send(b'recv wait 5\r\n')
+ASSERT_EMPTY(waiter)
+A(waker, 'send waiter Wake up!', 'success')
+time.sleep(1.5)
+A(waiter, 'recv', b'message <timestamp> waker waiter Wake up!\r\nerror inbox is empty\r\n')
+# So is a broadcast.
+waiter.send(b'recv wait 5\r\n')
+ASSERT_EMPTY(waiter)
+A(waker, 'send * Everybody up!', 'success')
+time.sleep(1.5)
+A(waiter, 'recv', b'message <timestamp> waker * Everybody up!\r\nerror inbox is empty\r\n')
+A(waker, 'recv', 'message <timestamp> waker * Everybody up!')
+# A message that is already in the inbox is returned without waiting.
+A(waker, 'send waiter Already here', 'success')
+A(waiter, 'recv wait 5', 'message <timestamp> waker waiter Already here')
+# Once the timeout is over, the inbox is reported to be empty.
+waiter.send(b'recv wait 0.3\r\n')
+ASSERT_EMPTY(waiter)
+time.sleep(0.3)
+A(waiter, 'recv', b'error inbox is empty\r\nerror inbox is empty\r\n')
+A(waiter, 'recv wait x', 'error invalid timeout')
+A(waiter, 'recv wait -1', 'error invalid timeout')
+A(waiter, 'recv wait', 'error wrong number of fields')
+
+
 ASSERT_EMPTY(iafisher)
 ASSERT_EMPTY(bob)
 ASSERT_EMPTY(alice)
@@ -246,3 +301,9 @@ ASSERT_EMPTY(auth_user)
 ASSERT_EMPTY(bad_syntax_user)
 ASSERT_EMPTY(long_user)
 ASSERT_EMPTY(utf8_user)
+ASSERT_EMPTY(recv_user)
+ASSERT_EMPTY(group_x)
+ASSERT_EMPTY(group_y)
+ASSERT_EMPTY(group_z)
+ASSERT_EMPTY(waiter)
+ASSERT_EMPTY(waker)
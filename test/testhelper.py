@@ -0,0 +1,82 @@
+"""Helpers for scripts that talk to a chat server, such as the polyglot-server
+test suite.
+
+Although the module is written in Python, it interacts with the server only
+through the standard sockets interface, and thus it can test a server written
+in any language.
+
+Author:  Ian Fisher (iafisher@protonmail.com)
+Version: August 2018
+"""
+import inspect
+import socket
+import sys
+import time
+
+
+SERVER_PORT = 8888
+
+# Time to wait, in seconds, before receiving the response to a request. If you
+# get spurious "expected b'...', got nothing" errors, try adjusting this value
+# upwards.
+TIME_TO_WAIT = 0.1
+
+
+def ASSERT(cond, msg, *args):
+    try:
+        assert cond
+    except AssertionError:
+        # Report the line of the test script, not of this module.
+        frame = inspect.getframeinfo(inspect.stack()[-1][0])
+        sys.stderr.write(('Error ({}:{}): ' + msg + '\r\n').format(
+            frame.filename, frame.lineno, *args))
+
+
+def ASSERT_EMPTY(client):
+    time.sleep(TIME_TO_WAIT)
+    try:
+        data = client.recv(1024, socket.MSG_DONTWAIT)
+    except BlockingIOError:
+        pass
+    else:
+        ASSERT(data == b'', 'expected nothing, got {!r}', data)
+
+
+def A(client, request, response):
+    response = to_bytes(response)
+    client.send(to_bytes(request))
+    time.sleep(TIME_TO_WAIT)
+    try:
+        data = client.recv(4096, socket.MSG_DONTWAIT)
+    except BlockingIOError:
+        ASSERT(False, 'expected {!r}, got nothing', response)
+    else:
+        ASSERT(equivalent(response, data), 'expected {!r}, got {!r}',
+            response, data)
+
+
+def new_client(credentials=None, port=SERVER_PORT):
+    client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    client.connect((socket.gethostbyname('localhost'), port))
+    if credentials is not None:
+        A(client, b'register ' + to_bytes(credentials), 'success')
+    return client
+
+
+def to_bytes(str_or_bytes):
+    if isinstance(str_or_bytes, str):
+        return str_or_bytes.encode('utf-8') + b'\r\n'
+    else:
+        return str_or_bytes
+
+
+def equivalent(expected, got):
+    index = expected.find(b'<timestamp>')
+    if index != -1:
+        next_space = got.find(b' ', index + 1)
+        if next_space == -1:
+            next_space = len(got)
+        return expected[:index] == got[:index] \
+            and equivalent(expected[index+11:], got[next_space:])
+    else:
+        return expected == got